@@ -53,6 +53,57 @@ class Config:
         self.REDIS_DB = int(os.getenv("REDIS_DB", "0"))
         self.REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
         
+        # Пул заранее созданных клиентов 3x-ui для мгновенной выдачи подписки
+        # CLIENT_POOL_SIZE - сколько свободных клиентов держать на каждом активном сервере (0 = пул отключен)
+        # CLIENT_POOL_REFILL_BATCH - сколько клиентов создавать на сервер за один проход фоновой задачи
+        # CLIENT_POOL_CLAIM_TIMEOUT_MINUTES - через сколько минут забранный из пула клиент убирается из пула
+        self.CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", "0"))
+        self.CLIENT_POOL_REFILL_BATCH = int(os.getenv("CLIENT_POOL_REFILL_BATCH", "3"))
+        self.CLIENT_POOL_CLAIM_TIMEOUT_MINUTES = int(os.getenv("CLIENT_POOL_CLAIM_TIMEOUT_MINUTES", "30"))
+        
+        # Очередь повторных попыток создания подписок
+        # RETRY_QUEUE_BATCH_SIZE - сколько попыток забирать из очереди за один раз
+        # RETRY_QUEUE_SERVER_CONCURRENCY - сколько попыток одновременно обрабатывать на одном сервере
+        # RETRY_QUEUE_CLAIM_TIMEOUT_MINUTES - через сколько минут зависшая попытка (processing) возвращается в очередь
+        # RETRY_PARK_MAX_HOURS - сколько часов после оплаты ждать восстановления сервера, затем возврат средств
+        self.RETRY_QUEUE_BATCH_SIZE = int(os.getenv("RETRY_QUEUE_BATCH_SIZE", "50"))
+        self.RETRY_QUEUE_SERVER_CONCURRENCY = int(os.getenv("RETRY_QUEUE_SERVER_CONCURRENCY", "3"))
+        self.RETRY_QUEUE_CLAIM_TIMEOUT_MINUTES = int(os.getenv("RETRY_QUEUE_CLAIM_TIMEOUT_MINUTES", "30"))
+        self.RETRY_PARK_MAX_HOURS = int(os.getenv("RETRY_PARK_MAX_HOURS", "24"))
+        
+        # Очередь исходящих сообщений Telegram (рассылки и уведомления)
+        # TELEGRAM_GLOBAL_RATE - сообщений в секунду на весь бот (лимит Telegram ~30, оставляем запас для ответов)
+        # TELEGRAM_PER_CHAT_RATE - сообщений в секунду в один чат
+        # TELEGRAM_SEND_WORKERS - количество параллельных отправок
+        self.TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+        self.TELEGRAM_PER_CHAT_RATE = float(os.getenv("TELEGRAM_PER_CHAT_RATE", "1"))
+        self.TELEGRAM_SEND_WORKERS = int(os.getenv("TELEGRAM_SEND_WORKERS", "10"))
+        
+        # Рассылки: сколько сообщений рассылки одновременно находится в очереди отправки
+        self.BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "200"))
+        
+        # Режим получения обновлений Telegram: "polling" или "webhook"
+        # TELEGRAM_WEBHOOK_BASE_URL - публичный адрес бота (https://bot.example.com), к нему добавляется TELEGRAM_WEBHOOK_PATH
+        # TELEGRAM_WEBHOOK_SECRET - секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+        # TELEGRAM_WEBHOOK_MAX_CONNECTIONS - сколько одновременных соединений может открыть Telegram (1-100)
+        # WEBHOOK_SERVER_HOST / WEBHOOK_SERVER_PORT - где слушает встроенный HTTP-сервер
+        # YOOKASSA_WEBHOOK_ENABLED - принимать уведомления YooKassa по пути из WEBHOOK_URL
+        self.BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+        self.TELEGRAM_WEBHOOK_BASE_URL = os.getenv("TELEGRAM_WEBHOOK_BASE_URL", "").rstrip("/")
+        self.TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+        self.TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+        self.TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "40"))
+        self.WEBHOOK_SERVER_HOST = os.getenv("WEBHOOK_SERVER_HOST", "0.0.0.0")
+        self.WEBHOOK_SERVER_PORT = int(os.getenv("WEBHOOK_SERVER_PORT", "8080"))
+        self.YOOKASSA_WEBHOOK_ENABLED = os.getenv("YOOKASSA_WEBHOOK_ENABLED", "false").strip().lower() in ("true", "1", "yes", "on")
+        
+        # Сколько обновлений Telegram обрабатывать одновременно (в обоих режимах)
+        self.UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "60"))
+        
+        # Периодические фоновые задачи (проверка подписок, очередь повторов, пул клиентов и т.д.)
+        # При запуске нескольких реплик бота включайте их только на одной
+        self.BACKGROUND_JOBS_ENABLED = os.getenv("BACKGROUND_JOBS_ENABLED", "true").strip().lower() in ("true", "1", "yes", "on")
+        
         # Пароль для команды выдачи безграничной подписки
         self.GRANT_UNLIMITED_PASSWORD = os.getenv("GRANT_UNLIMITED_PASSWORD", "")
 
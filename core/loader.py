@@ -1,6 +1,7 @@
 from aiogram import Bot, Dispatcher
 from core.config import config
+from core.session import create_bot_session
 from core.storage import fsm_storage
 
-bot = Bot(token=config.BOT_TOKEN, parse_mode="HTML")
+bot = Bot(token=config.BOT_TOKEN, parse_mode="HTML", session=create_bot_session())
 dp = Dispatcher(storage=fsm_storage)
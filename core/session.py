@@ -0,0 +1,123 @@
+"""
+HTTP-сессия бота с единой логикой повторов запросов к Telegram Bot API
+
+Повторы реализованы как request middleware aiogram, поэтому действуют для всех
+вызовов (bot.send_message, message.answer, callback.message.edit_text и т.д.)
+без подмены методов aiogram.
+"""
+import asyncio
+import logging
+import random
+from contextvars import ContextVar
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import GetUpdates, SendMessage, SendPhoto, TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+logger = logging.getLogger(__name__)
+
+# True - не ждать retry_after в сессии, а сразу пробросить TelegramRetryAfter.
+# Устанавливается очередью отправки (services.telegram_sender): она сама откладывает
+# задачу, не занимая воркер ожиданием
+raise_on_flood_control: ContextVar[bool] = ContextVar("raise_on_flood_control", default=False)
+
+
+class RetryRequestMiddleware(BaseRequestMiddleware):
+    """
+    Повтор запросов при flood control и сетевых ошибках
+
+    - TelegramRetryAfter: ждем ровно retry_after секунд, указанных Telegram
+      (и приостанавливаем уведомления и рассылки в очереди на то же время);
+      запросы из очереди отправки не ждут, а сразу получают исключение
+    - TelegramNetworkError: экспоненциальная задержка со случайным разбросом (full jitter),
+      чтобы одновременно упавшие запросы не повторялись синхронно
+    """
+
+    def __init__(
+        self,
+        max_flood_retries: int = 3,
+        max_flood_wait: float = 60,
+        max_network_retries: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8
+    ):
+        self.max_flood_retries = max_flood_retries
+        self.max_flood_wait = max_flood_wait
+        self.max_network_retries = max_network_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _network_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        # У long polling своя логика переподключения
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+
+        method_name = type(method).__name__
+        flood_attempts = 0
+        network_attempts = 0
+        while True:
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                flood_attempts += 1
+                if raise_on_flood_control.get():
+                    raise
+                if flood_attempts > self.max_flood_retries or e.retry_after > self.max_flood_wait:
+                    raise
+                from services.telegram_sender import telegram_sender
+                telegram_sender.pause(e.retry_after)
+                logger.warning(
+                    f"⚠️ Flood control Telegram ({method_name}): ожидание {e.retry_after} сек "
+                    f"(попытка {flood_attempts}/{self.max_flood_retries})"
+                )
+                await asyncio.sleep(e.retry_after)
+            except TelegramNetworkError as e:
+                network_attempts += 1
+                if network_attempts > self.max_network_retries:
+                    logger.error(
+                        f"❌ Не удалось выполнить {method_name} после {network_attempts} попыток: {e}"
+                    )
+                    raise
+                delay = self._network_delay(network_attempts)
+                logger.warning(
+                    f"⚠️ Сетевая ошибка при {method_name} (попытка {network_attempts}/{self.max_network_retries}): "
+                    f"{e}. Повтор через {delay:.1f} сек..."
+                )
+                await asyncio.sleep(delay)
+
+
+class DefaultReplyKeyboardMiddleware(BaseRequestMiddleware):
+    """Добавляет кнопки главного меню к сообщениям, отправленным без клавиатуры"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        if isinstance(method, (SendMessage, SendPhoto)) and method.reply_markup is None:
+            from utils.keyboards.main_kb import main_menu
+            method.reply_markup = main_menu()
+        return await make_request(bot, method)
+
+
+def create_bot_session() -> AiohttpSession:
+    """
+    Создать сессию бота
+
+    Одна сессия aiohttp на весь процесс: соединения с Bot API (keep-alive) переиспользуются
+    между запросами всех обработчиков, очереди отправки и фоновых задач.
+    """
+    session = AiohttpSession()
+    session.middleware(DefaultReplyKeyboardMiddleware())
+    session.middleware(RetryRequestMiddleware())
+    return session
@@ -2,6 +2,11 @@
 Настройка подключения к базе данных PostgreSQL
 Оптимизировано для высокой нагрузки и стабильности
 """
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Optional
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
@@ -40,3 +45,94 @@ try:
 except Exception as e:
     logger.error(f"Failed to initialize database engine: {e}")
     raise
+
+
+# Сессия текущего обновления: (задача, в которой открыта сессия, сессия)
+_update_session: ContextVar[Optional[tuple[asyncio.Task, AsyncSession]]] = ContextVar(
+    "update_session", default=None
+)
+
+# Глубина вложенных блоков get_session для сессии (хранится в session.info)
+_SESSION_DEPTH_KEY = "get_session_depth"
+
+
+def _populate_existing(orm_execute_state) -> None:
+    """
+    SELECT в общей сессии обновляет уже загруженные объекты
+
+    Иначе после изменения данных (UPDATE без ORM, изменения из других процессов)
+    повторный запрос в той же сессии вернул бы устаревшие значения из identity map.
+    """
+    if orm_execute_state.is_select:
+        orm_execute_state.update_execution_options(populate_existing=True)
+
+
+@asynccontextmanager
+async def update_session_scope() -> AsyncIterator[AsyncSession]:
+    """
+    Открыть общую сессию для обработки одного обновления
+
+    Функции utils.db, вызванные в этой же задаче, используют эту сессию вместо
+    отдельной сессии на каждый вызов; функции, изменяющие данные, по-прежнему сами
+    делают commit. Транзакция, оставшаяся открытой после чтения, завершается при
+    выходе из внешнего блока get_session (см. get_session), поэтому соединение
+    не удерживается в состоянии "idle in transaction" во время HTTP-запросов
+    обработчика (панели 3x-ui, YooKassa) и возвращается в пул между запросами.
+    """
+    session = async_session()
+    event.listen(session.sync_session, "do_orm_execute", _populate_existing)
+    token = _update_session.set((asyncio.current_task(), session))
+    try:
+        yield session
+    finally:
+        _update_session.reset(token)
+        await session.close()
+
+
+def get_update_session() -> Optional[AsyncSession]:
+    """Общая сессия текущего обновления (None вне обработки обновления)"""
+    current = _update_session.get()
+    # Задачи, запущенные из обработчика (create_task, gather), наследуют контекст,
+    # но могут работать дольше обновления и параллельно с ним - им нужна своя сессия
+    if current and current[0] is asyncio.current_task():
+        return current[1]
+    return None
+
+
+@asynccontextmanager
+async def get_session(session: Optional[AsyncSession] = None) -> AsyncIterator[AsyncSession]:
+    """
+    Сессия для функций работы с БД
+
+    Переданная сессия или сессия текущего обновления используются без закрытия,
+    иначе открывается новая сессия на время блока. Если функция работала с сессией
+    текущего обновления и оставила транзакцию открытой (только чтения), транзакция
+    завершается при выходе из внешнего блока: объекты не устаревают
+    (expire_on_commit=False), а соединение возвращается в пул.
+    """
+    session = session or get_update_session()
+    if session is None:
+        async with async_session() as new_session:
+            yield new_session
+        return
+    
+    # Вложенные вызовы (функция utils.db вызывает другую с той же сессией) не должны
+    # завершать транзакцию внешней функции - она может держать блокировки
+    depth = session.info.get(_SESSION_DEPTH_KEY, 0)
+    session.info[_SESSION_DEPTH_KEY] = depth + 1
+    try:
+        yield session
+        if depth == 0 and session is get_update_session() and session.in_transaction():
+            await session.commit()
+    except Exception:
+        # Ошибка не должна оставлять общую сессию в состоянии прерванной транзакции.
+        # rollback() помечает устаревшими все объекты сессии, и обращение обработчика
+        # к уже загруженным пользователю, платежу или серверу вызвало бы ленивую загрузку
+        # (MissingGreenlet). Поэтому сначала отсоединяем объекты: загруженные значения
+        # остаются доступны, как у объектов отдельной сессии, следующие запросы
+        # загрузят данные заново.
+        session.expunge_all()
+        await session.rollback()
+        raise
+    finally:
+        session.info[_SESSION_DEPTH_KEY] = depth
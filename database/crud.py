@@ -25,4 +25,8 @@ async def create_user(session: AsyncSession, tg_id: int | str, username: str | N
     session.add(user)
     await session.commit()
     await session.refresh(user)
+    
+    # Сбрасываем запись "пользователь не найден" в кэше utils.db.get_user_by_tg_id
+    from utils.cache import CacheService, CacheKeys
+    await CacheService.delete(CacheKeys.USER_BY_TG_ID.format(tg_id=str(tg_id)))
     return user
@@ -0,0 +1,28 @@
+"""add_daily_stats_rolled_at
+
+Revision ID: add_daily_stats_rolled_at
+Revises: add_user_search_trgm
+Create Date: 2026-10-19 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_daily_stats_rolled_at'
+down_revision: Union[str, None] = 'add_user_search_trgm'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Отметка о подсчете выручки за день. Строки, созданные снимком подписок по статусам,
+    # остаются без отметки, поэтому следующий запуск rollup_daily_stats пересчитает всю историю
+    op.add_column('daily_stats', sa.Column('rolled_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('daily_stats', 'rolled_at')
@@ -0,0 +1,38 @@
+"""add_daily_stats_table
+
+Revision ID: add_daily_stats
+Revises: add_current_users_trigger
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_daily_stats'
+down_revision: Union[str, None] = 'add_current_users_trigger'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Создание таблицы daily_stats (статистика по дням для админ-панели)
+    op.create_table('daily_stats',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('revenue', sa.Float(), nullable=True),
+    sa.Column('paid_payments', sa.Integer(), nullable=True),
+    sa.Column('new_users', sa.Integer(), nullable=True),
+    sa.Column('active_subscriptions', sa.Integer(), nullable=True),
+    sa.Column('expired_subscriptions', sa.Integer(), nullable=True),
+    sa.Column('paused_subscriptions', sa.Integer(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('day')
+    )
+
+
+def downgrade() -> None:
+    # Удаление таблицы daily_stats
+    op.drop_table('daily_stats')
@@ -0,0 +1,29 @@
+"""add_locale_to_users
+
+Revision ID: add_user_locale
+Revises: add_pooled_clients
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_user_locale'
+down_revision: Union[str, None] = 'add_pooled_clients'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Добавляем язык и часовой пояс пользователя (заполняются из входящих обновлений Telegram)
+    op.add_column('users', sa.Column('language_code', sa.String(), nullable=True))
+    op.add_column('users', sa.Column('timezone_offset', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'timezone_offset')
+    op.drop_column('users', 'language_code')
@@ -0,0 +1,50 @@
+"""add_pooled_clients_table
+
+Revision ID: add_pooled_clients
+Revises: f1a2b3c4d5e6
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_pooled_clients'
+down_revision: Union[str, None] = 'f1a2b3c4d5e6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Создание таблицы pooled_clients (пул заранее созданных клиентов 3x-ui)
+    op.create_table('pooled_clients',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('server_id', sa.Integer(), nullable=False),
+    sa.Column('sub_id', sa.String(), nullable=False),
+    sa.Column('location_unique_name', sa.String(), nullable=False),
+    sa.Column('client_email', sa.String(), nullable=True),
+    sa.Column('client_keys', sa.Text(), nullable=True),
+    sa.Column('status', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('claimed_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['server_id'], ['servers.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_pooled_clients_id'), 'pooled_clients', ['id'], unique=False)
+    op.create_index(op.f('ix_pooled_clients_server_id'), 'pooled_clients', ['server_id'], unique=False)
+    op.create_index(op.f('ix_pooled_clients_sub_id'), 'pooled_clients', ['sub_id'], unique=True)
+    op.create_index(op.f('ix_pooled_clients_status'), 'pooled_clients', ['status'], unique=False)
+    op.create_index('idx_pooled_client_server_status', 'pooled_clients', ['server_id', 'status'], unique=False)
+
+
+def downgrade() -> None:
+    # Удаление таблицы pooled_clients
+    op.drop_index('idx_pooled_client_server_status', table_name='pooled_clients')
+    op.drop_index(op.f('ix_pooled_clients_status'), table_name='pooled_clients')
+    op.drop_index(op.f('ix_pooled_clients_sub_id'), table_name='pooled_clients')
+    op.drop_index(op.f('ix_pooled_clients_server_id'), table_name='pooled_clients')
+    op.drop_index(op.f('ix_pooled_clients_id'), table_name='pooled_clients')
+    op.drop_table('pooled_clients')
@@ -0,0 +1,68 @@
+"""add_server_current_users_trigger
+
+Revision ID: add_current_users_trigger
+Revises: add_server_reservations
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_current_users_trigger'
+down_revision: Union[str, None] = 'add_server_reservations'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # servers.current_users = количество активных подписок на сервере.
+    # Счетчик изменяется на +1/-1 триггером при создании, удалении подписки,
+    # изменении ее статуса или сервера (любым кодом, в том числе вне utils.db)
+    op.execute("""
+        CREATE OR REPLACE FUNCTION update_server_current_users() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE'
+               AND OLD.status IS NOT DISTINCT FROM NEW.status
+               AND OLD.server_id IS NOT DISTINCT FROM NEW.server_id THEN
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'active' THEN
+                UPDATE servers
+                SET current_users = GREATEST(COALESCE(current_users, 0) - 1, 0)
+                WHERE id = OLD.server_id;
+            END IF;
+
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'active' THEN
+                UPDATE servers
+                SET current_users = COALESCE(current_users, 0) + 1
+                WHERE id = NEW.server_id;
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER subscriptions_current_users
+        AFTER INSERT OR DELETE OR UPDATE OF status, server_id ON subscriptions
+        FOR EACH ROW EXECUTE FUNCTION update_server_current_users()
+    """)
+
+    # Начальное значение счетчика
+    op.execute("""
+        UPDATE servers
+        SET current_users = (
+            SELECT count(*) FROM subscriptions
+            WHERE subscriptions.server_id = servers.id AND subscriptions.status = 'active'
+        )
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS subscriptions_current_users ON subscriptions")
+    op.execute("DROP FUNCTION IF EXISTS update_server_current_users()")
@@ -0,0 +1,46 @@
+"""add_server_reservations_table
+
+Revision ID: add_server_reservations
+Revises: add_user_locale
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_server_reservations'
+down_revision: Union[str, None] = 'add_user_locale'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Создание таблицы server_reservations (места на серверах на время оформления покупки)
+    op.create_table('server_reservations',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('server_id', sa.Integer(), nullable=False),
+    sa.Column('tg_id', sa.String(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['server_id'], ['servers.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_server_reservations_id'), 'server_reservations', ['id'], unique=False)
+    op.create_index(op.f('ix_server_reservations_server_id'), 'server_reservations', ['server_id'], unique=False)
+    op.create_index(op.f('ix_server_reservations_tg_id'), 'server_reservations', ['tg_id'], unique=False)
+    op.create_index(op.f('ix_server_reservations_expires_at'), 'server_reservations', ['expires_at'], unique=False)
+    op.create_index('idx_server_reservation_server_expires', 'server_reservations', ['server_id', 'expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    # Удаление таблицы server_reservations
+    op.drop_index('idx_server_reservation_server_expires', table_name='server_reservations')
+    op.drop_index(op.f('ix_server_reservations_expires_at'), table_name='server_reservations')
+    op.drop_index(op.f('ix_server_reservations_tg_id'), table_name='server_reservations')
+    op.drop_index(op.f('ix_server_reservations_server_id'), table_name='server_reservations')
+    op.drop_index(op.f('ix_server_reservations_id'), table_name='server_reservations')
+    op.drop_table('server_reservations')
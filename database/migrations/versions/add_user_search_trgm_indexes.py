@@ -0,0 +1,47 @@
+"""add_user_search_trgm_indexes
+
+Revision ID: add_user_search_trgm
+Revises: add_daily_stats
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_user_search_trgm'
+down_revision: Union[str, None] = 'add_daily_stats'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# (индекс, таблица, колонка) для поиска пользователей администратором (utils.db.search_users).
+# GIN-индексы pg_trgm используются для LIKE/ILIKE по части строки и оператора сходства %
+TRGM_INDEXES = [
+    ('idx_user_username_trgm', 'users', 'username'),
+    ('idx_user_email_trgm', 'users', 'email'),
+    ('idx_user_sub_id_trgm', 'users', 'sub_id'),
+    ('idx_user_tg_id_trgm', 'users', 'tg_id'),
+    ('idx_subscription_sub_id_trgm', 'subscriptions', 'sub_id'),
+]
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for index_name, table_name, column_name in TRGM_INDEXES:
+        op.create_index(
+            index_name,
+            table_name,
+            [column_name],
+            postgresql_using='gin',
+            postgresql_ops={column_name: 'gin_trgm_ops'}
+        )
+
+
+def downgrade() -> None:
+    for index_name, table_name, _ in reversed(TRGM_INDEXES):
+        op.drop_index(index_name, table_name=table_name)
+    # Расширение pg_trgm не удаляем: его могут использовать другие объекты БД
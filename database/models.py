@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Float, Index, Text
+from sqlalchemy import Column, Integer, String, Date, DateTime, Boolean, ForeignKey, Float, Index, Text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database.base import Base
@@ -19,6 +19,8 @@ class User(Base):
     traffic_limit = Column(Float, default=0.0)
     is_admin = Column(Boolean, default=False)
     used_first_purchase_discount = Column(Boolean, default=False)  # Использовал ли пользователь скидку на первую покупку
+    language_code = Column(String, nullable=True)  # Язык из Telegram (from_user.language_code)
+    timezone_offset = Column(Integer, nullable=True)  # Смещение часового пояса в часах относительно UTC
     created_at = Column(DateTime, default=datetime.utcnow)
 
     payments = relationship("Payment", back_populates="user")
@@ -241,7 +243,7 @@ class FailedSubscriptionAttempt(Base):
     attempt_count = Column(Integer, default=0)  # Количество попыток обработки
     max_attempts = Column(Integer, default=5)  # Максимальное количество попыток
     next_attempt_at = Column(DateTime, nullable=True, index=True)  # Когда попробовать снова
-    status = Column(String, default="pending", index=True)  # pending / processing / completed / failed / refunded
+    status = Column(String, default="pending", index=True)  # pending / processing / parked / completed / failed / refunded
     refund_attempted = Column(Boolean, default=False)  # Была ли попытка возврата средств
     refund_id = Column(String, nullable=True)  # ID возврата в YooKassa
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
@@ -254,6 +256,51 @@ class FailedSubscriptionAttempt(Base):
     subscription = relationship("Subscription")
 
 
+class PooledClient(Base):
+    """Заранее созданный (отключенный) клиент 3x-ui для мгновенной выдачи подписки после оплаты"""
+    __tablename__ = "pooled_clients"
+
+    id = Column(Integer, primary_key=True, index=True)
+    server_id = Column(Integer, ForeignKey("servers.id"), nullable=False, index=True)
+    sub_id = Column(String, nullable=False, unique=True, index=True)  # Зарезервированный SubId (клиенты уже созданы на панели с этим subId)
+    location_unique_name = Column(String, nullable=False)  # Уникальное название локации, сгенерированное из sub_id
+    client_email = Column(String, nullable=True)  # Email основного клиента (VLESS, если есть)
+    client_keys = Column(Text, nullable=True)  # JSON с ключами клиентов (то же, что сохраняется в Subscription.x3ui_client_id)
+    status = Column(String, default="available", index=True)  # available / claimed (забранные убираются через CLIENT_POOL_CLAIM_TIMEOUT_MINUTES)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    claimed_at = Column(DateTime, nullable=True)
+
+    server = relationship("Server")
+
+
+class ServerReservation(Base):
+    """Место на сервере, занятое пользователем на время оформления покупки (до оплаты)"""
+    __tablename__ = "server_reservations"
+
+    id = Column(Integer, primary_key=True, index=True)
+    server_id = Column(Integer, ForeignKey("servers.id"), nullable=False, index=True)
+    tg_id = Column(String, nullable=False, index=True)  # Telegram ID покупателя
+    expires_at = Column(DateTime, nullable=False, index=True)  # После этого времени место снова свободно
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    server = relationship("Server")
+
+
+class DailyStats(Base):
+    """Статистика за день (заполняется фоновой задачей, используется в статистике админ-панели)"""
+    __tablename__ = "daily_stats"
+
+    day = Column(Date, primary_key=True)  # День (UTC)
+    revenue = Column(Float, default=0.0)  # Сумма успешных платежей
+    paid_payments = Column(Integer, default=0)  # Количество успешных платежей
+    new_users = Column(Integer, default=0)  # Количество новых пользователей
+    active_subscriptions = Column(Integer, nullable=True)  # Подписки по статусам на момент последнего обновления за день
+    expired_subscriptions = Column(Integer, nullable=True)
+    paused_subscriptions = Column(Integer, nullable=True)
+    rolled_at = Column(DateTime, nullable=True)  # Когда посчитаны выручка и новые пользователи (NULL - день еще не закрыт)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
 class AdminDocumentation(Base):
     """Документация для админов"""
     __tablename__ = "admin_documentation"
@@ -293,4 +340,13 @@ Index('idx_payment_tg_status', Payment.tg_id, Payment.status)
 Index('idx_tutorial_platform_active', Tutorial.platform_id, Tutorial.is_active)
 Index('idx_tutorial_platform_basic', Tutorial.platform_id, Tutorial.is_basic)
 Index('idx_failed_attempt_status_next', FailedSubscriptionAttempt.status, FailedSubscriptionAttempt.next_attempt_at)
-Index('idx_failed_attempt_payment', FailedSubscriptionAttempt.payment_id, FailedSubscriptionAttempt.status)
\ No newline at end of file
+Index('idx_failed_attempt_payment', FailedSubscriptionAttempt.payment_id, FailedSubscriptionAttempt.status)
+Index('idx_pooled_client_server_status', PooledClient.server_id, PooledClient.status)
+Index('idx_server_reservation_server_expires', ServerReservation.server_id, ServerReservation.expires_at)
+
+# Триграммные индексы для поиска пользователей администратором (требуют расширения pg_trgm)
+Index('idx_user_username_trgm', User.username, postgresql_using='gin', postgresql_ops={'username': 'gin_trgm_ops'})
+Index('idx_user_email_trgm', User.email, postgresql_using='gin', postgresql_ops={'email': 'gin_trgm_ops'})
+Index('idx_user_sub_id_trgm', User.sub_id, postgresql_using='gin', postgresql_ops={'sub_id': 'gin_trgm_ops'})
+Index('idx_user_tg_id_trgm', User.tg_id, postgresql_using='gin', postgresql_ops={'tg_id': 'gin_trgm_ops'})
+Index('idx_subscription_sub_id_trgm', Subscription.sub_id, postgresql_using='gin', postgresql_ops={'sub_id': 'gin_trgm_ops'})
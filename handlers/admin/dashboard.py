@@ -3,17 +3,19 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from utils.filters import AdminFilter
-from utils.keyboards.admin_kb import admin_menu, stats_keyboard, cancel_keyboard
-from utils.db import (
-    get_total_revenue,
-    get_revenue_by_period,
-    get_subscriptions_count_by_status,
-    get_users_with_active_subscriptions_count,
-    get_paid_payments_count_by_period,
-    get_new_users_count_by_period,
-    get_all_users
+from utils.keyboards.admin_kb import admin_menu, stats_keyboard, cancel_keyboard, purchase_latency_keyboard
+from utils.db import get_users_count
+from services.admin_stats import get_admin_stats_snapshot
+from utils.tracing import get_stage_summary, TraceStages
+from services.broadcast import (
+    BroadcastStatus,
+    build_message_data,
+    create_broadcast,
+    get_broadcast,
+    launch_broadcast,
+    set_broadcast_status,
+    update_status_message
 )
-from datetime import datetime, timedelta
 import html
 
 router = Router()
@@ -39,32 +41,18 @@ async def safe_edit_text(message: types.Message, text: str, reply_markup=None, p
 async def stats_callback(callback: types.CallbackQuery):
     await callback.answer()
     
-    # Определяем периоды
-    now = datetime.utcnow()
-    today_start = datetime(now.year, now.month, now.day, 0, 0, 0)
-    week_start = today_start - timedelta(days=7)
-    month_start = datetime(now.year, now.month, 1, 0, 0, 0)
-    
-    # Получаем статистику по подпискам
-    active_subscriptions = await get_subscriptions_count_by_status("active")
-    expired_subscriptions = await get_subscriptions_count_by_status("expired")
-    paused_subscriptions = await get_subscriptions_count_by_status("paused")
-    total_subscriptions = active_subscriptions + expired_subscriptions + paused_subscriptions
-    
-    # Получаем статистику по пользователям
-    users_with_subscriptions = await get_users_with_active_subscriptions_count()
-    
-    # Получаем финансовую статистику
-    total_revenue = await get_total_revenue()
-    revenue_today = await get_revenue_by_period(today_start)
-    revenue_week = await get_revenue_by_period(week_start)
-    revenue_month = await get_revenue_by_period(month_start)
-    
-    # Получаем статистику по платежам
-    payments_today = await get_paid_payments_count_by_period(today_start)
-    
-    # Получаем статистику по новым пользователям
-    new_users_today = await get_new_users_count_by_period(today_start)
+    # Снимок статистики (обновляется не чаще раза в минуту)
+    stats = await get_admin_stats_snapshot()
+    active_subscriptions = stats["active_subscriptions"]
+    expired_subscriptions = stats["expired_subscriptions"]
+    paused_subscriptions = stats["paused_subscriptions"]
+    users_with_subscriptions = stats["users_with_subscriptions"]
+    total_revenue = stats["total_revenue"]
+    revenue_today = stats["revenue_today"]
+    revenue_week = stats["revenue_week"]
+    revenue_month = stats["revenue_month"]
+    payments_today = stats["payments_today"]
+    new_users_today = stats["new_users_today"]
     
     # Формируем сообщение
     text = "📊 <b>Статистика</b>\n\n"
@@ -100,14 +88,64 @@ async def stats_callback(callback: types.CallbackQuery):
     await safe_edit_text(callback.message, text, reply_markup=stats_keyboard())
 
 
+# Порядок и подписи этапов покупки в сводке
+PURCHASE_STAGE_LABELS = [
+    (TraceStages.SERVER_SELECTION, "Выбор сервера"),
+    (TraceStages.YOOKASSA_CREATE, "Создание платежа YooKassa"),
+    (TraceStages.PAYMENT_SAVE, "Сохранение платежа"),
+    (TraceStages.PAYMENT_WAIT, "Ожидание оплаты"),
+    (TraceStages.POLL_LAG, "Задержка обнаружения оплаты"),
+    (TraceStages.YOOKASSA_STATUS, "Запрос статуса YooKassa"),
+    (TraceStages.X3UI_LOGIN, "Вход в панель 3x-ui"),
+    (TraceStages.X3UI_PROVISION, "Создание клиентов 3x-ui"),
+    (TraceStages.X3UI_KEYS, "Получение ключей 3x-ui"),
+    (TraceStages.SUBSCRIPTION_SAVE, "Сохранение подписки"),
+    (TraceStages.KEY_DELIVERY, "Отправка ключа"),
+    (TraceStages.TOTAL, "Всего: от кнопки до ключа"),
+]
+
+
+def format_duration_ms(duration_ms: float) -> str:
+    """Форматировать длительность в мс для отображения"""
+    if duration_ms >= 60000:
+        return f"{duration_ms / 60000:.1f} мин"
+    if duration_ms >= 1000:
+        return f"{duration_ms / 1000:.1f} с"
+    return f"{duration_ms:.0f} мс"
+
+
+# Скорость покупки по этапам
+@router.callback_query(F.data == "admin_purchase_latency", AdminFilter())
+async def purchase_latency_callback(callback: types.CallbackQuery):
+    await callback.answer()
+    
+    summary = await get_stage_summary()
+    
+    text = "⏱️ <b>Скорость покупки по этапам</b>\n"
+    text += "<i>p50 / p95 по последним покупкам</i>\n\n"
+    
+    if not summary:
+        text += "Пока нет данных. Они появятся после первых покупок."
+    else:
+        for stage, label in PURCHASE_STAGE_LABELS:
+            stats = summary.get(stage)
+            if not stats:
+                continue
+            text += (
+                f"• {label}: <b>{format_duration_ms(stats['p50'])}</b> / "
+                f"{format_duration_ms(stats['p95'])} (n={stats['count']})\n"
+            )
+    
+    await safe_edit_text(callback.message, text, reply_markup=purchase_latency_keyboard())
+
+
 # Массовая рассылка
 @router.callback_query(F.data == "admin_broadcast", AdminFilter())
 async def broadcast_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     
     # Получаем количество пользователей
-    users = await get_all_users()
-    total_users = len(users)
+    total_users = await get_users_count()
     
     await callback.message.answer(
         f"📢 <b>Массовая рассылка сообщений</b>\n\n"
@@ -127,50 +165,22 @@ async def broadcast_message_received(message: types.Message, state: FSMContext):
     message_text = message.text or message.caption or ""
     message_text = message_text.strip() if message_text else ""
     
-    # Проверяем, есть ли медиа
-    has_media = bool(message.photo or message.video or message.document or 
-                     message.audio or message.voice or message.video_note)
+    # Рассылка копирует исходное сообщение, поэтому подходит любой тип сообщения
+    message_data = build_message_data(message)
     
-    if not message_text and not has_media:
+    if not message_data:
         await message.answer(
-            "❌ Сообщение не может быть пустым. Введите текст сообщения или отправьте медиа с подписью:",
+            "❌ Этот тип сообщения не поддерживается. Отправьте текст, фото, видео или другой медиа-контент:",
             reply_markup=cancel_keyboard()
         )
         return
     
-    # Сохраняем данные сообщения в state
-    message_data = {
-        "text": message_text,
-        "has_media": has_media,
-        "media_type": None,
-        "file_id": None
-    }
-    
-    # Определяем тип медиа и сохраняем file_id
-    if message.photo:
-        message_data["media_type"] = "photo"
-        message_data["file_id"] = message.photo[-1].file_id
-    elif message.video:
-        message_data["media_type"] = "video"
-        message_data["file_id"] = message.video.file_id
-    elif message.document:
-        message_data["media_type"] = "document"
-        message_data["file_id"] = message.document.file_id
-    elif message.audio:
-        message_data["media_type"] = "audio"
-        message_data["file_id"] = message.audio.file_id
-    elif message.voice:
-        message_data["media_type"] = "voice"
-        message_data["file_id"] = message.voice.file_id
-    elif message.video_note:
-        message_data["media_type"] = "video_note"
-        message_data["file_id"] = message.video_note.file_id
+    has_media = message_data["has_media"]
     
     await state.update_data(message_data=message_data)
     
     # Получаем количество пользователей для подтверждения
-    users = await get_all_users()
-    total_users = len(users)
+    total_users = await get_users_count()
     
     # Формируем превью сообщения
     preview_text = "📢 <b>Подтверждение рассылки</b>\n\n"
@@ -183,7 +193,9 @@ async def broadcast_message_received(message: types.Message, state: FSMContext):
             "document": "📄 Документ",
             "audio": "🎵 Аудио",
             "voice": "🎤 Голосовое",
-            "video_note": "📹 Видеосообщение"
+            "video_note": "📹 Видеосообщение",
+            "animation": "🎞️ Анимация",
+            "sticker": "🖼️ Стикер"
         }
         preview_text += f"📎 Тип: {media_type_names.get(message_data['media_type'], 'Медиа')}\n"
     
@@ -225,188 +237,65 @@ async def broadcast_execute(callback: types.CallbackQuery, state: FSMContext):
         await state.clear()
         return
     
-    # Получаем всех пользователей
-    users = await get_all_users()
-    total_users = len(users)
+    total_users = await get_users_count()
     
     if total_users == 0:
         await callback.message.answer("❌ В базе данных нет пользователей для рассылки.")
         await state.clear()
         return
     
-    # Отправляем сообщение о начале рассылки
+    # Отправляем сообщение о начале рассылки (дальше его обновляет сервис рассылки)
     status_msg = await callback.message.answer(
         f"⏳ <b>Начало рассылки...</b>\n\n"
-        f"📊 Отправка сообщений {total_users} пользователям...\n"
-        f"✅ Успешно: 0\n"
-        f"❌ Ошибок: 0",
+        f"📊 Отправка сообщений {total_users} пользователям...",
         parse_mode="HTML"
     )
     
-    # Импортируем bot
-    from core.loader import bot
-    
-    success_count = 0
-    error_count = 0
-    errors_list = []
-    
-    message_text = message_data.get("text", "")
-    has_media = message_data.get("has_media", False)
-    media_type = message_data.get("media_type")
-    file_id = message_data.get("file_id")
-    
-    # Формируем текст сообщения для пользователей
-    user_message_text = f"📨 <b>Сообщение от администратора</b>\n\n{message_text}" if message_text else "📨 <b>Сообщение от администратора</b>"
-    
-    # Отправляем сообщения каждому пользователю
-    for i, user in enumerate(users, 1):
-        try:
-            if has_media:
-                # Отправляем медиа с подписью
-                caption = user_message_text if message_text else "📨 <b>Сообщение от администратора</b>"
-                
-                if media_type == "photo":
-                    await bot.send_photo(
-                        chat_id=int(user.tg_id),
-                        photo=file_id,
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif media_type == "video":
-                    await bot.send_video(
-                        chat_id=int(user.tg_id),
-                        video=file_id,
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif media_type == "document":
-                    await bot.send_document(
-                        chat_id=int(user.tg_id),
-                        document=file_id,
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif media_type == "audio":
-                    await bot.send_audio(
-                        chat_id=int(user.tg_id),
-                        audio=file_id,
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif media_type == "voice":
-                    # Для voice отправляем отдельно, так как у него нет caption
-                    await bot.send_voice(
-                        chat_id=int(user.tg_id),
-                        voice=file_id
-                    )
-                    if message_text:
-                        await bot.send_message(
-                            chat_id=int(user.tg_id),
-                            text=user_message_text,
-                            parse_mode="HTML"
-                        )
-                    else:
-                        await bot.send_message(
-                            chat_id=int(user.tg_id),
-                            text="📨 <b>Сообщение от администратора</b>",
-                            parse_mode="HTML"
-                        )
-                elif media_type == "video_note":
-                    # Для video_note отправляем отдельно, так как у него нет caption
-                    await bot.send_video_note(
-                        chat_id=int(user.tg_id),
-                        video_note=file_id
-                    )
-                    if message_text:
-                        await bot.send_message(
-                            chat_id=int(user.tg_id),
-                            text=user_message_text,
-                            parse_mode="HTML"
-                        )
-                    else:
-                        await bot.send_message(
-                            chat_id=int(user.tg_id),
-                            text="📨 <b>Сообщение от администратора</b>",
-                            parse_mode="HTML"
-                        )
-            else:
-                # Отправляем только текстовое сообщение
-                await bot.send_message(
-                    chat_id=int(user.tg_id),
-                    text=user_message_text,
-                    parse_mode="HTML"
-                )
-            
-            success_count += 1
-            
-            # Обновляем статус каждые 10 сообщений или в конце
-            if i % 10 == 0 or i == total_users:
-                try:
-                    await status_msg.edit_text(
-                        f"⏳ <b>Рассылка в процессе...</b>\n\n"
-                        f"📊 Отправка сообщений {total_users} пользователям...\n"
-                        f"📈 Прогресс: {i}/{total_users} ({i * 100 // total_users}%)\n"
-                        f"✅ Успешно: {success_count}\n"
-                        f"❌ Ошибок: {error_count}",
-                        parse_mode="HTML"
-                    )
-                except:
-                    pass  # Игнорируем ошибки редактирования статуса
-            
-            # Небольшая задержка, чтобы не превышать лимиты Telegram API
-            if i % 30 == 0:  # Задержка каждые 30 сообщений
-                import asyncio
-                await asyncio.sleep(1)
-                
-        except Exception as e:
-            error_count += 1
-            error_msg = str(e)
-            
-            # Короткое логирование ошибки
-            username = user.username or f"ID: {user.tg_id}"
-            if len(errors_list) < 5:  # Сохраняем только первые 5 ошибок
-                errors_list.append(f"@{username}: {error_msg[:50]}")
-            
-            # Обновляем статус при ошибках тоже
-            if error_count % 10 == 0 or i == total_users:
-                try:
-                    await status_msg.edit_text(
-                        f"⏳ <b>Рассылка в процессе...</b>\n\n"
-                        f"📊 Отправка сообщений {total_users} пользователям...\n"
-                        f"📈 Прогресс: {i}/{total_users} ({i * 100 // total_users}%)\n"
-                        f"✅ Успешно: {success_count}\n"
-                        f"❌ Ошибок: {error_count}",
-                        parse_mode="HTML"
-                    )
-                except:
-                    pass
-    
-    # Финальное сообщение о результатах
-    result_text = f"✅ <b>Рассылка завершена!</b>\n\n"
-    result_text += f"👥 Всего пользователей: {total_users}\n"
-    result_text += f"✅ Успешно отправлено: <b>{success_count}</b>\n"
-    result_text += f"❌ Ошибок: <b>{error_count}</b>\n"
-    
-    if errors_list:
-        result_text += f"\n<b>Примеры ошибок:</b>\n"
-        for error in errors_list:
-            result_text += f"• {html.escape(error)}\n"
-        if error_count > len(errors_list):
-            result_text += f"... и еще {error_count - len(errors_list)} ошибок\n"
-    
-    await status_msg.edit_text(result_text, parse_mode="HTML")
-    
-    # Возвращаем в админ-меню
-    await callback.message.answer(
-        "🔧 <b>Админ-панель</b>\n\n"
-        "Выберите раздел для управления:",
-        reply_markup=admin_menu(),
-        parse_mode="HTML"
-    )
+    # Рассылка выполняется в фоне и переживает перезапуск бота
+    try:
+        broadcast_id = await create_broadcast(callback.message.chat.id, status_msg.message_id, message_data)
+    except Exception as e:
+        await status_msg.edit_text(f"❌ Не удалось запустить рассылку: {html.escape(str(e))}", parse_mode="HTML")
+        await state.clear()
+        return
+    launch_broadcast(broadcast_id)
     
     await state.clear()
 
 
+async def _change_broadcast_status(callback: types.CallbackQuery, prefix: str, status: str, answer_text: str):
+    """Изменить статус рассылки по нажатию кнопки управления"""
+    broadcast_id = callback.data[len(prefix):]
+    
+    if not await set_broadcast_status(broadcast_id, status):
+        await callback.answer("❌ Рассылка не найдена или уже завершена", show_alert=True)
+        return
+    
+    await callback.answer(answer_text)
+    
+    if status == BroadcastStatus.RUNNING:
+        launch_broadcast(broadcast_id)
+    
+    broadcast = await get_broadcast(broadcast_id)
+    if broadcast:
+        await update_status_message(broadcast)
+
+
+@router.callback_query(F.data.startswith("broadcast_pause_"), AdminFilter())
+async def broadcast_pause(callback: types.CallbackQuery):
+    await _change_broadcast_status(callback, "broadcast_pause_", BroadcastStatus.PAUSED, "⏸️ Рассылка приостановлена")
+
+
+@router.callback_query(F.data.startswith("broadcast_resume_"), AdminFilter())
+async def broadcast_resume(callback: types.CallbackQuery):
+    await _change_broadcast_status(callback, "broadcast_resume_", BroadcastStatus.RUNNING, "▶️ Рассылка продолжена")
+
+
+@router.callback_query(F.data.startswith("broadcast_stop_"), AdminFilter())
+async def broadcast_stop(callback: types.CallbackQuery):
+    await _change_broadcast_status(callback, "broadcast_stop_", BroadcastStatus.CANCELLED, "❌ Рассылка отменена")
+
+
 @router.callback_query(F.data == "broadcast_cancel", BroadcastStates.waiting_confirm, AdminFilter())
 async def broadcast_cancel_confirm(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
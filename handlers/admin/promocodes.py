@@ -150,7 +150,7 @@ async def promocode_add_code(message: types.Message, state: FSMContext):
     
     # Проверяем, существует ли уже такой промокод
     from utils.db import get_promo_code_by_code
-    existing = await get_promo_code_by_code(code)
+    existing = await get_promo_code_by_code(code, use_cache=False)
     if existing:
         await message.answer("❌ Промокод с таким кодом уже существует. Введите другой код:")
         return
@@ -323,7 +323,7 @@ async def promocode_edit_code(message: types.Message, state: FSMContext):
     
     # Проверяем, существует ли уже такой промокод (кроме текущего)
     from utils.db import get_promo_code_by_code
-    existing = await get_promo_code_by_code(code)
+    existing = await get_promo_code_by_code(code, use_cache=False)
     data = await state.get_data()
     if existing and existing.id != data["promocode_id"]:
         await message.answer("❌ Промокод с таким кодом уже существует. Введите другой код:", reply_markup=cancel_keyboard())
@@ -28,6 +28,7 @@ from utils.db import (
     get_users_with_subscriptions_by_server,
     get_subscriptions_by_server
 )
+from services.broadcast import build_message_data, launch_server_notification
 
 router = Router()
 
@@ -1156,7 +1157,6 @@ async def server_notify_users_send(message: types.Message, state: FSMContext):
     """Отправка уведомлений пользователям"""
     data = await state.get_data()
     server_id = data.get("server_id")
-    users_count = data.get("users_count", 0)
     
     if not server_id:
         await message.answer("❌ Ошибка: сервер не найден", reply_markup=servers_menu())
@@ -1169,12 +1169,12 @@ async def server_notify_users_send(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
-    if not message.text:
-        await message.answer("❌ Пожалуйста, отправьте текстовое сообщение для уведомления:", reply_markup=cancel_keyboard())
+    # Уведомление копирует исходное сообщение, поэтому можно отправить текст или медиа с подписью
+    message_data = build_message_data(message)
+    if not message_data:
+        await message.answer("❌ Пожалуйста, отправьте текст или медиа с подписью для уведомления:", reply_markup=cancel_keyboard())
         return
     
-    notification_text = message.text
-    
     # Получаем всех пользователей с подписками на этом сервере
     users = await get_users_with_subscriptions_by_server(server_id)
     
@@ -1183,39 +1183,20 @@ async def server_notify_users_send(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
-    # Формируем сообщение для пользователей
+    # Формируем заголовок сообщения для пользователей
     location_name = server.location.name if server.location else "локации"
-    user_message = f"🔔 <b>Уведомление о локации {html.escape(location_name)}</b>\n\n"
-    user_message += f"{notification_text}"
-    
-    # Отправляем сообщения пользователям
-    from core.loader import bot
-    sent_count = 0
-    failed_count = 0
-    
-    await message.answer(f"📤 Отправка уведомлений {users_count} пользователям...")
-    
-    for user in users:
-        try:
-            await bot.send_message(
-                chat_id=int(user.tg_id),
-                text=user_message,
-                parse_mode="HTML"
-            )
-            sent_count += 1
-        except Exception as e:
-            logger.error(f"❌ Ошибка при отправке уведомления пользователю {user.tg_id}: {e}")
-            failed_count += 1
-    
-    # Отправляем отчет администратору
-    result_text = f"✅ <b>Уведомления отправлены</b>\n\n"
-    result_text += f"Сервер: <b>{html.escape(server.name)}</b>\n"
-    result_text += f"Всего пользователей: <b>{users_count}</b>\n"
-    result_text += f"✅ Отправлено: <b>{sent_count}</b>\n"
-    if failed_count > 0:
-        result_text += f"❌ Ошибок: <b>{failed_count}</b>\n"
-    
-    await message.answer(result_text, reply_markup=servers_menu())
+    header = f"🔔 <b>Уведомление о локации {html.escape(location_name)}</b>"
+    
+    # Отправка идет в фоне через общую очередь (один вызов на пользователя): обработчик
+    # не ждет доставки всем получателям, отчет придет отдельным сообщением
+    launch_server_notification(
+        admin_chat_id=message.chat.id,
+        server_name=server.name,
+        recipients=[int(user.tg_id) for user in users],
+        message_data=message_data,
+        header=header
+    )
+    await message.answer(f"📤 Отправка уведомлений {len(users)} пользователям запущена, отчет придет после завершения.")
     await state.clear()
     
     # Возвращаемся к меню редактирования сервера
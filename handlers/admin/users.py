@@ -8,13 +8,16 @@ from utils.keyboards.admin_kb import (
     admin_menu,
     users_menu,
     user_list_keyboard,
+    user_search_results_keyboard,
     user_detail_keyboard,
     cancel_keyboard,
     confirm_delete_all_subscriptions_keyboard
 )
 import html
 from utils.db import (
-    get_all_users,
+    get_users_page,
+    get_users_count,
+    search_users,
     get_user_by_id,
     update_user,
     set_admin,
@@ -24,14 +27,11 @@ from utils.db import (
     get_subscription_by_id,
     update_subscription,
     get_subscription_identifier,
-    get_user_by_tg_id,
     get_tariff_by_id
 )
 from services.x3ui_api import get_x3ui_client
 from services.subscription import delete_all_user_subscriptions_completely
-from database.base import async_session
-from database.models import User
-from sqlalchemy import select, or_
+from sqlalchemy import select
 
 router = Router()
 
@@ -81,11 +81,24 @@ async def user_list_callback(callback: types.CallbackQuery):
     await show_users_page(callback.message, page=0)
 
 
-async def show_users_page(message: types.Message, page: int = 0):
-    """Показать страницу списка пользователей"""
-    users = await get_all_users()
+async def show_users_page(message: types.Message, page: int = 0, after_id: int = None, before_id: int = None):
+    """
+    Показать страницу списка пользователей
+    
+    Страницы листаются по ID пользователя (курсор в callback_data), поэтому
+    каждая страница - один запрос с LIMIT, а общее количество берется из кэша.
+    """
+    page_users, has_prev, has_next = await get_users_page(
+        after_id=after_id,
+        before_id=before_id,
+        limit=USERS_PER_PAGE
+    )
     
-    if not users:
+    if not page_users:
+        if after_id is not None or before_id is not None:
+            # Пользователи страницы были удалены - начинаем с первой страницы
+            await show_users_page(message, page=0)
+            return
         await safe_edit_text(
             message,
             "👥 <b>Список пользователей</b>\n\n"
@@ -94,17 +107,10 @@ async def show_users_page(message: types.Message, page: int = 0):
         )
         return
     
-    total_users = len(users)
-    total_pages = (total_users + USERS_PER_PAGE - 1) // USERS_PER_PAGE
-    
-    if page < 0:
+    if not has_prev:
         page = 0
-    if page >= total_pages:
-        page = total_pages - 1
-    
-    start_idx = page * USERS_PER_PAGE
-    end_idx = start_idx + USERS_PER_PAGE
-    page_users = users[start_idx:end_idx]
+    total_users = await get_users_count(use_cache=True)
+    total_pages = max((total_users + USERS_PER_PAGE - 1) // USERS_PER_PAGE, page + 1)
     
     text = f"👥 <b>Список пользователей</b>\n\n"
     text += f"Всего пользователей: {total_users}\n"
@@ -125,16 +131,19 @@ async def show_users_page(message: types.Message, page: int = 0):
     await safe_edit_text(
         message,
         text,
-        reply_markup=user_list_keyboard(page_users, page, total_pages)
+        reply_markup=user_list_keyboard(page_users, page, has_prev, has_next)
     )
 
 
-# Обработчик пагинации
-@router.callback_query(F.data.startswith("admin_users_page_"), AdminFilter())
+# Обработчик пагинации: admin_users_next_{страница}_{ID последнего} / admin_users_prev_{страница}_{ID первого}
+@router.callback_query(or_f(F.data.startswith("admin_users_next_"), F.data.startswith("admin_users_prev_")), AdminFilter())
 async def users_page_callback(callback: types.CallbackQuery):
     await callback.answer()
-    page = int(callback.data.split("_")[-1])
-    await show_users_page(callback.message, page)
+    direction, page, cursor_id = callback.data.split("_")[-3:]
+    if direction == "next":
+        await show_users_page(callback.message, int(page), after_id=int(cursor_id))
+    else:
+        await show_users_page(callback.message, int(page), before_id=int(cursor_id))
 
 
 # Поиск пользователя
@@ -144,7 +153,8 @@ async def user_search_start(callback: types.CallbackQuery, state: FSMContext):
     await safe_edit_text(
         callback.message,
         "🔍 <b>Поиск пользователя</b>\n\n"
-        "Введите ID пользователя (число) или username (без @):",
+        "Введите ID, Telegram ID (или его начало), username, email или SubId.\n"
+        "Регистр не важен, можно ввести часть строки или username с опечаткой:",
         reply_markup=cancel_keyboard()
     )
     await state.set_state(SearchUserStates.waiting_query)
@@ -152,56 +162,82 @@ async def user_search_start(callback: types.CallbackQuery, state: FSMContext):
 
 @router.message(SearchUserStates.waiting_query, AdminFilter())
 async def user_search_process(message: types.Message, state: FSMContext):
-    query = message.text.strip()
+    query = (message.text or "").strip()
     
     if not query:
-        await message.answer("❌ Введите ID или username пользователя:")
+        await message.answer("❌ Введите строку поиска:")
         return
     
-    user = None
-    
-    # Пробуем найти по ID (число)
-    try:
-        user_id = int(query)
-        user = await get_user_by_id(user_id)
-    except ValueError:
-        pass
-    
-    # Если не нашли по ID, ищем по username
-    if not user:
-        username = query.lstrip('@')
-        async with async_session() as session:
-            result = await session.execute(
-                select(User).where(User.username == username)
-            )
-            user = result.scalar_one_or_none()
-    
-    # Если не нашли по username, пробуем по tg_id
-    if not user:
-        try:
-            user = await get_user_by_tg_id(query)
-        except:
-            pass
+    users, has_next = await search_users(query, limit=USERS_PER_PAGE)
     
-    if not user:
+    if not users:
         await message.answer(
             f"❌ Пользователь не найден по запросу: {html.escape(query)}\n\n"
-            "Попробуйте ввести ID или username:",
+            "Попробуйте ввести другой запрос:",
             reply_markup=cancel_keyboard()
         )
         return
     
-    await state.clear()
-    # Сразу показываем профиль пользователя для редактирования
-    text = await format_user_details_text(user)
-    subscriptions = await get_user_subscriptions(user.id)
+    if len(users) == 1 and not has_next:
+        await state.clear()
+        # Единственный результат - сразу показываем профиль пользователя для редактирования
+        user = users[0]
+        text = await format_user_details_text(user)
+        subscriptions = await get_user_subscriptions(user.id)
+        await message.answer(
+            text,
+            reply_markup=user_detail_keyboard(user.id, user.is_admin, subscriptions),
+            parse_mode="HTML"
+        )
+        return
+    
+    # Строку поиска сохраняем для пагинации (в callback_data она может не поместиться)
+    await state.set_state(None)
+    await state.update_data(user_search_query=query)
     await message.answer(
-        text,
-        reply_markup=user_detail_keyboard(user.id, user.is_admin, subscriptions),
+        format_user_search_text(query, users, page=0),
+        reply_markup=user_search_results_keyboard(users, page=0, has_next=has_next),
         parse_mode="HTML"
     )
 
 
+@router.callback_query(F.data.startswith("admin_user_search_page_"), AdminFilter())
+async def user_search_page_callback(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    query = (await state.get_data()).get("user_search_query")
+    if not query:
+        await user_search_start(callback, state)
+        return
+    
+    page = int(callback.data.split("_")[-1])
+    users, has_next = await search_users(query, offset=page * USERS_PER_PAGE, limit=USERS_PER_PAGE)
+    if not users and page > 0:
+        page = 0
+        users, has_next = await search_users(query, limit=USERS_PER_PAGE)
+    
+    await safe_edit_text(
+        callback.message,
+        format_user_search_text(query, users, page),
+        reply_markup=user_search_results_keyboard(users, page=page, has_next=has_next)
+    )
+
+
+def format_user_search_text(query: str, users: list, page: int) -> str:
+    """Форматировать текст страницы результатов поиска"""
+    text = f"🔍 <b>Результаты поиска:</b> {html.escape(query)}\n"
+    text += f"Страница {page + 1}\n\n"
+    
+    for user in users:
+        username = user.username or "не указан"
+        text += f"<b>@{html.escape(username)}</b>\n"
+        text += f"   ID: {user.id} | TG: {user.tg_id}\n"
+        if user.email:
+            text += f"   📧 {html.escape(user.email)}\n"
+        text += "\n"
+    
+    return text
+
+
 # Вспомогательная функция для форматирования текста деталей пользователя
 async def format_user_details_text(user):
     """Форматировать текст деталей пользователя"""
@@ -308,14 +344,14 @@ async def subscription_view_callback(callback: types.CallbackQuery):
     }.get(subscription.status, "Неизвестно")
     
     from datetime import datetime
-    from utils.db import utc_to_moscow
+    from utils.db import utc_to_user_timezone
     
     text = f"📦 <b>Подписка {subscription_id_display}</b>\n\n"
     text += f"🌍 Локация: {location_name}\n"
     text += f"Статус: {status_emoji} {status_text}\n"
     
     if subscription.expire_date:
-        expire_date_local = utc_to_moscow(subscription.expire_date) if isinstance(subscription.expire_date, datetime) else subscription.expire_date
+        expire_date_local = utc_to_user_timezone(subscription.expire_date, language_code=callback.from_user.language_code) if isinstance(subscription.expire_date, datetime) else subscription.expire_date
         expire_str = expire_date_local.strftime("%d.%m.%Y в %H:%M") if isinstance(expire_date_local, datetime) else str(expire_date_local)
         text += f"📅 Окончание: {expire_str}\n"
     
@@ -434,14 +470,14 @@ async def subscription_extend_callback(callback: types.CallbackQuery):
             status_emoji = "✅"
             status_text = "Активна"
             
-            from utils.db import utc_to_moscow
+            from utils.db import utc_to_user_timezone
             
             text = f"📦 <b>Подписка {subscription_id_display}</b>\n\n"
             text += f"🌍 Локация: {location_name}\n"
             text += f"Статус: {status_emoji} {status_text}\n"
             
             if subscription.expire_date:
-                expire_date_local = utc_to_moscow(subscription.expire_date) if isinstance(subscription.expire_date, datetime) else subscription.expire_date
+                expire_date_local = utc_to_user_timezone(subscription.expire_date, language_code=callback.from_user.language_code) if isinstance(subscription.expire_date, datetime) else subscription.expire_date
                 expire_str = expire_date_local.strftime("%d.%m.%Y в %H:%M") if isinstance(expire_date_local, datetime) else str(expire_date_local)
                 text += f"📅 Окончание: {expire_str}\n"
             
@@ -522,14 +558,14 @@ async def subscription_pause_callback(callback: types.CallbackQuery):
                 status_text = "Приостановлена"
                 
                 from datetime import datetime
-                from utils.db import utc_to_moscow
+                from utils.db import utc_to_user_timezone
                 
                 text = f"📦 <b>Подписка {subscription_id_display}</b>\n\n"
                 text += f"🌍 Локация: {location_name}\n"
                 text += f"Статус: {status_emoji} {status_text}\n"
                 
                 if subscription.expire_date:
-                    expire_date_local = utc_to_moscow(subscription.expire_date) if isinstance(subscription.expire_date, datetime) else subscription.expire_date
+                    expire_date_local = utc_to_user_timezone(subscription.expire_date, language_code=callback.from_user.language_code) if isinstance(subscription.expire_date, datetime) else subscription.expire_date
                     expire_str = expire_date_local.strftime("%d.%m.%Y в %H:%M") if isinstance(expire_date_local, datetime) else str(expire_date_local)
                     text += f"📅 Окончание: {expire_str}\n"
                 
@@ -754,7 +790,6 @@ async def create_subscription_location_selected(callback: types.CallbackQuery, s
     # Получаем первый доступный тариф (или стандартный тариф локации)
     from database.models import Tariff
     from database.base import async_session
-    from sqlalchemy import select
     
     async with async_session() as session:
         result = await session.execute(select(Tariff).order_by(Tariff.id).limit(1))
@@ -936,7 +971,7 @@ async def create_subscription_location_selected(callback: types.CallbackQuery, s
         # Отправляем уведомление пользователю
         try:
             from core.loader import bot
-            from utils.db import utc_to_moscow
+            from utils.db import utc_to_user_timezone
             from datetime import datetime
             
             subscription_id_display = get_subscription_identifier(subscription, location.name)
@@ -951,7 +986,7 @@ async def create_subscription_location_selected(callback: types.CallbackQuery, s
             
             # Время действия
             if subscription.expire_date:
-                expire_date_local = utc_to_moscow(subscription.expire_date) if isinstance(subscription.expire_date, datetime) else subscription.expire_date
+                expire_date_local = utc_to_user_timezone(subscription.expire_date, user=user) if isinstance(subscription.expire_date, datetime) else subscription.expire_date
                 expire_str = expire_date_local.strftime("%d.%m.%Y в %H:%M") if isinstance(expire_date_local, datetime) else str(expire_date_local)
                 user_message += f"📅 <b>Окончание подписки:</b> {expire_str}\n"
             
@@ -9,19 +9,23 @@ from utils.logger import logger
 from utils.db import (
     get_user_by_tg_id,
     get_server_by_id,
-    get_location_by_id,
-    get_tariff_by_id,
+    get_catalog_location,
+    get_catalog_server,
     create_payment,
     update_payment_status,
     create_subscription,
     get_payment_by_yookassa_id,
     select_available_server_for_location,
+    reserve_server_for_location,
+    release_server_reservation,
     update_server_current_users,
     has_user_made_purchase,
     mark_user_used_discount,
     get_promo_code_by_code,
     can_use_promo_code,
     use_promo_code,
+    set_promo_code_usage_payment,
+    release_promo_code_usage,
     get_subscription_identifier,
     utc_to_user_timezone,
     update_user_email
@@ -29,7 +33,10 @@ from utils.db import (
 from aiogram.fsm.state import State, StatesGroup
 from core.config import config
 from services.yookassa_service import yookassa_service
+from utils import tracing
+from utils.tracing import span, TraceStages
 from datetime import datetime, timedelta
+import time
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 # asyncio больше не нужен для проверки платежей - используется APScheduler
 
@@ -87,12 +94,15 @@ class EmailStates(StatesGroup):
     waiting_email = State()
 
 
-@router.callback_query(F.data.startswith("buy_location_"))
+@router.callback_query(F.data.startswith("buy_location_"), flags={"throttling_key": "heavy"})
 async def select_location_for_payment(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик выбора локации для покупки - сразу создает платеж и перекидывает на страницу оплаты"""
     # Не вызываем callback.answer() здесь, так как для новых пользователей будем использовать callback.answer(url=...)
+    # Трассировка покупки начинается с нажатия кнопки оплаты
+    purchase_started_at = time.time()
+    tracing.start_trace()
     location_id = int(callback.data.split("_")[-1])
-    location = await get_location_by_id(location_id)
+    location = await get_catalog_location(location_id)
     
     if not location or not location.is_active:
         try:
@@ -175,6 +185,16 @@ async def select_location_for_payment(callback: types.CallbackQuery, state: FSMC
         await state.update_data(payment_message_id=new_message.message_id)
         return
     
+    # Новый пользователь сразу переходит к оплате - занимаем место на сервере
+    available_server = await reserve_server_for_location(location_id, str(callback.from_user.id))
+    if not available_server:
+        await callback.message.answer(
+            "❌ К сожалению, все серверы в этой локации переполнены.\n"
+            "Попробуйте выбрать другую локацию или попробуйте позже.",
+            reply_markup=main_menu()
+        )
+        return
+    
     # Для новых пользователей проверяем email перед созданием платежа
     # Проверяем наличие email в БД
     if not user.email or not validate_email(user.email):
@@ -270,6 +290,9 @@ async def select_location_for_payment(callback: types.CallbackQuery, state: FSMC
             currency="RUB"
         )
         
+        # Сохраняем этапы до перехода к оплате и отметки для расчета ожидания оплаты
+        await tracing.start_payment_trace(payment.id, purchase_started_at)
+        
         # Сохраняем payment_id в state
         await state.update_data(
             payment_id=payment.id,
@@ -366,9 +389,12 @@ async def enter_promo_code_handler(callback: types.CallbackQuery, state: FSMCont
     await state.set_state(PromoCodeStates.waiting_promo_code)
 
 
-@router.message(PromoCodeStates.waiting_promo_code)
+@router.message(PromoCodeStates.waiting_promo_code, flags={"throttling_key": "panel"})
 async def process_promo_code(message: types.Message, state: FSMContext):
     """Обработка введенного промокода"""
+    # Трассировка покупки начинается с нажатия кнопки оплаты
+    purchase_started_at = time.time()
+    tracing.start_trace()
     promo_code_text = message.text.strip().upper()
     
     # Получаем данные из state
@@ -380,7 +406,7 @@ async def process_promo_code(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
-    location = await get_location_by_id(location_id)
+    location = await get_catalog_location(location_id)
     if not location or not location.is_active:
         await message.answer("❌ Локация не найдена или неактивна", reply_markup=main_menu())
         await state.clear()
@@ -436,8 +462,8 @@ async def process_promo_code(message: types.Message, state: FSMContext):
     except:
         pass
     
-    # Автоматически выбираем доступный сервер из локации
-    server = await select_available_server_for_location(location_id)
+    # Автоматически выбираем доступный сервер из локации и занимаем на нем место до оплаты
+    server = await reserve_server_for_location(location_id, str(message.from_user.id))
     if not server:
         await message.answer(
             "❌ К сожалению, все серверы в этой локации переполнены.\n"
@@ -462,6 +488,18 @@ async def process_promo_code(message: types.Message, state: FSMContext):
         await check_and_request_email(user, message, state, action_data)
         return
     
+    # Используем промокод до создания платежа со скидкой (лимит проверяется атомарно)
+    promo_usage = await use_promo_code(promo_code.id, user.id)
+    if not promo_usage:
+        await release_server_reservation(str(message.from_user.id))
+        await message.answer(
+            PROMO_CODE_REJECTED_TEXT,
+            reply_markup=main_menu(),
+            parse_mode="HTML"
+        )
+        await state.set_state(None)
+        return
+    
     # Сразу создаем платеж после применения промокода
     try:
         # Формируем описание платежа
@@ -519,6 +557,8 @@ async def process_promo_code(message: types.Message, state: FSMContext):
                 user_error_message += f"Произошла ошибка: {error_message}\n\n"
                 user_error_message += "Пожалуйста, попробуйте позже или свяжитесь с поддержкой."
             
+            # Платеж не создан - возвращаем использование промокода
+            await release_promo_code_usage(promo_usage.id)
             await message.answer(
                 user_error_message,
                 reply_markup=main_menu(),
@@ -536,8 +576,11 @@ async def process_promo_code(message: types.Message, state: FSMContext):
             currency="RUB"
         )
         
-        # Если использован промокод, отмечаем его использование
-        await use_promo_code(promo_code.id, user.id, payment.id)
+        # Сохраняем этапы до перехода к оплате и отметки для расчета ожидания оплаты
+        await tracing.start_payment_trace(payment.id, purchase_started_at)
+        
+        # Привязываем использование промокода к платежу
+        await set_promo_code_usage_payment(promo_usage.id, payment.id)
         
         # Сохраняем payment_id в state
         await state.update_data(
@@ -587,6 +630,13 @@ async def process_promo_code(message: types.Message, state: FSMContext):
         await state.set_state(None)
 
 
+PROMO_CODE_REJECTED_TEXT = (
+    "❌ <b>Промокод больше не действует</b>\n\n"
+    "Лимит использований исчерпан, промокод отключен или вы уже использовали его.\n"
+    "Выберите локацию еще раз, чтобы оплатить без промокода."
+)
+
+
 def cancel_keyboard():
     """Клавиатура отмены ввода промокода"""
     kb = InlineKeyboardBuilder()
@@ -609,13 +659,17 @@ async def continue_payment_after_email(
     """Продолжает создание платежа после ввода email"""
     from services.payment_checker import start_payment_check
     
+    # Трассировка покупки начинается с нажатия кнопки оплаты
+    purchase_started_at = time.time()
+    tracing.start_trace()
+    
     # Получаем дополнительные данные из state (для продления подписки)
     state_data = await state.get_data()
     is_renewal = state_data.get("is_renewal", False)
     subscription_id = state_data.get("subscription_id")
     server_id = state_data.get("server_id")
     
-    location = await get_location_by_id(location_id)
+    location = await get_catalog_location(location_id)
     if not location:
         if isinstance(message_or_callback, types.CallbackQuery):
             await message_or_callback.message.answer("❌ Локация не найдена", reply_markup=main_menu())
@@ -626,9 +680,9 @@ async def continue_payment_after_email(
     
     # Для продления используем существующий сервер, для новой покупки - выбираем доступный
     if is_renewal and server_id:
-        available_server = await get_server_by_id(server_id)
+        available_server = await get_catalog_server(server_id)
     else:
-        available_server = await select_available_server_for_location(location_id)
+        available_server = await reserve_server_for_location(location_id, str(message_or_callback.from_user.id))
     
     if not available_server:
         if isinstance(message_or_callback, types.CallbackQuery):
@@ -644,6 +698,21 @@ async def continue_payment_after_email(
         await state.clear()
         return
     
+    # Используем промокод до создания платежа со скидкой (лимит проверяется атомарно)
+    promo_usage = None
+    if discount_applied and promo_code_id:
+        promo_usage = await use_promo_code(promo_code_id, user.id)
+        if not promo_usage:
+            if not is_renewal:
+                await release_server_reservation(str(user.tg_id))
+            if isinstance(message_or_callback, types.CallbackQuery):
+                await message_or_callback.message.answer(PROMO_CODE_REJECTED_TEXT, reply_markup=main_menu(), parse_mode="HTML")
+            else:
+                await message_or_callback.answer(PROMO_CODE_REJECTED_TEXT, reply_markup=main_menu(), parse_mode="HTML")
+            await state.clear()
+            return
+    
+    payment = None
     try:
         # Пересчитываем цену на основе текущего TEST_MODE, а не используем сохраненное значение
         # Получаем реальную цену локации и пересчитываем с учетом скидок
@@ -698,6 +767,13 @@ async def continue_payment_after_email(
             currency="RUB"
         )
         
+        # Привязываем использование промокода к платежу
+        if promo_usage:
+            await set_promo_code_usage_payment(promo_usage.id, payment.id)
+        
+        # Сохраняем этапы до перехода к оплате и отметки для расчета ожидания оплаты
+        await tracing.start_payment_trace(payment.id, purchase_started_at)
+        
         # Сохраняем payment_id в state
         await state.update_data(
             payment_id=payment.id,
@@ -750,6 +826,9 @@ async def continue_payment_after_email(
         )
         
     except Exception as e:
+        # Платеж не создан - возвращаем использование промокода
+        if promo_usage and payment is None:
+            await release_promo_code_usage(promo_usage.id)
         error_message = str(e)
         user_error_message = "❌ <b>Ошибка при создании платежа</b>\n\n"
         user_error_message += f"Произошла ошибка: {error_message}\n\n"
@@ -800,24 +879,29 @@ async def check_and_request_email(user, message_or_callback, state: FSMContext,
     return False
 
 
-@router.callback_query(F.data.startswith("pay_location_"))
+@router.callback_query(F.data.startswith("pay_location_"), flags={"throttling_key": "panel"})
 async def create_payment_handler(callback: types.CallbackQuery, state: FSMContext):
     """Создание платежа через YooKassa - сразу перекидывает на страницу оплаты"""
     # Не вызываем callback.answer() здесь, так как будем использовать callback.answer(url=...)
     location_id = int(callback.data.split("_")[-1])
     
+    # Трассировка покупки начинается с нажатия кнопки оплаты
+    purchase_started_at = time.time()
+    tracing.start_trace()
+    
     user = await get_user_by_tg_id(str(callback.from_user.id))
     if not user:
         await callback.message.answer("❌ Пользователь не найден. Используйте /start", reply_markup=main_menu())
         return
     
-    location = await get_location_by_id(location_id)
+    location = await get_catalog_location(location_id)
     if not location or not location.is_active:
         await callback.message.answer("❌ Локация не найдена или неактивна", reply_markup=main_menu())
         return
     
-    # Автоматически выбираем доступный сервер из локации
-    server = await select_available_server_for_location(location_id)
+    # Автоматически выбираем доступный сервер из локации и занимаем на нем место до оплаты
+    with span(TraceStages.SERVER_SELECTION):
+        server = await reserve_server_for_location(location_id, str(callback.from_user.id))
     if not server:
         await callback.message.answer(
             "❌ К сожалению, все серверы в этой локации переполнены.\n"
@@ -863,6 +947,20 @@ async def create_payment_handler(callback: types.CallbackQuery, state: FSMContex
             await check_and_request_email(user, callback, state, action_data)
             return
         
+        # Используем промокод до создания платежа со скидкой (лимит проверяется атомарно)
+        promo_usage = None
+        if promo_code_id:
+            promo_usage = await use_promo_code(promo_code_id, user.id)
+            if not promo_usage:
+                await release_server_reservation(str(callback.from_user.id))
+                await state.update_data(discount_applied=False, promo_code_id=None, promo_code_discount=0.0)
+                await callback.message.answer(
+                    PROMO_CODE_REJECTED_TEXT,
+                    reply_markup=main_menu(),
+                    parse_mode="HTML"
+                )
+                return
+        
         # Удаляем предыдущее сообщение с информацией о локации
         try:
             await callback.message.delete()
@@ -931,6 +1029,10 @@ async def create_payment_handler(callback: types.CallbackQuery, state: FSMContex
                 user_error_message += f"Произошла ошибка: {error_message}\n\n"
                 user_error_message += "Пожалуйста, попробуйте позже или свяжитесь с поддержкой."
             
+            # Платеж не создан - возвращаем использование промокода и место на сервере
+            if promo_usage:
+                await release_promo_code_usage(promo_usage.id)
+            await release_server_reservation(str(callback.from_user.id))
             try:
                 await callback.answer("❌ Ошибка при создании платежа")
             except:
@@ -943,17 +1045,21 @@ async def create_payment_handler(callback: types.CallbackQuery, state: FSMContex
             return
         
         # Сохраняем платеж в БД
-        payment = await create_payment(
-            tg_id=str(callback.from_user.id),
-            amount=final_price,
-            server_id=server.id,
-            yookassa_payment_id=payment_data["id"],
-            currency="RUB"
-        )
+        with span(TraceStages.PAYMENT_SAVE):
+            payment = await create_payment(
+                tg_id=str(callback.from_user.id),
+                amount=final_price,
+                server_id=server.id,
+                yookassa_payment_id=payment_data["id"],
+                currency="RUB"
+            )
         
-        # Если использован промокод, отмечаем его использование
-        if promo_code_id:
-            await use_promo_code(promo_code_id, user.id, payment.id)
+        # Привязываем использование промокода к платежу
+        if promo_usage:
+            await set_promo_code_usage_payment(promo_usage.id, payment.id)
+        
+        # Сохраняем этапы до перехода к оплате и отметки для расчета ожидания оплаты
+        await tracing.start_payment_trace(payment.id, purchase_started_at)
         
         # Сохраняем payment_id в state
         await state.update_data(
@@ -1011,11 +1117,232 @@ async def create_payment_handler(callback: types.CallbackQuery, state: FSMContex
 # Функция check_payment_status удалена - теперь используется APScheduler через services/payment_checker.py
 
 
-async def handle_successful_payment(payment_id: int, user_id: int, server_id: int, message_id: int = None, subscription_id: int = None, is_renewal: bool = False):
+async def _create_x3ui_clients(payment, user, server, tariff, raise_on_provisioning_error: bool = False):
+    """
+    Создать клиентов новой подписки во всех инбаундах панели 3x-ui
+    
+    Returns:
+        (location_name, subscription_sub_id, location_unique_name, x3ui_subscription_link, x3ui_client_email)
+        или None, если создание отложено в очередь повторных попыток
+    """
+    from core.loader import bot
+    
+    payment_id = payment.id
+    user_id = int(user.tg_id)
+    server_id = server.id
+    location_name = server.location.name if server.location else "Неизвестно"
+    subscription_sub_id = None
+    location_unique_name = None
+    x3ui_subscription_link = None
+    x3ui_client_email = None
+    
+    try:
+        from services.x3ui_api import get_x3ui_client
+        import uuid as uuid_lib
+        
+        # Сервер уже получен выше, используем его для API подключения
+        # Создаем клиент 3x-ui API
+        logger.debug(f"Connecting to 3x-ui API: {server.api_url}")
+        x3ui_client = get_x3ui_client(server.api_url, server.api_username, server.api_password, server.ssl_certificate)
+        
+        # Создаем клиента в 3x-ui
+        # Email будет использоваться в формате {username}@{location_unique_name}.gigabridge
+        # Это позволяет одному пользователю иметь несколько подписок на одном сервере
+        
+        # Получаем название локации
+        location_name = server.location.name if server.location else "Неизвестно"
+        
+        # Генерируем уникальный subID для этой подписки (будет использован как seed для детерминированной генерации)
+        import uuid as uuid_lib
+        subscription_sub_id = str(uuid_lib.uuid4())
+        
+        # Генерируем уникальное название локации (будет использовано для email и идентификатора подписки)
+        # Используем subscription_sub_id как seed для детерминированной генерации
+        from utils.db import generate_location_unique_name
+        location_unique_name = generate_location_unique_name(location_name, seed=subscription_sub_id)
+        
+        # Извлекаем уникальный код из location_unique_name (убираем название локации и дефис)
+        # Формат: {location_slug}-{unique_code}, нам нужен только unique_code
+        unique_code = location_unique_name.split('-')[-1] if '-' in location_unique_name else location_unique_name
+        
+        # Подготавливаем username для использования в email
+        if user.username:
+            username = user.username
+        else:
+            username = f"user_{user.tg_id}"
+        
+        # Нормализуем название локации для использования в email (транслитерация в латиницу, lowercase)
+        from utils.db import generate_location_slug
+        location_slug = generate_location_slug(location_name)
+        
+        logger.debug(f"Creating clients in 3x-ui: username={username}, tg_id={user.tg_id}, location={location_name}, sub_id={subscription_sub_id}")
+        
+        # Получаем длительность подписки (для тестирования или обычный режим)
+        days_for_api, duration_timedelta = get_subscription_duration(tariff.duration_days)
+        
+        # Создаем клиентов во всех инбаундах на основе первого клиента каждого инбаунда
+        # Для каждого инбаунда берем первого клиента как шаблон, меняем только уникальные поля
+        # Формат email: {location_name}@{protocol}&{username}&{unique_code}
+        with span(TraceStages.X3UI_PROVISION):
+            create_result = await x3ui_client.add_client_to_all_inbounds(
+                location_name=location_slug,
+                username=username,
+                unique_code=unique_code,
+                days=days_for_api,
+                tg_id=str(user.tg_id),
+                limit_ip=3,
+                sub_id=subscription_sub_id
+            )
+        
+        # Проверяем результат создания
+        if not create_result:
+            raise Exception("API 3x-ui вернул пустой ответ")
+        
+        if isinstance(create_result, dict) and create_result.get("error"):
+            error_msg = create_result.get("message", "Неизвестная ошибка")
+            # Если хотя бы один клиент создан, продолжаем, иначе выбрасываем ошибку
+            if len(create_result.get("created", [])) == 0:
+                raise Exception(f"Ошибка при создании клиентов: {error_msg}")
+            else:
+                logger.warning(f"⚠️ Создано клиентов: {len(create_result.get('created', []))}, но были ошибки: {error_msg}")
+        
+        # Получаем email первого созданного клиента для сохранения в БД
+        # Или используем формат для VLESS, если есть VLESS инбаунд
+        created_clients = create_result.get("created", [])
+        if created_clients:
+            # Ищем VLESS клиента в первую очередь, если есть
+            vless_client = next((c for c in created_clients if c.get("protocol") == "vless"), None)
+            if vless_client:
+                client_email = vless_client.get("email")
+            else:
+                # Берем первого созданного клиента
+                client_email = created_clients[0].get("email")
+        else:
+            # Fallback: используем формат для VLESS
+            client_email = f"{location_slug}@vless&{username}&{unique_code}"
+        
+        logger.info(f"✅ Создано клиентов во всех инбаундах: {len(created_clients)}/{create_result.get('total_inbounds', 0)}")
+        for client_info in created_clients:
+            network = client_info.get('network', 'N/A')
+            protocol = client_info.get('protocol', 'N/A')
+            logger.info(f"   - Inbound {client_info.get('inbound_id')} ({protocol}, network: {network}): {client_info.get('email')}")
+        
+        # Получаем ключи подписки по subID (это вернет список ключей для клиентов с этим subID)
+        import json
+        with span(TraceStages.X3UI_KEYS):
+            client_keys_list = await x3ui_client.get_client_keys_from_subscription(
+                subscription_sub_id
+            )
+        
+        # Преобразуем список ключей в JSON строку для сохранения в БД
+        if client_keys_list:
+            x3ui_subscription_link = json.dumps(client_keys_list, ensure_ascii=False)
+            logger.info(f"Subscription keys received for {len(client_keys_list)} clients")
+        else:
+            logger.warning(f"Failed to get subscription keys by subID (inbound may be missing)")
+            x3ui_subscription_link = None
+        
+        # Сохраняем данные для создания подписки
+        x3ui_client_email = client_email
+        
+        # Закрываем сессию после использования
+        try:
+            await x3ui_client.close()
+        except Exception as close_error:
+            logger.warning(f"Error closing session: {close_error}")
+            
+    except Exception as e:
+        error_msg = f"Ошибка при создании клиента в 3x-ui: {str(e)}"
+        logger.error(f"{error_msg}")
+        import traceback
+        logger.error(traceback.format_exc())
+        
+        # Закрываем сессию в случае ошибки
+        try:
+            if 'x3ui_client' in locals():
+                await x3ui_client.close()
+        except:
+            pass
+        
+        # Если это ошибка отсутствия инбаунда - это нормально, продолжаем без ключа
+        if "инбаунд не найден" in error_msg.lower() or "missing_inbound" in error_msg.lower():
+            logger.warning(f"Inbound missing - continuing subscription creation without key")
+            x3ui_subscription_link = None
+            x3ui_client_email = None
+        elif raise_on_provisioning_error:
+            # Повторная попытка из очереди: ошибку обрабатывает сама очередь (backoff, парковка)
+            raise Exception(error_msg)
+        else:
+            # Для других ошибок создаем запись для повторной попытки вместо немедленного исключения
+            try:
+                from services.subscription_retry import create_failed_attempt
+                
+                # Определяем тип ошибки
+                error_type = "api_error"
+                if "connection" in error_msg.lower() or "timeout" in error_msg.lower():
+                    error_type = "connection_error"
+                elif "authentication" in error_msg.lower() or "auth" in error_msg.lower():
+                    error_type = "authentication_error"
+                
+                # Создаем запись о неудачной попытке
+                failed_attempt = await create_failed_attempt(
+                    payment_id=payment_id,
+                    user_id=user.id,
+                    server_id=server_id,
+                    error_message=error_msg,
+                    error_type=error_type,
+                    subscription_id=None,
+                    is_renewal=False
+                )
+                
+                logger.info(
+                    f"📝 Создана запись о неудачной попытке создания подписки (API ошибка): "
+                    f"attempt_id={failed_attempt.id}, будет повторная попытка через 5 минут"
+                )
+                
+                # Уведомляем пользователя
+                try:
+                    await bot.send_message(
+                        chat_id=user_id,
+                        text=(
+                            f"⚠️ <b>Техническая ошибка при создании подписки</b>\n\n"
+                            f"Произошла ошибка при создании вашей подписки на сервере.\n\n"
+                            f"<b>Не беспокойтесь:</b>\n"
+                            f"• Платеж успешно обработан\n"
+                            f"• Мы автоматически повторим попытку создания подписки\n"
+                            f"• Вы получите уведомление, как только подписка будет активирована\n\n"
+                            f"<b>Детали:</b>\n"
+                            f"• Платеж: {payment.amount:.2f} ₽\n"
+                            f"• ID платежа: {payment_id}\n\n"
+                            f"Если подписка не будет активирована в течение 2 часов, "
+                            f"средства будут автоматически возвращены на ваш счет."
+                        ),
+                        reply_markup=main_menu(),
+                        parse_mode="HTML"
+                    )
+                except Exception as notify_error:
+                    logger.error(f"Failed to send notification to user: {notify_error}")
+                
+                # Прерываем выполнение функции - подписка будет создана при повторной попытке
+                return
+                
+            except Exception as retry_error:
+                # Если не удалось создать запись для повторной попытки,
+                # пробрасываем исключение дальше
+                logger.error(f"❌ Ошибка при создании записи о неудачной попытке: {retry_error}")
+                logger.error(traceback.format_exc())
+                raise Exception(error_msg)
+    
+    return location_name, subscription_sub_id, location_unique_name, x3ui_subscription_link, x3ui_client_email
+
+async def handle_successful_payment(payment_id: int, user_id: int, server_id: int, message_id: int = None, subscription_id: int = None, is_renewal: bool = False, raise_on_provisioning_error: bool = False):
     """Обработка успешного платежа - создание или продление подписки и выдача ключа
     
     ВАЖНО: Эта функция вызывается ТОЛЬКО после подтверждения успешной оплаты через YooKassa API.
     Ключ и инструкции отправляются ТОЛЬКО после успешной оплаты.
+    
+    raise_on_provisioning_error=True используется очередью повторных попыток: ошибка создания
+    клиента в 3x-ui пробрасывается вызывающему вместо создания новой записи FailedSubscriptionAttempt.
     """
     from utils.db import generate_test_key, update_subscription, get_subscription_by_id, get_payment_by_yookassa_id
     from core.loader import bot
@@ -1037,21 +1364,7 @@ async def handle_successful_payment(payment_id: int, user_id: int, server_id: in
     if not user:
         return
     
-    # Обновляем username пользователя, если он изменился (получаем из Telegram API)
-    # Это нужно для того, чтобы всегда использовать актуальный username
-    language_code = None
-    try:
-        from core.loader import bot
-        chat = await bot.get_chat(user_id)
-        if chat.username and chat.username != user.username:
-            from utils.db import update_user
-            await update_user(user.id, username=chat.username)
-            user.username = chat.username
-            logger.debug(f"User username updated: {chat.username}")
-        # Получаем language_code из чата для определения часового пояса
-        language_code = getattr(chat, 'language_code', None)
-    except Exception as e:
-        logger.warning(f"Failed to update user username: {e}")
+    # Username и язык (часовой пояс) пользователя обновляются из входящих обновлений (UserLocaleMiddleware)
     
     # Получаем информацию о сервере
     server = await get_server_by_id(server_id)
@@ -1284,7 +1597,7 @@ async def handle_successful_payment(payment_id: int, user_id: int, server_id: in
                     date_format = "%d.%m.%Y"
                 
                 # Конвертируем UTC время в локальное время пользователя для отображения
-                moscow_expire_date = utc_to_user_timezone(new_expire_date, user=user, language_code=language_code)
+                moscow_expire_date = utc_to_user_timezone(new_expire_date, user=user)
                 if date_format == "%d.%m.%Y %H:%M":
                     expire_str = moscow_expire_date.strftime("%d.%m.%Y в %H:%M")
                 else:
@@ -1302,6 +1615,7 @@ async def handle_successful_payment(payment_id: int, user_id: int, server_id: in
                     reply_markup=main_menu(),
                     parse_mode="HTML"
                 )
+                await tracing.complete_payment_trace(payment_id)
             except Exception as e:
                 logger.error(f"Failed to send notification to user: {e}")
             
@@ -1311,219 +1625,36 @@ async def handle_successful_payment(payment_id: int, user_id: int, server_id: in
     # Создаем клиента в 3x-ui через API
     x3ui_subscription_link = None
     x3ui_client_email = None
-    x3ui_client_id = None
     
-    try:
-        from services.x3ui_api import get_x3ui_client
-        import uuid as uuid_lib
-        
-        # Сервер уже получен выше, используем его для API подключения
-        # Создаем клиент 3x-ui API
-        logger.debug(f"Connecting to 3x-ui API: {server.api_url}")
-        x3ui_client = get_x3ui_client(server.api_url, server.api_username, server.api_password, server.ssl_certificate)
-        
-        # Создаем клиента в 3x-ui
-        # Email будет использоваться в формате {username}@{location_unique_name}.gigabridge
-        # Это позволяет одному пользователю иметь несколько подписок на одном сервере
-        
-        # Получаем название локации
-        location_name = server.location.name if server.location else "Неизвестно"
-        
-        # Генерируем уникальный subID для этой подписки (будет использован как seed для детерминированной генерации)
-        import uuid as uuid_lib
-        subscription_sub_id = str(uuid_lib.uuid4())
-        
-        # Генерируем уникальное название локации (будет использовано для email и идентификатора подписки)
-        # Используем subscription_sub_id как seed для детерминированной генерации
-        from utils.db import generate_location_unique_name
-        location_unique_name = generate_location_unique_name(location_name, seed=subscription_sub_id)
-        
-        # Извлекаем уникальный код из location_unique_name (убираем название локации и дефис)
-        # Формат: {location_slug}-{unique_code}, нам нужен только unique_code
-        unique_code = location_unique_name.split('-')[-1] if '-' in location_unique_name else location_unique_name
-        
-        # Подготавливаем username для использования в email
-        if user.username:
-            username = user.username
-        else:
-            username = f"user_{user.tg_id}"
-        
-        # Нормализуем название локации для использования в email (транслитерация в латиницу, lowercase)
-        import re
-        import unicodedata
-        translit_map = {
-            'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo',
-            'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
-            'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
-            'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
-            'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya'
-        }
-        normalized = unicodedata.normalize('NFKD', location_name)
-        location_slug = ''.join(translit_map.get(char.lower(), char.lower()) for char in normalized)
-        location_slug = re.sub(r'[^a-z0-9]', '', location_slug)
-        
-        logger.debug(f"Creating clients in 3x-ui: username={username}, tg_id={user.tg_id}, location={location_name}, sub_id={subscription_sub_id}")
-        
-        # Получаем длительность подписки (для тестирования или обычный режим)
-        days_for_api, duration_timedelta = get_subscription_duration(tariff.duration_days)
-        
-        # Создаем клиентов во всех инбаундах на основе первого клиента каждого инбаунда
-        # Для каждого инбаунда берем первого клиента как шаблон, меняем только уникальные поля
-        # Формат email: {location_name}@{protocol}&{username}&{unique_code}
-        create_result = await x3ui_client.add_client_to_all_inbounds(
-            location_name=location_slug,
-            username=username,
-            unique_code=unique_code,
-            days=days_for_api,
-            tg_id=str(user.tg_id),
-            limit_ip=3,
-            sub_id=subscription_sub_id
-        )
-        
-        # Проверяем результат создания
-        if not create_result:
-            raise Exception("API 3x-ui вернул пустой ответ")
-        
-        if isinstance(create_result, dict) and create_result.get("error"):
-            error_msg = create_result.get("message", "Неизвестная ошибка")
-            # Если хотя бы один клиент создан, продолжаем, иначе выбрасываем ошибку
-            if len(create_result.get("created", [])) == 0:
-                raise Exception(f"Ошибка при создании клиентов: {error_msg}")
-            else:
-                logger.warning(f"⚠️ Создано клиентов: {len(create_result.get('created', []))}, но были ошибки: {error_msg}")
-        
-        # Получаем email первого созданного клиента для сохранения в БД
-        # Или используем формат для VLESS, если есть VLESS инбаунд
-        created_clients = create_result.get("created", [])
-        if created_clients:
-            # Ищем VLESS клиента в первую очередь, если есть
-            vless_client = next((c for c in created_clients if c.get("protocol") == "vless"), None)
-            if vless_client:
-                client_email = vless_client.get("email")
-            else:
-                # Берем первого созданного клиента
-                client_email = created_clients[0].get("email")
-        else:
-            # Fallback: используем формат для VLESS
-            client_email = f"{location_slug}@vless&{username}&{unique_code}"
-        
-        logger.info(f"✅ Создано клиентов во всех инбаундах: {len(created_clients)}/{create_result.get('total_inbounds', 0)}")
-        for client_info in created_clients:
-            network = client_info.get('network', 'N/A')
-            protocol = client_info.get('protocol', 'N/A')
-            logger.info(f"   - Inbound {client_info.get('inbound_id')} ({protocol}, network: {network}): {client_info.get('email')}")
-        
-        # Получаем ключи подписки по subID (это вернет список ключей для клиентов с этим subID)
-        import json
-        client_keys_list = await x3ui_client.get_client_keys_from_subscription(
-            subscription_sub_id
-        )
-        
-        # Преобразуем список ключей в JSON строку для сохранения в БД
-        if client_keys_list:
-            x3ui_subscription_link = json.dumps(client_keys_list, ensure_ascii=False)
-            logger.info(f"Subscription keys received for {len(client_keys_list)} clients")
-        else:
-            logger.warning(f"Failed to get subscription keys by subID (inbound may be missing)")
-            x3ui_subscription_link = None
-        
-        # Сохраняем данные для создания подписки
-        x3ui_client_email = client_email
-        
-        # Закрываем сессию после использования
-        try:
-            await x3ui_client.close()
-        except Exception as close_error:
-            logger.warning(f"Error closing session: {close_error}")
-            
-    except Exception as e:
-        error_msg = f"Ошибка при создании клиента в 3x-ui: {str(e)}"
-        logger.error(f"{error_msg}")
-        import traceback
-        logger.error(traceback.format_exc())
-        
-        # Закрываем сессию в случае ошибки
+    # Сначала пробуем забрать заранее созданного клиента из пула (мгновенная выдача)
+    pooled_client = None
+    if config.CLIENT_POOL_SIZE > 0:
         try:
-            if 'x3ui_client' in locals():
-                await x3ui_client.close()
-        except:
-            pass
-        
-        # Если это ошибка отсутствия инбаунда - это нормально, продолжаем без ключа
-        if "инбаунд не найден" in error_msg.lower() or "missing_inbound" in error_msg.lower():
-            logger.warning(f"Inbound missing - continuing subscription creation without key")
-            x3ui_subscription_link = None
-            x3ui_client_email = None
-        else:
-            # Для других ошибок создаем запись для повторной попытки вместо немедленного исключения
-            try:
-                from services.subscription_retry import create_failed_attempt
-                
-                # Определяем тип ошибки
-                error_type = "api_error"
-                if "connection" in error_msg.lower() or "timeout" in error_msg.lower():
-                    error_type = "connection_error"
-                elif "authentication" in error_msg.lower() or "auth" in error_msg.lower():
-                    error_type = "authentication_error"
-                
-                # Создаем запись о неудачной попытке
-                failed_attempt = await create_failed_attempt(
-                    payment_id=payment_id,
-                    user_id=user.id,
-                    server_id=server_id,
-                    error_message=error_msg,
-                    error_type=error_type,
-                    subscription_id=None,
-                    is_renewal=False
-                )
-                
-                logger.info(
-                    f"📝 Создана запись о неудачной попытке создания подписки (API ошибка): "
-                    f"attempt_id={failed_attempt.id}, будет повторная попытка через 5 минут"
-                )
-                
-                # Уведомляем пользователя
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=(
-                            f"⚠️ <b>Техническая ошибка при создании подписки</b>\n\n"
-                            f"Произошла ошибка при создании вашей подписки на сервере.\n\n"
-                            f"<b>Не беспокойтесь:</b>\n"
-                            f"• Платеж успешно обработан\n"
-                            f"• Мы автоматически повторим попытку создания подписки\n"
-                            f"• Вы получите уведомление, как только подписка будет активирована\n\n"
-                            f"<b>Детали:</b>\n"
-                            f"• Платеж: {payment.amount:.2f} ₽\n"
-                            f"• ID платежа: {payment_id}\n\n"
-                            f"Если подписка не будет активирована в течение 2 часов, "
-                            f"средства будут автоматически возвращены на ваш счет."
-                        ),
-                        reply_markup=main_menu(),
-                        parse_mode="HTML"
-                    )
-                except Exception as notify_error:
-                    logger.error(f"Failed to send notification to user: {notify_error}")
-                
-                # Прерываем выполнение функции - подписка будет создана при повторной попытке
-                return
-                
-            except Exception as retry_error:
-                # Если не удалось создать запись для повторной попытки,
-                # пробрасываем исключение дальше
-                logger.error(f"❌ Ошибка при создании записи о неудачной попытке: {retry_error}")
-                logger.error(traceback.format_exc())
-                raise Exception(error_msg)
+            from services.client_pool import take_pooled_client
+            with span(TraceStages.X3UI_PROVISION):
+                pooled_client = await take_pooled_client(server, str(user.tg_id))
+        except Exception as pool_error:
+            logger.warning(f"⚠️ Ошибка при выдаче клиента из пула, создаем клиента на панели: {pool_error}")
+            pooled_client = None
+    
+    if pooled_client is not None:
+        location_name = server.location.name if server.location else "Неизвестно"
+        subscription_sub_id = pooled_client.sub_id
+        location_unique_name = pooled_client.location_unique_name
+        x3ui_subscription_link = pooled_client.client_keys
+        x3ui_client_email = pooled_client.client_email
+    else:
+        created = await _create_x3ui_clients(payment, user, server, tariff, raise_on_provisioning_error)
+        if created is None:
+            # Создание клиентов отложено в очередь повторных попыток, пользователь уведомлен
+            return
+        location_name, subscription_sub_id, location_unique_name, x3ui_subscription_link, x3ui_client_email = created
     
     # Убеждаемся, что переменные определены (на случай если был except блок)
-    if 'x3ui_subscription_link' not in locals():
-        x3ui_subscription_link = None
-    if 'x3ui_client_email' not in locals():
-        x3ui_client_email = None
-    if 'subscription_sub_id' not in locals():
+    if not subscription_sub_id:
         import uuid as uuid_lib
         subscription_sub_id = str(uuid_lib.uuid4())
-    if 'location_unique_name' not in locals():
+    if not location_unique_name:
         # Генерируем location_unique_name если его нет
         from utils.db import generate_location_unique_name
         location_unique_name = generate_location_unique_name(location_name, seed=subscription_sub_id)
@@ -1539,18 +1670,19 @@ async def handle_successful_payment(payment_id: int, user_id: int, server_id: in
     subscription = None
     try:
         # Создаем подписку (даже если ключа нет - это нормально, если инбаунд отсутствует)
-        subscription = await create_subscription(
-            user_id=user.id,
-            server_id=server_id,
-            tariff_id=tariff.id,
-            x3ui_client_id=x3ui_subscription_link,  # Может быть None, если инбаунд отсутствует
-            x3ui_client_email=x3ui_client_email,  # Может быть None, если инбаунд отсутствует
-            sub_id=subscription_sub_id,  # Уникальный subID для этой подписки
-            location_unique_name=location_unique_name,  # Сохраняем уникальное название локации
-            status="active",
-            expire_date=expire_date,  # Срок действия в БД (1 минута в тесте, 30 дней в обычном режиме)
-            traffic_limit=tariff.traffic_limit
-        )
+        with span(TraceStages.SUBSCRIPTION_SAVE):
+            subscription = await create_subscription(
+                user_id=user.id,
+                server_id=server_id,
+                tariff_id=tariff.id,
+                x3ui_client_id=x3ui_subscription_link,  # Может быть None, если инбаунд отсутствует
+                x3ui_client_email=x3ui_client_email,  # Может быть None, если инбаунд отсутствует
+                sub_id=subscription_sub_id,  # Уникальный subID для этой подписки
+                location_unique_name=location_unique_name,  # Сохраняем уникальное название локации
+                status="active",
+                expire_date=expire_date,  # Срок действия в БД (1 минута в тесте, 30 дней в обычном режиме)
+                traffic_limit=tariff.traffic_limit
+            )
         
         # Отмечаем, что пользователь использовал скидку на первую покупку
         await mark_user_used_discount(user.id)
@@ -1687,6 +1819,8 @@ async def handle_successful_payment(payment_id: int, user_id: int, server_id: in
         # Прерываем выполнение функции
         return
     
+    delivery_started = time.perf_counter()
+    
     # Удаляем сообщение с оплатой, если есть
     if message_id:
         try:
@@ -1736,8 +1870,7 @@ async def handle_successful_payment(payment_id: int, user_id: int, server_id: in
         if subscription.expire_date:
             # Конвертируем UTC время в локальное время пользователя для отображения
             if isinstance(subscription.expire_date, datetime):
-                # language_code уже получен выше из Telegram API
-                local_expire_date = utc_to_user_timezone(subscription.expire_date, user=user, language_code=language_code)
+                local_expire_date = utc_to_user_timezone(subscription.expire_date, user=user)
                 expire_str = local_expire_date.strftime("%d.%m.%Y в %H:%M")
             else:
                 expire_str = str(subscription.expire_date)
@@ -1813,22 +1946,36 @@ async def handle_successful_payment(payment_id: int, user_id: int, server_id: in
         kb.adjust(1)
         
         # Отправляем сообщение с фото (если есть) или без
+        # Через общую очередь с наивысшим приоритетом - выдача ключа идет раньше рассылок
+        from services.telegram_sender import telegram_sender, SendPriority
         if photo:
-            sent_key_message = await bot.send_photo(
+            await telegram_sender.call(
+                lambda: bot.send_photo(
+                    chat_id=user_id,
+                    photo=photo,
+                    caption=text,
+                    reply_markup=kb.as_markup(),
+                    parse_mode="HTML"
+                ),
                 chat_id=user_id,
-                photo=photo,
-                caption=text,
-                reply_markup=kb.as_markup(),
-                parse_mode="HTML"
+                priority=SendPriority.CRITICAL
             )
         else:
-            sent_key_message = await bot.send_message(
+            await telegram_sender.call(
+                lambda: bot.send_message(
+                    chat_id=user_id,
+                    text=text,
+                    reply_markup=kb.as_markup(),
+                    parse_mode="HTML"
+                ),
                 chat_id=user_id,
-                text=text,
-                reply_markup=kb.as_markup(),
-                parse_mode="HTML"
+                priority=SendPriority.CRITICAL
             )
         
+        # Ключ доставлен - фиксируем время доставки и полное время покупки
+        tracing.add_span(TraceStages.KEY_DELIVERY, (time.perf_counter() - delivery_started) * 1000)
+        await tracing.complete_payment_trace(payment_id)
+        
         # КРИТИЧЕСКИ ВАЖНО: Отправляем кнопки главного меню ПОСЛЕ сообщения с ключом
         # Telegram скрывает ReplyKeyboard когда показываются inline-кнопки
         # Отправляем новое сообщение с reply-кнопками, чтобы они снова стали видны
@@ -1850,9 +1997,12 @@ async def handle_successful_payment(payment_id: int, user_id: int, server_id: in
         logger.error(f"Error sending notification to user: {e}")
 
 
-@router.callback_query(F.data.startswith("pay_renew_"))
+@router.callback_query(F.data.startswith("pay_renew_"), flags={"throttling_key": "panel"})
 async def pay_renew_handler(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик оплаты продления подписки"""
+    # Трассировка покупки начинается с нажатия кнопки оплаты
+    purchase_started_at = time.time()
+    tracing.start_trace()
     try:
         await callback.answer()
     except:
@@ -1888,7 +2038,7 @@ async def pay_renew_handler(callback: types.CallbackQuery, state: FSMContext):
             pass
         return
     
-    location = await get_location_by_id(location_id)
+    location = await get_catalog_location(location_id)
     if not location or not location.is_active:
         try:
             await callback.message.delete()
@@ -1900,7 +2050,7 @@ async def pay_renew_handler(callback: types.CallbackQuery, state: FSMContext):
             pass
         return
     
-    server = await get_server_by_id(server_id)
+    server = await get_catalog_server(server_id)
     if not server:
         try:
             await callback.message.delete()
@@ -2013,6 +2163,9 @@ async def pay_renew_handler(callback: types.CallbackQuery, state: FSMContext):
             currency="RUB"
         )
         
+        # Сохраняем этапы до перехода к оплате и отметки для расчета ожидания оплаты
+        await tracing.start_payment_trace(payment.id, purchase_started_at)
+        
         # Сохраняем payment_id в state
         await state.update_data(
             payment_id=payment.id,
@@ -2081,6 +2234,7 @@ async def cancel_payment_handler(callback: types.CallbackQuery, state: FSMContex
         except:
             pass
     
+    await release_server_reservation(str(callback.from_user.id))
     await state.clear()
     try:
         await callback.message.delete()
@@ -2096,6 +2250,7 @@ async def cancel_payment_handler(callback: types.CallbackQuery, state: FSMContex
 @router.callback_query(F.data == "cancel_purchase")
 async def cancel_purchase_handler(callback: types.CallbackQuery, state: FSMContext):
     """Отмена покупки"""
+    await release_server_reservation(str(callback.from_user.id))
     await state.clear()
     try:
         await callback.answer()
@@ -2121,7 +2276,7 @@ async def restore_payment_message(user_id: int, state: FSMContext):
     if not location_id:
         return
     
-    location = await get_location_by_id(location_id)
+    location = await get_catalog_location(location_id)
     if not location:
         return
     
@@ -2234,7 +2389,7 @@ async def clear_email_state_on_command(message: types.Message, state: FSMContext
     # Команда будет обработана соответствующим обработчиком
 
 
-@router.message(EmailStates.waiting_email, ~F.text.startswith("/"))
+@router.message(EmailStates.waiting_email, ~F.text.startswith("/"), flags={"throttling_key": "panel"})
 async def process_email_input(message: types.Message, state: FSMContext):
     """Обработка введенного email"""
     if not message.text:
@@ -2303,6 +2458,7 @@ async def process_email_input(message: types.Message, state: FSMContext):
 async def cancel_email_input_handler(callback: types.CallbackQuery, state: FSMContext):
     """Отмена ввода email"""
     await callback.answer("❌ Ввод email отменен")
+    await release_server_reservation(str(callback.from_user.id))
     await state.clear()
     await callback.message.answer("❌ Ввод email отменен", reply_markup=main_menu())
 
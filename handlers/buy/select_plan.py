@@ -2,8 +2,7 @@ from aiogram import F, Router, types
 from aiogram.fsm.context import FSMContext
 from utils.keyboards.main_kb import main_menu
 from utils.db import (
-    get_active_locations,
-    get_location_by_id,
+    get_catalog_locations,
     has_available_server_for_location,
     get_user_by_tg_id,
     has_user_made_purchase
@@ -22,7 +21,7 @@ async def purchase_start(message: types.Message):
     except:
         pass
     
-    locations = await get_active_locations()
+    locations = await get_catalog_locations()
     
     if not locations:
         await message.answer(
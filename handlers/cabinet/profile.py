@@ -6,13 +6,12 @@ from utils.keyboards.main_kb import main_menu
 from utils.db import (
     get_user_by_tg_id,
     get_user_subscriptions,
-    get_server_by_id,
+    get_catalog_server,
     get_subscription_by_id,
-    get_tariff_by_id,
-    get_active_locations,
+    get_catalog_tariff,
+    get_catalog_locations,
     has_available_server_for_location,
     has_user_made_purchase,
-    get_location_by_id,
     select_available_server_for_location,
     get_subscription_identifier,
     utc_to_user_timezone
@@ -29,7 +28,7 @@ logger = logging.getLogger(__name__)
 router = Router()
 
 
-@router.message(F.text == "👤 Профиль")
+@router.message(F.text == "👤 Профиль", flags={"throttling_key": "heavy"})
 async def profile_handler(message: types.Message):
     """Обработчик кнопки Профиль - показывает информацию о подписках пользователя"""
     try:
@@ -109,7 +108,7 @@ async def profile_handler(message: types.Message):
             # Не пробрасываем ошибку дальше, чтобы не прерывать работу бота
 
 
-@router.callback_query(F.data.startswith("subscription_detail_"))
+@router.callback_query(F.data.startswith("subscription_detail_"), flags={"throttling_key": "heavy"})
 async def subscription_detail_handler(callback: types.CallbackQuery):
     """Обработчик детального просмотра подписки"""
     try:
@@ -145,7 +144,7 @@ async def subscription_detail_handler(callback: types.CallbackQuery):
         return
     
     # Получаем информацию о сервере для локации
-    server = await get_server_by_id(subscription.server_id)
+    server = await get_catalog_server(subscription.server_id)
     
     status_emoji = {
         "active": "✅",
@@ -174,7 +173,7 @@ async def subscription_detail_handler(callback: types.CallbackQuery):
     # Ссылка на подписку
     if subscription.sub_id:
         # Получаем сервер для извлечения IP адреса
-        server = await get_server_by_id(subscription.server_id)
+        server = await get_catalog_server(subscription.server_id)
         if server:
             from utils.db import generate_subscription_link
             subscription_link = generate_subscription_link(server, subscription.sub_id)
@@ -186,15 +185,8 @@ async def subscription_detail_handler(callback: types.CallbackQuery):
         from datetime import datetime as dt
         if isinstance(subscription.expire_date, dt):
             # Конвертируем UTC время в локальное время пользователя для отображения
-            # Пытаемся получить language_code из Telegram, если доступен
-            language_code = None
-            try:
-                from core.loader import bot
-                chat = await bot.get_chat(int(user.tg_id))
-                language_code = getattr(chat, 'language_code', None)
-            except:
-                pass
-            local_expire_date = utc_to_user_timezone(subscription.expire_date, user=user, language_code=language_code)
+            # (часовой пояс сохранен в профиле из входящих обновлений, см. UserLocaleMiddleware)
+            local_expire_date = utc_to_user_timezone(subscription.expire_date, user=user)
             expire_str = local_expire_date.strftime("%d.%m.%Y в %H:%M")
         else:
             expire_str = str(subscription.expire_date)
@@ -238,7 +230,7 @@ async def subscription_detail_handler(callback: types.CallbackQuery):
                     
                     # Вычисляем точную дату и время удаления
                     deletion_datetime = subscription.expire_date + delete_interval
-                    local_deletion_datetime = utc_to_user_timezone(deletion_datetime, user=user, language_code=language_code)
+                    local_deletion_datetime = utc_to_user_timezone(deletion_datetime, user=user)
                     deletion_datetime_str = local_deletion_datetime.strftime("%d.%m.%Y в %H:%M")
                     
                     # Вычисляем оставшееся время до удаления
@@ -276,7 +268,7 @@ async def subscription_detail_handler(callback: types.CallbackQuery):
         try:
             # Получаем сервер для извлечения IP адреса (если еще не получен)
             if not server:
-                server = await get_server_by_id(subscription.server_id)
+                server = await get_catalog_server(subscription.server_id)
             if server:
                 from utils.db import generate_subscription_link
                 subscription_link = generate_subscription_link(server, subscription.sub_id)
@@ -454,7 +446,7 @@ async def profile_purchase_handler(callback: types.CallbackQuery):
     except:
         pass
     
-    locations = await get_active_locations()
+    locations = await get_catalog_locations()
     
     if not locations:
         await callback.message.answer(
@@ -550,7 +542,7 @@ async def renew_subscription_handler(callback: types.CallbackQuery, state: FSMCo
         return
     
     # Получаем информацию о сервере и локации
-    server = await get_server_by_id(subscription.server_id)
+    server = await get_catalog_server(subscription.server_id)
     if not server or not server.location:
         try:
             await callback.message.delete()
@@ -613,7 +605,7 @@ async def renew_subscription_handler(callback: types.CallbackQuery, state: FSMCo
     
     # Показываем информацию о продлении и кнопку оплаты
     # Получаем тариф для определения длительности
-    tariff = await get_tariff_by_id(subscription.tariff_id) if subscription.tariff_id else None
+    tariff = await get_catalog_tariff(subscription.tariff_id) if subscription.tariff_id else None
     tariff_duration_days = tariff.duration_days if tariff else 30
     
     # Формируем текст о длительности продления
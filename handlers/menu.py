@@ -305,16 +305,16 @@ async def show_instructions_after_purchase_callback(callback: types.CallbackQuer
     )
 
 
-@router.callback_query(F.data == "get_key")
+@router.callback_query(F.data == "get_key", flags={"throttling_key": "heavy"})
 async def get_key_callback(callback: types.CallbackQuery):
     """Обработчик кнопки 'Получить ключ' - открывает список локаций для покупки"""
     
     # Импортируем функции для покупки
-    from utils.db import get_active_locations, has_available_server_for_location, get_user_by_tg_id, has_user_made_purchase
+    from utils.db import get_catalog_locations, has_available_server_for_location, get_user_by_tg_id, has_user_made_purchase
     from core.config import config
     from aiogram.utils.keyboard import InlineKeyboardBuilder
     
-    locations = await get_active_locations()
+    locations = await get_catalog_locations()
     
     if not locations:
         from utils.message_utils import callback_answer_and_save
@@ -42,7 +42,7 @@ async def start_handler(message: types.Message):
             )
 
 
-@router.message(Command("grant_unlimited"))
+@router.message(Command("grant_unlimited"), flags={"throttling_key": "panel"})
 async def grant_unlimited_handler(message: types.Message):
     """Обработчик команды /grant_unlimited <пароль> <название> - выдача безграничной бессрочной подписки на локацию"""
     # Получаем или создаем пользователя
@@ -99,29 +99,49 @@ async def main():
     from services.scheduler import start_scheduler
     start_scheduler()
     
-    # Добавляем задачи проверки подписок
-    from services.subscription_checker import start_subscription_checker
-    start_subscription_checker()
+    # Сброс кэша в памяти процесса по изменениям на других репликах
+    from utils.cache import cache_invalidation_listener
+    cache_invalidation_listener.start()
     
-    # Добавляем задачу обработки повторных попыток создания подписок
-    from services.subscription_retry import start_subscription_retry_handler
-    start_subscription_retry_handler()
-    
-    # Добавляем задачу проверки оплаты серверов
-    from services.server_payment_checker import start_server_payment_checker
-    start_server_payment_checker()
-    
-    # Добавляем задачу проверки загрузки серверов
-    from services.server_load_checker import start_server_load_checker
-    start_server_load_checker()
+    from core.config import config
     
-    # Добавляем задачу автоматической отправки бэкапов админам
-    from services.backup_scheduler import start_weekly_backup
-    start_weekly_backup()
+    # Периодические задачи (при нескольких репликах выполняются только на одной)
+    if config.BACKGROUND_JOBS_ENABLED:
+        # Добавляем задачи проверки подписок
+        from services.subscription_checker import start_subscription_checker
+        start_subscription_checker()
+        
+        # Добавляем задачу обработки повторных попыток создания подписок
+        from services.subscription_retry import start_subscription_retry_handler
+        start_subscription_retry_handler()
+        
+        # Добавляем задачу проверки оплаты серверов
+        from services.server_payment_checker import start_server_payment_checker
+        start_server_payment_checker()
+        
+        # Добавляем задачу проверки загрузки серверов
+        from services.server_load_checker import start_server_load_checker
+        start_server_load_checker()
+        
+        # Добавляем задачу автоматической отправки бэкапов админам
+        from services.backup_scheduler import start_weekly_backup
+        start_weekly_backup()
+        
+        # Добавляем задачу пополнения пула заранее созданных клиентов 3x-ui
+        from services.client_pool import start_client_pool_replenisher
+        start_client_pool_replenisher()
+        
+        # Добавляем задачу обновления статистики по дням для админ-панели
+        from services.admin_stats import start_stats_rollup
+        start_stats_rollup()
+    else:
+        logger.info("⏸️ Периодические фоновые задачи отключены (BACKGROUND_JOBS_ENABLED=false)")
     
-    # Патчим методы для автоматического добавления кнопок управления
-    from utils.message_utils import patch_bot_methods
-    patch_bot_methods()
+    # Продолжаем рассылки, прерванные перезапуском, и периодически - рассылки,
+    # процесс-владелец которых остановился
+    from services.broadcast import resume_broadcasts, start_broadcast_resumer
+    await resume_broadcasts()
+    start_broadcast_resumer()
     
     # Роутеры бота
     # Важно: users_router должен быть раньше servers_router,
@@ -142,6 +162,40 @@ async def main():
     dp.include_router(backup_router)
     dp.include_router(updates_router)
     dp.include_router(support_router)
+    
+    # Ограничиваем количество одновременно обрабатываемых обновлений
+    from middlewares import (
+        AdminMiddleware,
+        CleanupMessagesMiddleware,
+        ConcurrencyLimitMiddleware,
+        DbSessionMiddleware,
+        ThrottlingMiddleware,
+        UserLocaleMiddleware
+    )
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(config.UPDATE_CONCURRENCY))
+    
+    # Одна сессия БД (одно соединение пула) на обновление для всех функций utils.db
+    dp.update.outer_middleware(DbSessionMiddleware())
+    
+    # Сохраняем язык (часовой пояс) и username пользователя из входящих обновлений
+    dp.update.outer_middleware(UserLocaleMiddleware())
+    
+    # Права администратора определяются один раз на обновление (для AdminFilter)
+    dp.update.outer_middleware(AdminMiddleware())
+    
+    # Защита от флуда: лимиты по группам хендлеров (флаг throttling_key) до обращения к БД и панелям
+    dp.message.middleware(ThrottlingMiddleware())
+    dp.callback_query.middleware(ThrottlingMiddleware())
+    
+    # Удаляем предыдущие сообщения бота и сообщения пользователя (в фоне, параллельно с обработчиком).
+    # Исходные сообщения рассылки и уведомлений сервера не удаляем - их копируют получателям позже
+    from handlers.admin.dashboard import BroadcastStates
+    from handlers.admin.servers import NotifyUsersStates
+    cleanup_middleware = CleanupMessagesMiddleware(
+        keep_message_states=(BroadcastStates.waiting_message, NotifyUsersStates.waiting_message)
+    )
+    dp.message.middleware(cleanup_middleware)
+    dp.callback_query.middleware(cleanup_middleware)
 
     # Перезагружаем .env файл ПЕРЕД созданием конфига
     from dotenv import load_dotenv
@@ -188,13 +242,25 @@ async def main():
         logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА: TEST_MODE={config.TEST_MODE}, но в env='{test_mode_env}' (должно быть False)")
         logger.error("❌ Проверьте парсинг в core/config.py")
     
-    logger.info("Bot started")
+    logger.info(f"Bot started (режим: {config.BOT_MODE})")
     try:
-        await dp.start_polling(bot)
+        if config.BOT_MODE == "webhook":
+            from services.webhook_server import run_webhook
+            await run_webhook(dp, bot)
+        else:
+            # Polling не работает при установленном webhook (например, после переключения режима)
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot)
     finally:
         # Останавливаем планировщик при завершении
         from services.scheduler import stop_scheduler
         stop_scheduler()
+        
+        await cache_invalidation_listener.stop()
+        
+        # Останавливаем воркеры очереди исходящих сообщений
+        from services.telegram_sender import telegram_sender
+        await telegram_sender.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
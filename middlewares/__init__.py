@@ -1,4 +1,8 @@
+from middlewares.admin import AdminMiddleware
 from middlewares.cleanup_messages import CleanupMessagesMiddleware
+from middlewares.concurrency import ConcurrencyLimitMiddleware
+from middlewares.db_session import DbSessionMiddleware
+from middlewares.throttling import ThrottlingMiddleware
+from middlewares.user_locale import UserLocaleMiddleware
 
-__all__ = ['CleanupMessagesMiddleware']
-
+__all__ = ['AdminMiddleware', 'CleanupMessagesMiddleware', 'ConcurrencyLimitMiddleware', 'DbSessionMiddleware', 'ThrottlingMiddleware', 'UserLocaleMiddleware']
@@ -0,0 +1,35 @@
+"""
+Middleware для определения прав администратора один раз на обновление
+"""
+import logging
+from typing import Callable, Dict, Any, Awaitable
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from utils.db import is_admin
+
+logger = logging.getLogger(__name__)
+
+
+class AdminMiddleware(BaseMiddleware):
+    """
+    Добавляет в данные обновления флаг is_admin
+
+    AdminFilter берет флаг из данных обновления, поэтому проверка фильтра на каждом
+    роутере не обращается ни к Redis, ни к БД. Список администраторов кэшируется
+    в памяти процесса (utils.db.get_admin_tg_ids).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user = data.get("event_from_user")
+        if from_user:
+            try:
+                data["is_admin"] = await is_admin(str(from_user.id))
+            except Exception as e:
+                logger.error(f"❌ Не удалось проверить права администратора {from_user.id}: {e}")
+                data["is_admin"] = False
+        return await handler(event, data)
@@ -2,15 +2,82 @@
 Middleware для автоматической очистки предыдущих сообщений бота
 Оставляет в чате только одно активное сообщение
 """
-from typing import Callable, Dict, Any, Awaitable
+import asyncio
+import logging
+from typing import Callable, Dict, Any, Awaitable, Iterable, Set
 from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
 from aiogram.types import Message, CallbackQuery, TelegramObject
 from core.storage import redis_client
+from utils.message_utils import BOT_MESSAGE_IDS_KEY
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать перед удалением, чтобы объединить сообщения при частых нажатиях (секунды)
+CLEANUP_DEBOUNCE_SECONDS = 0.5
+
+# Максимум сообщений в одном вызове deleteMessages (ограничение Telegram)
+DELETE_MESSAGES_BATCH = 100
+
+
+class MessageCleanupQueue:
+    """
+    Фоновое удаление сообщений
+
+    Удаления не задерживают обработку обновления. Для каждого чата работает не больше
+    одной задачи: она ждет CLEANUP_DEBOUNCE_SECONDS, собирая все запрошенные за это
+    время сообщения, и удаляет их одним вызовом deleteMessages (до 100 ID за вызов).
+    """
+
+    def __init__(self):
+        self._pending: Dict[int, Set[int]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def schedule(self, chat_id: int, message_ids: Iterable[int]) -> None:
+        """Поставить сообщения чата в очередь на удаление"""
+        message_ids = set(message_ids)
+        if not message_ids:
+            return
+        self._pending.setdefault(chat_id, set()).update(message_ids)
+
+        task = self._tasks.get(chat_id)
+        if task is None or task.done():
+            self._tasks[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    async def _drain(self, chat_id: int) -> None:
+        from core.loader import bot
+
+        try:
+            while self._pending.get(chat_id):
+                await asyncio.sleep(CLEANUP_DEBOUNCE_SECONDS)
+                message_ids = sorted(self._pending.pop(chat_id, ()))
+                for start in range(0, len(message_ids), DELETE_MESSAGES_BATCH):
+                    try:
+                        # Ненайденные и уже удаленные сообщения Telegram пропускает сам
+                        await bot.delete_messages(
+                            chat_id=chat_id,
+                            message_ids=message_ids[start:start + DELETE_MESSAGES_BATCH]
+                        )
+                    except Exception as e:
+                        logger.debug(f"Не удалось удалить сообщения в чате {chat_id}: {e}")
+        finally:
+            self._tasks.pop(chat_id, None)
+
+
+cleanup_queue = MessageCleanupQueue()
 
 
 class CleanupMessagesMiddleware(BaseMiddleware):
-    """Middleware для удаления предыдущих сообщений бота"""
-    
+    """
+    Middleware для удаления предыдущих сообщений бота
+
+    Входящее сообщение в одном из состояний keep_message_states не удаляется: обработчик
+    использует его позже (рассылка и уведомления копируют исходное сообщение через copy_message).
+    """
+
+    def __init__(self, keep_message_states: Iterable[State] = ()):
+        self.keep_message_states = {state.state for state in keep_message_states}
+
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -19,82 +86,46 @@ class CleanupMessagesMiddleware(BaseMiddleware):
     ) -> Any:
         """
         Обрабатывает событие и удаляет предыдущее сообщение бота
+
+        Перед обработчиком выполняется только одно чтение из Redis, удаление сообщений
+        идет в фоне параллельно с обработчиком.
         """
         user_id = None
         chat_id = None
-        
+        to_delete = []
+
         # Определяем user_id и chat_id в зависимости от типа события
         if isinstance(event, Message):
             user_id = event.from_user.id if event.from_user else None
             chat_id = event.chat.id
-            # Удаляем сообщение пользователя (middleware сделает это автоматически)
-            # Но мы также удаляем его здесь для надежности
-            try:
-                await event.delete()
-            except Exception:
-                pass
+            # Удаляем сообщение пользователя, если обработчику оно не нужно после ответа
+            if data.get("raw_state") not in self.keep_message_states:
+                to_delete.append(event.message_id)
         elif isinstance(event, CallbackQuery):
             user_id = event.from_user.id if event.from_user else None
             if event.message:
                 chat_id = event.message.chat.id
-        
+
         if not user_id or not chat_id:
             # Если не можем определить пользователя, пропускаем
             return await handler(event, data)
-        
-        # Формируем ключи для Redis
-        redis_key = f"last_bot_message:{chat_id}:{user_id}"
-        menu_key = f"menu_message:{chat_id}:{user_id}"
-        
-        # УДАЛЯЕМ предыдущее сообщение бота ДО выполнения обработчика
-        # Это важно, чтобы удалить сообщение бота, а не только сообщение пользователя
+
+        # Забираем ID сообщений ДО выполнения обработчика (одна транзакция - один запрос к Redis):
+        # обработчик сохранит ID нового сообщения, и оно останется в чате
         try:
-            # Получаем ID сообщения с кнопками управления для проверки
-            menu_message_id_bytes = await redis_client.get(menu_key)
-            menu_message_id = None
-            if menu_message_id_bytes:
-                menu_message_id = menu_message_id_bytes.decode('utf-8') if isinstance(menu_message_id_bytes, bytes) else str(menu_message_id_bytes)
-            
-            # Получаем ID последнего сообщения бота
-            last_message_id_bytes = await redis_client.get(redis_key)
-            
-            # Удаляем предыдущее сообщение бота, если оно есть
-            # НО: проверяем, не является ли это сообщение с кнопками управления
-            if last_message_id_bytes:
-                # Redis возвращает bytes, нужно декодировать
-                last_message_id = last_message_id_bytes.decode('utf-8') if isinstance(last_message_id_bytes, bytes) else str(last_message_id_bytes)
-                
-                # Если это НЕ сообщение с кнопками управления, удаляем его
-                # Сообщение с кнопками управления НЕ должно удаляться
-                if menu_message_id != last_message_id:
-                    try:
-                        from core.loader import bot
-                        await bot.delete_message(chat_id=chat_id, message_id=int(last_message_id))
-                    except Exception:
-                        # Игнорируем ошибки (сообщение могло быть уже удалено)
-                        pass
+            ids_key = BOT_MESSAGE_IDS_KEY.format(chat_id=chat_id, user_id=user_id)
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.lrange(ids_key, 0, -1)
+            pipe.delete(ids_key)
+            bot_message_ids, _ = await pipe.execute()
+            to_delete.extend(int(message_id) for message_id in bot_message_ids)
         except Exception:
             # Игнорируем ошибки Redis
             pass
-        
-        # Выполняем обработчик
-        # Патченный Message.answer() автоматически добавит кнопки управления и сохранит ID
-        result = await handler(event, data)
-        
-        return result
 
+        if to_delete:
+            cleanup_queue.schedule(chat_id, to_delete)
 
-async def save_bot_message(chat_id: int, user_id: int, message_id: int):
-    """
-    Сохраняет ID сообщения бота для последующего удаления
-    Вызывается после отправки сообщения ботом
-    """
-    try:
-        redis_key = f"last_bot_message:{chat_id}:{user_id}"
-        # Сохраняем как строку для правильной работы с Redis
-        await redis_client.set(redis_key, str(message_id), ex=86400)  # TTL 24 часа
-    except Exception as e:
-        # Логируем ошибки для отладки
-        print(f"[SAVE_MESSAGE] Ошибка сохранения сообщения {message_id}: {e}")
-        pass
+        # Выполняем обработчик
+        return await handler(event, data)
 
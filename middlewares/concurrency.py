@@ -0,0 +1,29 @@
+"""
+Middleware для ограничения количества одновременно обрабатываемых обновлений
+"""
+import asyncio
+from typing import Callable, Dict, Any, Awaitable
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """
+    Ограничивает количество одновременно выполняемых хендлеров
+
+    Polling и webhook запускают обработку каждого обновления отдельной задачей без
+    ограничения. При всплеске обновлений лишние ждут здесь, а не открывают новые
+    соединения с БД и панелями 3x-ui.
+    """
+    
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(max(1, limit))
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        async with self.semaphore:
+            return await handler(event, data)
@@ -0,0 +1,31 @@
+"""
+Middleware для работы с БД через одну сессию на обновление
+"""
+from typing import Callable, Dict, Any, Awaitable
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from database.base import update_session_scope
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Открывает одну сессию БД на обновление и передает ее обработчикам (аргумент session)
+
+    Функции utils.db, вызванные при обработке обновления, используют эту сессию
+    автоматически, поэтому одно обновление занимает одно соединение пула вместо
+    отдельного соединения и транзакции на каждый запрос.
+
+    Транзакции чтения завершаются после каждой функции utils.db, поэтому во время
+    запросов к панелям 3x-ui и YooKassa соединение возвращено в пул
+    (см. get_session).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        async with update_session_scope() as session:
+            data["session"] = session
+            return await handler(event, data)
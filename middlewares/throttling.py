@@ -0,0 +1,154 @@
+"""
+Middleware для защиты от флуда: ограничение частоты запросов пользователя
+
+Лимиты считаются скользящим окном в Redis (общие для всех реплик бота) отдельно
+для каждой группы хендлеров. Группа задается флагом хендлера throttling_key:
+
+    @router.callback_query(F.data.startswith("pay_location_"), flags={"throttling_key": "panel"})
+
+Одинаковые запросы пользователя, пока предыдущий еще обрабатывается, отбрасываются.
+В окно записываются только принятые запросы: отклоненные клики не продлевают ограничение.
+"""
+import hashlib
+import logging
+import time
+import uuid
+from typing import Callable, Dict, Any, Awaitable, Optional
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message, CallbackQuery, TelegramObject
+from core.storage import redis_client
+from utils.message_utils import safe_callback_answer
+
+logger = logging.getLogger(__name__)
+
+# Ключи для Redis
+THROTTLE_KEY = "throttle:{user_id}:{group}"
+THROTTLE_INFLIGHT_KEY = "throttle:inflight:{user_id}:{fingerprint}"
+THROTTLE_NOTIFIED_KEY = "throttle:notified:{user_id}:{group}"
+
+# Лимиты по группам: (запросов, окно в секундах)
+# panel - хендлеры, обращающиеся к панелям 3x-ui и YooKassa
+# heavy - хендлеры с несколькими запросами к БД (списки локаций, профиль, подписки)
+THROTTLE_LIMITS = {
+    "default": (20, 10),
+    "heavy": (6, 10),
+    "panel": (3, 10),
+}
+
+# Через сколько секунд снимается отметка "запрос обрабатывается" (если обработчик завис)
+INFLIGHT_TTL = 60
+
+THROTTLED_TEXT = "⏳ Слишком много запросов. Подождите несколько секунд."
+IN_PROGRESS_TEXT = "⏳ Запрос уже обрабатывается..."
+
+# Результаты проверки запроса
+ADMITTED = 0
+THROTTLED = 1
+THROTTLED_FIRST = 2  # Первое превышение в окне - пользователю отправляется сообщение
+IN_PROGRESS = 3
+
+# Проверка лимита и отметка "запрос обрабатывается" атомарно, одним запросом к Redis.
+# KEYS: окно запросов, отметка об уведомлении, [отметка "запрос обрабатывается"]
+# ARGV: текущее время, окно (сек), лимит, ID запроса, TTL отметки "запрос обрабатывается"
+_ADMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('zremrangebyscore', KEYS[1], 0, now - window)
+if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[3]) then
+    if redis.call('set', KEYS[2], '1', 'NX', 'EX', window) then
+        return 2
+    end
+    return 1
+end
+if KEYS[3] and not redis.call('set', KEYS[3], '1', 'NX', 'EX', tonumber(ARGV[5])) then
+    return 3
+end
+redis.call('zadd', KEYS[1], now, ARGV[4])
+redis.call('expire', KEYS[1], window)
+return 0
+"""
+
+
+def _request_fingerprint(event: TelegramObject) -> Optional[str]:
+    """Отпечаток запроса для поиска одинаковых запросов (None - не объединять)"""
+    if isinstance(event, CallbackQuery):
+        raw = f"cb:{event.data}"
+    elif isinstance(event, Message) and event.text:
+        raw = f"msg:{event.text}"
+    else:
+        return None
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничивает частоту запросов пользователя (регистрируется как inner middleware)"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user = data.get("event_from_user")
+        if not from_user or not redis_client:
+            return await handler(event, data)
+
+        group = get_flag(data, "throttling_key", default="default")
+        limit, window = THROTTLE_LIMITS.get(group, THROTTLE_LIMITS["default"])
+        fingerprint = _request_fingerprint(event)
+        keys = [
+            THROTTLE_KEY.format(user_id=from_user.id, group=group),
+            THROTTLE_NOTIFIED_KEY.format(user_id=from_user.id, group=group),
+        ]
+        inflight_key = (
+            THROTTLE_INFLIGHT_KEY.format(user_id=from_user.id, fingerprint=fingerprint)
+            if fingerprint else None
+        )
+        if inflight_key:
+            keys.append(inflight_key)
+
+        now = time.time()
+        try:
+            result = await redis_client.eval(
+                _ADMIT_SCRIPT, len(keys), *keys,
+                now, window, limit, f"{now}:{uuid.uuid4().hex[:8]}", INFLIGHT_TTL
+            )
+        except Exception as e:
+            # При недоступности Redis не блокируем пользователей
+            logger.debug(f"Ошибка проверки частоты запросов: {e}")
+            return await handler(event, data)
+
+        if result in (THROTTLED, THROTTLED_FIRST):
+            # Сообщение отправляем только при первом превышении в окне, чтобы не отвечать на каждый клик
+            await self._answer(event, THROTTLED_TEXT, notify=result == THROTTLED_FIRST)
+            logger.debug(f"Пользователь {from_user.id} ограничен ({group}: {limit} за {window} сек)")
+            return None
+
+        if result == IN_PROGRESS:
+            await self._answer(event, IN_PROGRESS_TEXT, notify=False)
+            return None
+
+        try:
+            return await handler(event, data)
+        finally:
+            if inflight_key:
+                await self._release(inflight_key)
+
+    @staticmethod
+    async def _release(inflight_key: str) -> None:
+        try:
+            await redis_client.delete(inflight_key)
+        except Exception:
+            pass
+
+    @staticmethod
+    async def _answer(event: TelegramObject, text: str, notify: bool) -> None:
+        """Дешевый ответ без обращения к БД: ответ на callback (обязателен) или одно сообщение"""
+        if isinstance(event, CallbackQuery):
+            await safe_callback_answer(event, text)
+        elif isinstance(event, Message) and notify:
+            try:
+                await event.answer(text)
+            except Exception:
+                pass
@@ -0,0 +1,49 @@
+"""
+Middleware для сохранения языка и username пользователя из входящих обновлений
+"""
+import logging
+from typing import Callable, Dict, Any, Awaitable
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User as TelegramUser
+from utils.cache import CacheService, CacheKeys
+from utils.db import update_user_locale
+
+logger = logging.getLogger(__name__)
+
+# Сколько хранить в кэше последние сохраненные значения (сутки)
+USER_LOCALE_CACHE_TTL = 86400
+
+
+class UserLocaleMiddleware(BaseMiddleware):
+    """
+    Сохраняет language_code (и часовой пояс по нему) и username из from_user в профиль пользователя
+
+    Благодаря этому обработчикам и уведомлениям не нужно запрашивать bot.get_chat()
+    для отображения времени в часовом поясе пользователя. В БД пишем только при
+    изменении значений, обычное обновление стоит одного чтения из Redis.
+    """
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user: TelegramUser = data.get("event_from_user")
+        if from_user and not from_user.is_bot:
+            await self._remember_locale(from_user)
+        return await handler(event, data)
+    
+    @staticmethod
+    async def _remember_locale(from_user: TelegramUser) -> None:
+        cache_key = CacheKeys.USER_LOCALE.format(tg_id=from_user.id)
+        current = {"language_code": from_user.language_code, "username": from_user.username}
+        try:
+            if await CacheService.get(cache_key) == current:
+                return
+            
+            # Пользователь еще не зарегистрирован (/start) - не кэшируем, сохраним при следующем обновлении
+            if await update_user_locale(str(from_user.id), from_user.language_code, from_user.username):
+                await CacheService.set(cache_key, current, ttl=USER_LOCALE_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить язык пользователя {from_user.id}: {e}")
@@ -0,0 +1,47 @@
+"""
+Статистика для админ-панели: снимок с коротким кэшем и фоновое заполнение статистики по дням
+"""
+import logging
+from services.scheduler import add_job
+from utils.cache import CacheService, CacheKeys
+from utils.db import get_admin_stats, rollup_daily_stats
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд показывать сохраненный снимок статистики
+ADMIN_STATS_CACHE_TTL = 60
+
+
+async def get_admin_stats_snapshot() -> dict:
+    """Получить статистику для админ-панели (из кэша, если снимок свежий)"""
+    stats = await CacheService.get(CacheKeys.ADMIN_STATS)
+    if stats is not None:
+        return stats
+
+    stats = await get_admin_stats()
+    await CacheService.set(CacheKeys.ADMIN_STATS, stats, ttl=ADMIN_STATS_CACHE_TTL)
+    return stats
+
+
+async def rollup_daily_stats_job():
+    """Периодическая задача обновления статистики по дням"""
+    try:
+        await rollup_daily_stats()
+        logger.debug("Статистика по дням обновлена")
+    except Exception as e:
+        logger.error(f"❌ Ошибка при обновлении статистики по дням: {e}")
+
+
+def start_stats_rollup():
+    """Запустить задачу обновления статистики по дням (сразу и затем каждый час)"""
+    from datetime import datetime
+
+    add_job(
+        rollup_daily_stats_job,
+        trigger="interval",
+        hours=1,
+        id="rollup_daily_stats",
+        next_run_time=datetime.utcnow(),
+        max_instances=1
+    )
+    logger.info("✅ Задача обновления статистики по дням добавлена (каждый час)")
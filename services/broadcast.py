@@ -0,0 +1,488 @@
+"""
+Фоновые рассылки с сохранением прогресса в Redis
+
+Рассылка - это задача с ID, состояние которой (статус, курсор по User.id, счетчики)
+хранится в Redis. Получатели читаются из БД пачками после курсора, поэтому рассылка
+не загружает всех пользователей в память и продолжается с места остановки после
+перезапуска бота. Отправка идет через общую очередь services.telegram_sender.
+
+Рассылку выполняет процесс, владеющий блокировкой (значение - токен владельца).
+Блокировка продлевается после каждой пачки; если процесс-владелец остановился,
+она истекает, и периодическая задача resume_broadcasts любого процесса
+продолжает рассылку с сохраненного курсора.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Optional, Dict, Any
+from aiogram.enums import ContentType
+from core.config import config
+from core.storage import redis_client
+from services.telegram_sender import telegram_sender, SendPriority
+from utils.db import get_users_count, get_user_recipients_batch
+
+logger = logging.getLogger(__name__)
+
+# Ключи для Redis
+BROADCAST_KEY = "broadcast:{broadcast_id}"
+BROADCAST_LOCK_KEY = "broadcast:{broadcast_id}:lock"
+ACTIVE_BROADCASTS_KEY = "broadcast:active"
+
+# Время жизни состояния рассылки (7 дней)
+BROADCAST_TTL = 7 * 86400
+
+# Блокировка, чтобы одну рассылку не выполняли два процесса (продлевается после каждой пачки)
+BROADCAST_LOCK_TTL = 120
+
+# Как часто проверять рассылки без владельца (секунды)
+BROADCAST_RESUME_INTERVAL = 60
+
+# Продление и снятие блокировки только ее владельцем: после истечения блокировку
+# может взять другой процесс, и ее нельзя продлевать или удалять
+_EXTEND_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Не чаще одного редактирования сообщения со статусом за указанное число секунд
+STATUS_EDIT_INTERVAL = 3
+
+# Сколько примеров ошибок хранить
+MAX_ERROR_SAMPLES = 5
+
+DEFAULT_HEADER = "📨 <b>Сообщение от администратора</b>"
+
+
+class BroadcastStatus:
+    """Статусы рассылки"""
+    RUNNING = "running"
+    PAUSED = "paused"
+    CANCELLED = "cancelled"
+    COMPLETED = "completed"
+
+
+# Задачи рассылок, запущенные в этом процессе
+_running_tasks: Dict[str, asyncio.Task] = {}
+
+# Задачи уведомлений пользователей сервера (ссылки держим, чтобы задачи не собрал GC)
+_notification_tasks: set[asyncio.Task] = set()
+
+
+# Типы медиа с подписью: копируются с заголовком в подписи
+MEDIA_WITH_CAPTION = ("photo", "video", "animation", "document", "audio", "voice")
+# Типы медиа без подписи: копируются как есть, без заголовка
+MEDIA_WITHOUT_CAPTION = ("video_note", "sticker")
+
+
+def build_message_data(message) -> Optional[dict]:
+    """
+    Сохранить ссылку на исходное сообщение администратора для рассылки
+
+    Медиа не перезаливается и не пересобирается: получателям отправляется копия
+    исходного сообщения (copy_message), поэтому храним только chat_id и message_id.
+
+    Returns:
+        Данные сообщения или None, если тип сообщения не поддерживается
+    """
+    content_type = ContentType(message.content_type).value
+    if content_type not in ("text",) + MEDIA_WITH_CAPTION + MEDIA_WITHOUT_CAPTION:
+        return None
+
+    has_media = content_type != "text"
+    return {
+        "from_chat_id": message.chat.id,
+        "message_id": message.message_id,
+        "text": message.html_text if (message.text or message.caption) else "",
+        "has_media": has_media,
+        "media_type": content_type if has_media else None
+    }
+
+
+async def send_broadcast_message(bot, chat_id: int, message_data: dict, header: str = DEFAULT_HEADER):
+    """
+    Отправить сообщение рассылки одному пользователю (один вызов Bot API)
+
+    Текст отправляется с заголовком, медиа копируется из исходного сообщения
+    с подписью "заголовок + исходная подпись" (форматирование сохраняется).
+    """
+    message_text = message_data.get("text", "")
+    text = f"{header}\n\n{message_text}" if message_text else header
+
+    if not message_data.get("has_media", False):
+        return await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+
+    if message_data.get("media_type") in MEDIA_WITHOUT_CAPTION:
+        return await bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=message_data["from_chat_id"],
+            message_id=message_data["message_id"]
+        )
+
+    return await bot.copy_message(
+        chat_id=chat_id,
+        from_chat_id=message_data["from_chat_id"],
+        message_id=message_data["message_id"],
+        caption=text,
+        parse_mode="HTML"
+    )
+
+
+async def create_broadcast(admin_chat_id: int, status_message_id: int, message_data: dict) -> str:
+    """
+    Создать рассылку (без запуска)
+
+    Args:
+        admin_chat_id: Чат администратора для сообщения со статусом
+        status_message_id: ID сообщения со статусом рассылки
+        message_data: Данные сообщения (см. build_message_data)
+
+    Returns:
+        ID рассылки
+    """
+    if not redis_client:
+        raise RuntimeError("Redis недоступен: рассылка требует хранилища прогресса")
+
+    broadcast_id = uuid.uuid4().hex[:12]
+    total = await get_users_count()
+    key = BROADCAST_KEY.format(broadcast_id=broadcast_id)
+
+    await redis_client.hset(key, mapping={
+        "status": BroadcastStatus.RUNNING,
+        "cursor": 0,
+        "total": total,
+        "sent": 0,
+        "failed": 0,
+        "admin_chat_id": admin_chat_id,
+        "status_message_id": status_message_id,
+        "message_data": json.dumps(message_data, ensure_ascii=False),
+        "errors": "[]",
+        "created_at": int(time.time())
+    })
+    await redis_client.expire(key, BROADCAST_TTL)
+    await redis_client.sadd(ACTIVE_BROADCASTS_KEY, broadcast_id)
+
+    logger.info(f"📢 Создана рассылка {broadcast_id} на {total} пользователей")
+    return broadcast_id
+
+
+async def get_broadcast(broadcast_id: str) -> Optional[Dict[str, Any]]:
+    """Получить состояние рассылки"""
+    data = await redis_client.hgetall(BROADCAST_KEY.format(broadcast_id=broadcast_id))
+    if not data:
+        return None
+
+    for field in ("cursor", "total", "sent", "failed", "admin_chat_id", "status_message_id", "created_at"):
+        data[field] = int(data.get(field) or 0)
+    data["message_data"] = json.loads(data.get("message_data") or "{}")
+    data["errors"] = json.loads(data.get("errors") or "[]")
+    data["id"] = broadcast_id
+    return data
+
+
+async def set_broadcast_status(broadcast_id: str, status: str) -> bool:
+    """
+    Изменить статус рассылки (пауза, продолжение, отмена)
+
+    Returns:
+        True если статус изменен, False если рассылка не найдена или уже завершена
+    """
+    state = await get_broadcast(broadcast_id)
+    if not state or state["status"] in (BroadcastStatus.COMPLETED, BroadcastStatus.CANCELLED):
+        return False
+
+    await redis_client.hset(BROADCAST_KEY.format(broadcast_id=broadcast_id), "status", status)
+    if status == BroadcastStatus.CANCELLED:
+        await redis_client.srem(ACTIVE_BROADCASTS_KEY, broadcast_id)
+    logger.info(f"📢 Рассылка {broadcast_id}: статус изменен на {status}")
+    return True
+
+
+def format_broadcast_status(state: Dict[str, Any]) -> str:
+    """Сформировать текст сообщения со статусом рассылки"""
+    total = state["total"]
+    processed = state["sent"] + state["failed"]
+    percent = processed * 100 // total if total else 100
+
+    titles = {
+        BroadcastStatus.RUNNING: "⏳ <b>Рассылка в процессе...</b>",
+        BroadcastStatus.PAUSED: "⏸️ <b>Рассылка приостановлена</b>",
+        BroadcastStatus.CANCELLED: "❌ <b>Рассылка отменена</b>",
+        BroadcastStatus.COMPLETED: "✅ <b>Рассылка завершена!</b>",
+    }
+
+    text = f"{titles.get(state['status'], '📢 <b>Рассылка</b>')}\n\n"
+    text += f"👥 Всего пользователей: {total}\n"
+    text += f"📈 Прогресс: {processed}/{total} ({percent}%)\n"
+    text += f"✅ Успешно отправлено: <b>{state['sent']}</b>\n"
+    text += f"❌ Ошибок: <b>{state['failed']}</b>\n"
+
+    if state["errors"] and state["status"] in (BroadcastStatus.COMPLETED, BroadcastStatus.CANCELLED):
+        import html
+        text += f"\n<b>Примеры ошибок:</b>\n"
+        for error in state["errors"]:
+            text += f"• {html.escape(error)}\n"
+        if state["failed"] > len(state["errors"]):
+            text += f"... и еще {state['failed'] - len(state['errors'])} ошибок\n"
+
+    return text
+
+
+async def update_status_message(state: Dict[str, Any]) -> None:
+    """Обновить сообщение со статусом рассылки у администратора"""
+    from core.loader import bot
+    from utils.keyboards.admin_kb import broadcast_control_keyboard
+
+    try:
+        await bot.edit_message_text(
+            chat_id=state["admin_chat_id"],
+            message_id=state["status_message_id"],
+            text=format_broadcast_status(state),
+            reply_markup=broadcast_control_keyboard(state["id"], state["status"]),
+            parse_mode="HTML"
+        )
+    except Exception:
+        pass  # Игнорируем ошибки редактирования статуса (например, "message is not modified")
+
+
+async def _send_batch(bot, state: Dict[str, Any], batch: list) -> tuple[int, int, list]:
+    """Отправить сообщение пачке получателей через общую очередь"""
+    futures = [
+        telegram_sender.submit(
+            lambda chat_id=int(tg_id): send_broadcast_message(bot, chat_id, state["message_data"]),
+            chat_id=int(tg_id),
+            priority=SendPriority.BULK
+        )
+        for _, tg_id, _ in batch
+    ]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+
+    sent = 0
+    failed = 0
+    errors = []
+    for (_, tg_id, username), result in zip(batch, results):
+        if isinstance(result, Exception):
+            failed += 1
+            errors.append(f"@{username or f'ID: {tg_id}'}: {str(result)[:50]}")
+        else:
+            sent += 1
+    return sent, failed, errors
+
+
+async def run_broadcast(broadcast_id: str) -> None:
+    """
+    Выполнить рассылку с текущего курсора
+
+    Курсор сохраняется после каждой отправленной пачки, поэтому после перезапуска
+    повторно может быть отправлена не больше чем одна пачка.
+    """
+    from core.loader import bot
+
+    key = BROADCAST_KEY.format(broadcast_id=broadcast_id)
+    lock_key = BROADCAST_LOCK_KEY.format(broadcast_id=broadcast_id)
+    batch_size = max(1, config.BROADCAST_CONCURRENCY)
+
+    # Рассылку выполняет только один процесс
+    lock_token = uuid.uuid4().hex
+    if not await redis_client.set(lock_key, lock_token, nx=True, ex=BROADCAST_LOCK_TTL):
+        logger.debug(f"📢 Рассылка {broadcast_id} уже выполняется другим процессом")
+        return
+
+    last_edit = 0.0
+    try:
+        while True:
+            state = await get_broadcast(broadcast_id)
+            if not state or state["status"] != BroadcastStatus.RUNNING:
+                break
+
+            batch = await get_user_recipients_batch(after_id=state["cursor"], limit=batch_size)
+            if not batch:
+                await redis_client.hset(key, "status", BroadcastStatus.COMPLETED)
+                await redis_client.srem(ACTIVE_BROADCASTS_KEY, broadcast_id)
+                logger.info(f"✅ Рассылка {broadcast_id} завершена")
+                break
+
+            sent, failed, errors = await _send_batch(bot, state, batch)
+
+            pipe = redis_client.pipeline()
+            pipe.hincrby(key, "sent", sent)
+            pipe.hincrby(key, "failed", failed)
+            pipe.hset(key, "cursor", batch[-1][0])
+            if errors and len(state["errors"]) < MAX_ERROR_SAMPLES:
+                pipe.hset(key, "errors", json.dumps((state["errors"] + errors)[:MAX_ERROR_SAMPLES], ensure_ascii=False))
+            pipe.expire(key, BROADCAST_TTL)
+            pipe.eval(_EXTEND_LOCK_SCRIPT, 1, lock_key, lock_token, BROADCAST_LOCK_TTL)
+            *_, lock_extended = await pipe.execute()
+            if not lock_extended:
+                # Блокировка истекла и могла перейти к другому процессу
+                logger.warning(f"⚠️ Рассылка {broadcast_id}: блокировка потеряна, выполнение остановлено")
+                break
+
+            # Обновляем статус не чаще раза в STATUS_EDIT_INTERVAL секунд
+            if time.monotonic() - last_edit >= STATUS_EDIT_INTERVAL:
+                last_edit = time.monotonic()
+                state = await get_broadcast(broadcast_id)
+                if state:
+                    await update_status_message(state)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка при выполнении рассылки {broadcast_id}: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+    finally:
+        try:
+            await redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, lock_token)
+        except Exception as e:
+            logger.warning(f"Не удалось снять блокировку рассылки {broadcast_id}: {e}")
+        _running_tasks.pop(broadcast_id, None)
+
+    # Финальное состояние сообщения со статусом
+    state = await get_broadcast(broadcast_id)
+    if state:
+        await update_status_message(state)
+        if state["status"] == BroadcastStatus.COMPLETED:
+            await _send_admin_menu(state["admin_chat_id"])
+
+
+async def _send_admin_menu(admin_chat_id: int) -> None:
+    """Вернуть администратора в админ-меню после завершения рассылки"""
+    from core.loader import bot
+    from utils.keyboards.admin_kb import admin_menu
+
+    try:
+        await bot.send_message(
+            chat_id=admin_chat_id,
+            text="🔧 <b>Админ-панель</b>\n\nВыберите раздел для управления:",
+            reply_markup=admin_menu(),
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось отправить админ-меню после рассылки: {e}")
+
+
+def launch_broadcast(broadcast_id: str) -> None:
+    """Запустить выполнение рассылки в фоне"""
+    task = _running_tasks.get(broadcast_id)
+    if task and not task.done():
+        return
+    _running_tasks[broadcast_id] = asyncio.create_task(run_broadcast(broadcast_id))
+
+
+async def run_server_notification(
+    admin_chat_id: int,
+    server_name: str,
+    recipients: list[int],
+    message_data: dict,
+    header: str
+) -> None:
+    """
+    Отправить уведомление пользователям сервера и прислать отчет администратору
+
+    Получателей немного (только пользователи одного сервера), поэтому, в отличие
+    от рассылки, прогресс не сохраняется в Redis.
+    """
+    from core.loader import bot
+
+    futures = [
+        telegram_sender.submit(
+            lambda chat_id=chat_id: send_broadcast_message(bot, chat_id, message_data, header=header),
+            chat_id=chat_id,
+            priority=SendPriority.NOTIFICATION
+        )
+        for chat_id in recipients
+    ]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+
+    sent_count = 0
+    failed_count = 0
+    for chat_id, result in zip(recipients, results):
+        if isinstance(result, Exception):
+            logger.error(f"❌ Ошибка при отправке уведомления пользователю {chat_id}: {result}")
+            failed_count += 1
+        else:
+            sent_count += 1
+
+    import html
+    result_text = f"✅ <b>Уведомления отправлены</b>\n\n"
+    result_text += f"Сервер: <b>{html.escape(server_name)}</b>\n"
+    result_text += f"Всего пользователей: <b>{len(recipients)}</b>\n"
+    result_text += f"✅ Отправлено: <b>{sent_count}</b>\n"
+    if failed_count > 0:
+        result_text += f"❌ Ошибок: <b>{failed_count}</b>\n"
+
+    try:
+        await bot.send_message(chat_id=admin_chat_id, text=result_text, parse_mode="HTML")
+    except Exception as e:
+        logger.warning(f"Не удалось отправить отчет об уведомлении администратору {admin_chat_id}: {e}")
+
+
+def launch_server_notification(
+    admin_chat_id: int,
+    server_name: str,
+    recipients: list[int],
+    message_data: dict,
+    header: str
+) -> None:
+    """Запустить уведомление пользователей сервера в фоне (см. run_server_notification)"""
+    task = asyncio.create_task(
+        run_server_notification(admin_chat_id, server_name, recipients, message_data, header)
+    )
+    _notification_tasks.add(task)
+    task.add_done_callback(_notification_tasks.discard)
+
+
+async def resume_broadcasts() -> None:
+    """
+    Продолжить рассылки без работающего владельца
+
+    Вызывается при запуске и периодически: рассылка, процесс-владелец которой
+    перезапустился или остановился, продолжается после истечения его блокировки.
+    """
+    if not redis_client:
+        return
+
+    try:
+        broadcast_ids = await redis_client.smembers(ACTIVE_BROADCASTS_KEY)
+    except Exception as e:
+        logger.error(f"❌ Ошибка при получении активных рассылок: {e}")
+        return
+
+    for broadcast_id in broadcast_ids:
+        state = await get_broadcast(broadcast_id)
+        if not state or state["status"] in (BroadcastStatus.COMPLETED, BroadcastStatus.CANCELLED):
+            await redis_client.srem(ACTIVE_BROADCASTS_KEY, broadcast_id)
+            continue
+        if state["status"] != BroadcastStatus.RUNNING:
+            continue
+        task = _running_tasks.get(broadcast_id)
+        if task and not task.done():
+            continue
+        # Блокировка есть - рассылку выполняет другой процесс (или владелец еще не остановлен)
+        if await redis_client.exists(BROADCAST_LOCK_KEY.format(broadcast_id=broadcast_id)):
+            continue
+        logger.info(f"📢 Продолжаем рассылку {broadcast_id} с пользователя ID>{state['cursor']}")
+        launch_broadcast(broadcast_id)
+
+
+def start_broadcast_resumer() -> None:
+    """Запускает периодическую проверку рассылок без владельца"""
+    from services.scheduler import add_job
+
+    add_job(
+        resume_broadcasts,
+        trigger="interval",
+        seconds=BROADCAST_RESUME_INTERVAL,
+        id="resume_broadcasts",
+        max_instances=1
+    )
+    logger.info(f"✅ Задача продолжения рассылок добавлена (каждые {BROADCAST_RESUME_INTERVAL} сек)")
@@ -0,0 +1,350 @@
+"""
+Пул заранее созданных клиентов 3x-ui для мгновенной выдачи подписки после оплаты
+
+Фоновая задача держит на каждом активном сервере CLIENT_POOL_SIZE отключенных клиентов
+с уже зарезервированным subId. При покупке достаточно забрать запись из пула и включить
+клиентов на панели - без логина с полным созданием клиентов во всех инбаундах.
+Забранные записи убираются из пула той же задачей (reap_stale_pooled_clients).
+"""
+import json
+import logging
+import uuid as uuid_lib
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import select, func, and_, delete, exists
+from database.base import async_session
+from database.models import PooledClient, Server, Subscription
+from core.config import config
+from services.scheduler import add_job
+
+logger = logging.getLogger(__name__)
+
+# Username в email клиентов пула (реальный владелец неизвестен на момент создания)
+POOL_USERNAME = "pool"
+
+# Сколько забранных записей разбирать за один проход
+STALE_CLAIM_REAP_BATCH = 100
+
+
+async def count_available_pooled_clients(server_id: int) -> int:
+    """Подсчитать количество свободных клиентов в пуле сервера"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(func.count(PooledClient.id)).where(
+                and_(
+                    PooledClient.server_id == server_id,
+                    PooledClient.status == "available"
+                )
+            )
+        )
+        return result.scalar() or 0
+
+
+async def claim_pooled_client(server_id: int) -> Optional[PooledClient]:
+    """
+    Атомарно забрать свободного клиента из пула сервера
+
+    Используется SELECT ... FOR UPDATE SKIP LOCKED, поэтому параллельные покупки
+    (в том числе на разных репликах бота) никогда не получат одного и того же клиента.
+
+    Returns:
+        Запись PooledClient со статусом claimed или None, если пул пуст
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(PooledClient)
+            .where(
+                and_(
+                    PooledClient.server_id == server_id,
+                    PooledClient.status == "available"
+                )
+            )
+            .order_by(PooledClient.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        pooled_client = result.scalar_one_or_none()
+        if not pooled_client:
+            return None
+
+        pooled_client.status = "claimed"
+        pooled_client.claimed_at = datetime.utcnow()
+        await session.commit()
+        await session.refresh(pooled_client)
+        return pooled_client
+
+
+async def release_pooled_client(pooled_client_id: int) -> None:
+    """Вернуть клиента в пул (например, если не удалось включить его на панели)"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(PooledClient).where(PooledClient.id == pooled_client_id)
+        )
+        pooled_client = result.scalar_one_or_none()
+        if not pooled_client:
+            return
+
+        pooled_client.status = "available"
+        pooled_client.claimed_at = None
+        await session.commit()
+
+
+async def take_pooled_client(server: Server, tg_id: str) -> Optional[PooledClient]:
+    """
+    Забрать клиента из пула и включить его на панели 3x-ui
+
+    Args:
+        server: Сервер, на котором создается подписка
+        tg_id: Telegram ID покупателя
+
+    Returns:
+        Запись PooledClient, если клиент успешно выдан, иначе None
+        (в этом случае нужно создавать клиентов обычным способом)
+    """
+    if config.CLIENT_POOL_SIZE <= 0:
+        return None
+
+    pooled_client = await claim_pooled_client(server.id)
+    if not pooled_client:
+        logger.info(f"Пул клиентов сервера {server.id} пуст, создаем клиента на панели")
+        return None
+
+    from services.x3ui_api import get_x3ui_client
+    x3ui_client = get_x3ui_client(server.api_url, server.api_username, server.api_password, server.ssl_certificate)
+    try:
+        result = await x3ui_client.activate_clients_by_sub_id(pooled_client.sub_id, tg_id=tg_id)
+    except Exception as e:
+        result = {"error": True, "message": str(e)}
+    finally:
+        try:
+            await x3ui_client.close()
+        except Exception:
+            pass
+
+    if not result or result.get("error") or result.get("errors"):
+        error_msg = result.get("message", "Неизвестная ошибка") if result else "Пустой ответ"
+        logger.warning(f"⚠️ Не удалось включить клиента из пула (sub_id={pooled_client.sub_id}): {error_msg}")
+        if result and result.get("updated"):
+            # Часть клиентов уже включена на покупателя - в пул такую запись не возвращаем.
+            # Она остается забранной, подписки с этим subId не будет, и
+            # reap_stale_pooled_clients удалит клиентов с панели
+            return None
+        await release_pooled_client(pooled_client.id)
+        return None
+
+    logger.info(f"✅ Выдан клиент из пула сервера {server.id}: sub_id={pooled_client.sub_id}")
+    return pooled_client
+
+
+async def create_pooled_client(server: Server) -> Optional[PooledClient]:
+    """
+    Создать на панели отключенных клиентов с новым subId и сохранить их в пул
+
+    Args:
+        server: Сервер с загруженной локацией
+
+    Returns:
+        Созданная запись PooledClient или None при ошибке
+    """
+    from services.x3ui_api import get_x3ui_client
+    from utils.db import generate_location_unique_name, generate_location_slug
+
+    location_name = server.location.name if server.location else "Неизвестно"
+    sub_id = str(uuid_lib.uuid4())
+    location_unique_name = generate_location_unique_name(location_name, seed=sub_id)
+    unique_code = location_unique_name.split('-')[-1] if '-' in location_unique_name else location_unique_name
+
+    x3ui_client = get_x3ui_client(server.api_url, server.api_username, server.api_password, server.ssl_certificate)
+    try:
+        create_result = await x3ui_client.add_client_to_all_inbounds(
+            location_name=generate_location_slug(location_name),
+            username=POOL_USERNAME,
+            unique_code=unique_code,
+            days=0,
+            tg_id=None,
+            limit_ip=3,
+            sub_id=sub_id,
+            enable=False
+        )
+        created_clients = create_result.get("created", []) if create_result else []
+        if not created_clients:
+            error_msg = create_result.get("message", "Пустой ответ") if create_result else "Пустой ответ"
+            logger.warning(f"⚠️ Не удалось пополнить пул сервера {server.id}: {error_msg}")
+            return None
+
+        vless_client = next((c for c in created_clients if c.get("protocol") == "vless"), None)
+        client_email = (vless_client or created_clients[0]).get("email")
+
+        client_keys_list = await x3ui_client.get_client_keys_from_subscription(sub_id)
+        client_keys = json.dumps(client_keys_list, ensure_ascii=False) if client_keys_list else None
+    finally:
+        try:
+            await x3ui_client.close()
+        except Exception:
+            pass
+
+    async with async_session() as session:
+        pooled_client = PooledClient(
+            server_id=server.id,
+            sub_id=sub_id,
+            location_unique_name=location_unique_name,
+            client_email=client_email,
+            client_keys=client_keys,
+            status="available"
+        )
+        session.add(pooled_client)
+        await session.commit()
+        await session.refresh(pooled_client)
+        return pooled_client
+
+
+async def _delete_panel_clients(server: Server, sub_id: str) -> bool:
+    """Удалить клиентов пула с панели (True, если клиентов на панели больше нет)"""
+    from services.x3ui_api import get_x3ui_client
+
+    x3ui_client = get_x3ui_client(server.api_url, server.api_username, server.api_password, server.ssl_certificate)
+    try:
+        result = await x3ui_client.delete_all_clients_by_sub_id(sub_id)
+    except Exception as e:
+        result = {"error": True, "message": str(e)}
+    finally:
+        try:
+            await x3ui_client.close()
+        except Exception:
+            pass
+
+    if result and (not result.get("error") or result.get("error_type") == "not_found"):
+        return True
+    error_msg = result.get("message", "Неизвестная ошибка") if result else "Пустой ответ"
+    logger.warning(f"⚠️ Не удалось удалить клиентов пула с панели (sub_id={sub_id}): {error_msg}")
+    return False
+
+
+async def reap_stale_pooled_clients() -> int:
+    """
+    Убрать из пула клиентов, забранных больше CLIENT_POOL_CLAIM_TIMEOUT_MINUTES назад
+
+    Если есть подписка с тем же subId, клиент выдан и принадлежит ей - удаляется только
+    запись пула. Иначе выдача прервалась (например, процесс упал между захватом клиента
+    и созданием подписки): клиенты удаляются с панели, пул пополнится новыми.
+
+    Returns:
+        Количество удаленных записей
+    """
+    from utils.db import get_server_by_id
+
+    stale_before = datetime.utcnow() - timedelta(minutes=config.CLIENT_POOL_CLAIM_TIMEOUT_MINUTES)
+    async with async_session() as session:
+        result = await session.execute(
+            select(PooledClient, exists().where(Subscription.sub_id == PooledClient.sub_id))
+            .where(
+                and_(
+                    PooledClient.status == "claimed",
+                    PooledClient.claimed_at <= stale_before
+                )
+            )
+            .order_by(PooledClient.id)
+            .limit(STALE_CLAIM_REAP_BATCH)
+        )
+        rows = result.all()
+
+    reaped_ids = []
+    abandoned = 0
+    for pooled_client, delivered in rows:
+        if not delivered:
+            server = await get_server_by_id(pooled_client.server_id)
+            if server and not await _delete_panel_clients(server, pooled_client.sub_id):
+                # Панель недоступна - попробуем в следующий проход
+                continue
+            abandoned += 1
+        reaped_ids.append(pooled_client.id)
+
+    if not reaped_ids:
+        return 0
+
+    async with async_session() as session:
+        await session.execute(
+            delete(PooledClient).where(
+                and_(
+                    PooledClient.id.in_(reaped_ids),
+                    PooledClient.status == "claimed"
+                )
+            )
+        )
+        await session.commit()
+
+    if abandoned:
+        logger.warning(f"⚠️ Из пула удалено {abandoned} клиентов с прерванной выдачей")
+    logger.info(f"🧹 Из пула убрано забранных записей: {len(reaped_ids)}")
+    return len(reaped_ids)
+
+
+async def replenish_client_pools() -> None:
+    """
+    Пополнить пулы клиентов на всех активных серверах
+
+    За один проход на каждый сервер создается не больше CLIENT_POOL_REFILL_BATCH клиентов,
+    чтобы нагрузка на панели распределялась во времени, а не приходилась на момент продаж.
+    Перед пополнением из пула убираются давно забранные записи.
+    """
+    if config.CLIENT_POOL_SIZE <= 0:
+        return
+
+    from utils.db import get_all_servers
+
+    try:
+        await reap_stale_pooled_clients()
+    except Exception as e:
+        logger.error(f"❌ Ошибка при очистке забранных клиентов пула: {e}")
+
+    try:
+        servers = await get_all_servers()
+    except Exception as e:
+        logger.error(f"❌ Ошибка при получении серверов для пополнения пула: {e}")
+        return
+
+    for server in servers:
+        if not server.is_active:
+            continue
+
+        try:
+            available = await count_available_pooled_clients(server.id)
+            missing = config.CLIENT_POOL_SIZE - available
+
+            # Не держим в пуле больше клиентов, чем осталось свободных мест на сервере
+            if server.max_users is not None:
+                free_slots = server.max_users - (server.current_users or 0)
+                missing = min(missing, free_slots - available)
+
+            to_create = min(missing, config.CLIENT_POOL_REFILL_BATCH)
+            if to_create <= 0:
+                continue
+
+            created = 0
+            for _ in range(to_create):
+                if await create_pooled_client(server):
+                    created += 1
+                else:
+                    # Панель недоступна - не тратим остальные попытки в этом проходе
+                    break
+
+            if created:
+                logger.info(f"✅ Пул сервера {server.id} пополнен на {created} клиентов (свободно: {available + created})")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при пополнении пула сервера {server.id}: {e}")
+
+
+def start_client_pool_replenisher():
+    """Запустить фоновую задачу пополнения пула клиентов"""
+    if config.CLIENT_POOL_SIZE <= 0:
+        logger.info("ℹ️ Пул клиентов 3x-ui отключен (CLIENT_POOL_SIZE=0)")
+        return
+
+    add_job(
+        replenish_client_pools,
+        trigger="interval",
+        minutes=2,
+        id="replenish_client_pools",
+        max_instances=1
+    )
+    logger.info(f"✅ Задача пополнения пула клиентов добавлена (каждые 2 минуты, размер пула: {config.CLIENT_POOL_SIZE})")
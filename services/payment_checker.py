@@ -7,10 +7,14 @@ from services.scheduler import add_job, remove_job
 from services.yookassa_service import yookassa_service
 from utils.db import (
     update_payment_status,
-    get_payment_by_yookassa_id
+    get_payment_by_yookassa_id,
+    release_server_reservation
 )
 from handlers.buy.payment import handle_successful_payment
 from core.storage import redis_client
+from utils import tracing
+from utils.tracing import TraceStages
+from datetime import datetime
 from core.loader import bot
 from utils.keyboards.main_kb import main_menu
 import logging
@@ -20,6 +24,9 @@ logger = logging.getLogger(__name__)
 # Ключи для Redis
 PAYMENT_DATA_KEY = "payment:check:{yookassa_payment_id}"
 PAYMENT_CHECK_MAX_TIME = 300  # 5 минут в секундах
+# Блокировка проверки платежа: опрос и уведомление YooKassa не должны обработать платеж дважды
+PAYMENT_CHECK_LOCK_KEY = "payment:check:{yookassa_payment_id}:lock"
+PAYMENT_CHECK_LOCK_TTL = 120
 
 
 async def store_payment_check_data(
@@ -77,10 +84,11 @@ async def handle_canceled_payment(
     reason: Optional[str] = None
 ):
     """Обработка отмененного или проваленного платежа"""
-    from utils.db import update_payment_status
+    from utils.db import update_payment_status, release_server_reservation
     
-    # Обновляем статус платежа в БД
+    # Обновляем статус платежа в БД и освобождаем место на сервере
     await update_payment_status(payment_id, "failed")
+    await release_server_reservation(str(user_id))
     
     # Формируем сообщение для пользователя
     try:
@@ -178,7 +186,37 @@ async def handle_canceled_payment(
 
 
 async def check_payment_job(yookassa_payment_id: str):
-    """Задача для проверки статуса платежа"""
+    """Задача для проверки статуса платежа (вызывается планировщиком и при уведомлении YooKassa)"""
+    lock_key = PAYMENT_CHECK_LOCK_KEY.format(yookassa_payment_id=yookassa_payment_id)
+    if not await redis_client.set(lock_key, "1", nx=True, ex=PAYMENT_CHECK_LOCK_TTL):
+        logger.debug(f"Платеж {yookassa_payment_id} уже проверяется, пропускаем")
+        return
+    
+    # Каждая проверка - отдельная трассировка, этапы записываются в Redis по завершении
+    tracing.start_trace()
+    try:
+        await _check_payment(yookassa_payment_id)
+    finally:
+        await tracing.flush_trace()
+        await redis_client.delete(lock_key)
+
+
+async def _record_payment_detected(payment_id: int, captured_at) -> None:
+    """Записать время ожидания оплаты и задержку обнаружения оплаты опросом"""
+    await tracing.record_since_mark(payment_id, tracing.MARK_PAYMENT_CREATED, TraceStages.PAYMENT_WAIT)
+    if not captured_at:
+        return
+    try:
+        captured = datetime.fromisoformat(str(captured_at).replace("Z", "+00:00"))
+        lag_ms = (datetime.now(captured.tzinfo) - captured).total_seconds() * 1000
+        if lag_ms >= 0:
+            tracing.add_span(TraceStages.POLL_LAG, lag_ms)
+    except ValueError:
+        logger.debug(f"Не удалось разобрать captured_at платежа {payment_id}: {captured_at}")
+
+
+async def _check_payment(yookassa_payment_id: str):
+    """Проверка статуса платежа (см. check_payment_job)"""
     try:
         # Получаем данные из Redis
         data = await get_payment_check_data(yookassa_payment_id)
@@ -188,11 +226,14 @@ async def check_payment_job(yookassa_payment_id: str):
             logger.debug(f"Данные платежа {yookassa_payment_id} не найдены, задача удалена")
             return
         
+        tracing.bind_payment(data["payment_id"])
+        
         # Проверяем статус платежа
         payment_status = yookassa_service.get_payment_status(yookassa_payment_id)
         
         if payment_status and payment_status["status"] == "succeeded":
             # Платеж успешен
+            await _record_payment_detected(data["payment_id"], payment_status.get("captured_at"))
             await handle_successful_payment(
                 payment_id=data["payment_id"],
                 user_id=data["user_id"],
@@ -201,6 +242,8 @@ async def check_payment_job(yookassa_payment_id: str):
                 subscription_id=data.get("subscription_id"),
                 is_renewal=data.get("is_renewal", False)
             )
+            # Место занято подпиской, бронь больше не нужна
+            await release_server_reservation(str(data["user_id"]), data["server_id"])
             # Удаляем данные и задачу
             await delete_payment_check_data(yookassa_payment_id)
             remove_job(f"check_payment_{yookassa_payment_id}")
@@ -0,0 +1,121 @@
+"""
+Отслеживание доступности панелей 3x-ui
+
+Состояние хранится в Redis, чтобы его видели все реплики бота: счетчик подряд идущих
+ошибок и момент, с которого сервер считается недоступным.
+"""
+import logging
+import time
+from typing import Optional
+from core.storage import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Ключ для Redis
+SERVER_HEALTH_KEY = "server:health:{server_id}"
+
+# Сколько ошибок подряд нужно, чтобы считать сервер недоступным
+SERVER_DOWN_FAILURE_THRESHOLD = 2
+
+# Время жизни записи о здоровье сервера (сутки) - старые ошибки не должны влиять вечно
+SERVER_HEALTH_TTL = 86400
+
+
+async def record_server_failure(server_id: int) -> int:
+    """
+    Зафиксировать ошибку обращения к панели сервера
+
+    Args:
+        server_id: ID сервера
+
+    Returns:
+        Количество ошибок подряд
+    """
+    if not redis_client:
+        return 0
+
+    key = SERVER_HEALTH_KEY.format(server_id=server_id)
+    try:
+        failures = await redis_client.hincrby(key, "failures", 1)
+        if failures >= SERVER_DOWN_FAILURE_THRESHOLD:
+            # Запоминаем момент, когда сервер впервые признан недоступным
+            if await redis_client.hsetnx(key, "down_since", int(time.time())):
+                logger.warning(f"🔴 Сервер {server_id} признан недоступным ({failures} ошибок подряд)")
+        await redis_client.expire(key, SERVER_HEALTH_TTL)
+        return failures
+    except Exception as e:
+        logger.error(f"❌ Ошибка при сохранении состояния сервера {server_id}: {e}")
+        return 0
+
+
+async def record_server_success(server_id: int) -> None:
+    """Зафиксировать успешное обращение к панели сервера (сбрасывает счетчик ошибок)"""
+    if not redis_client:
+        return
+
+    key = SERVER_HEALTH_KEY.format(server_id=server_id)
+    try:
+        down_since = await redis_client.hget(key, "down_since")
+        await redis_client.delete(key)
+        if down_since:
+            downtime = int(time.time()) - int(down_since)
+            logger.info(f"🟢 Сервер {server_id} снова доступен (был недоступен {downtime} сек)")
+    except Exception as e:
+        logger.error(f"❌ Ошибка при сбросе состояния сервера {server_id}: {e}")
+
+
+async def is_server_down(server_id: int) -> bool:
+    """Проверить, считается ли сервер недоступным"""
+    if not redis_client:
+        return False
+
+    try:
+        down_since = await redis_client.hget(SERVER_HEALTH_KEY.format(server_id=server_id), "down_since")
+        return down_since is not None
+    except Exception as e:
+        logger.error(f"❌ Ошибка при получении состояния сервера {server_id}: {e}")
+        return False
+
+
+async def get_server_down_since(server_id: int) -> Optional[int]:
+    """Получить unix-время, с которого сервер считается недоступным (или None)"""
+    if not redis_client:
+        return None
+
+    try:
+        down_since = await redis_client.hget(SERVER_HEALTH_KEY.format(server_id=server_id), "down_since")
+        return int(down_since) if down_since else None
+    except Exception as e:
+        logger.error(f"❌ Ошибка при получении состояния сервера {server_id}: {e}")
+        return None
+
+
+async def probe_server(server) -> bool:
+    """
+    Проверить доступность панели сервера (вход в панель) и обновить его состояние
+
+    Args:
+        server: Объект Server
+
+    Returns:
+        True если панель доступна
+    """
+    from services.x3ui_api import get_x3ui_client
+
+    x3ui_client = get_x3ui_client(server.api_url, server.api_username, server.api_password, server.ssl_certificate)
+    try:
+        available = await x3ui_client.login(max_retries=1)
+    except Exception as e:
+        logger.debug(f"Проверка сервера {server.id} завершилась ошибкой: {e}")
+        available = False
+    finally:
+        try:
+            await x3ui_client.close()
+        except Exception:
+            pass
+
+    if available:
+        await record_server_success(server.id)
+    else:
+        await record_server_failure(server.id)
+    return available
@@ -3,7 +3,7 @@
 когда сервер почти заполнен
 """
 from services.scheduler import add_job
-from utils.db import get_all_servers, get_all_admins, count_active_subscriptions_by_server
+from utils.db import get_all_servers, get_all_admins, recount_servers_current_users
 from core.config import config
 import logging
 import html
@@ -112,8 +112,8 @@ async def check_server_load(server_id: int = None):
                 if server.max_users is None:
                     continue
                 
-                # Подсчитываем текущее количество активных подписок
-                current_users = await count_active_subscriptions_by_server(server.id)
+                # Количество активных подписок (счетчик ведется триггером БД)
+                current_users = server.current_users or 0
                 
                 # Вычисляем процент загрузки
                 if server.max_users == 0:
@@ -164,7 +164,16 @@ async def check_server_load(server_id: int = None):
 async def check_all_servers_load_job():
     """
     Периодическая задача для проверки загрузки всех серверов
+    
+    Перед проверкой счетчики current_users сверяются с фактическим количеством подписок.
     """
+    try:
+        corrected = await recount_servers_current_users()
+        if corrected:
+            logger.warning(f"⚠️ Исправлены счетчики пользователей на {corrected} серверах")
+    except Exception as e:
+        logger.error(f"Ошибка при пересчете пользователей на серверах: {e}")
+    
     await check_server_load()
 
 
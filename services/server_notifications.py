@@ -1,4 +1,5 @@
 """Модуль для отправки уведомлений пользователям об изменениях на серверах"""
+import asyncio
 import logging
 from typing import List, Set
 from utils.db import (
@@ -9,6 +10,7 @@ from utils.db import (
     get_subscription_identifier
 )
 from database.models import User, Subscription, Server
+from services.telegram_sender import telegram_sender, SendPriority
 
 logger = logging.getLogger(__name__)
 
@@ -64,6 +66,7 @@ async def notify_users_about_server_changes(
         # Отправляем уведомления каждому пользователю
         success_count = 0
         error_count = 0
+        pending_sends = []
         
         for user in users:
             try:
@@ -104,23 +107,33 @@ async def notify_users_about_server_changes(
                         status_emoji = "✅" if sub.status == "active" else "⏸️" if sub.status == "paused" else "❌"
                         text += f"{status_emoji} {sub_id_display}\n"
                 
-                # Отправляем сообщение
-                await bot.send_message(
-                    chat_id=int(user.tg_id),
-                    text=text,
-                    parse_mode="HTML"
-                )
-                
-                success_count += 1
-                
-                # Небольшая задержка, чтобы не превышать лимиты Telegram API
-                if success_count % 20 == 0:
-                    import asyncio
-                    await asyncio.sleep(1)
+                # Ставим сообщение в общую очередь отправки (лимиты Telegram соблюдает очередь)
+                chat_id = int(user.tg_id)
+                pending_sends.append((
+                    user.tg_id,
+                    telegram_sender.submit(
+                        lambda chat_id=chat_id, text=text: bot.send_message(
+                            chat_id=chat_id,
+                            text=text,
+                            parse_mode="HTML"
+                        ),
+                        chat_id=chat_id,
+                        priority=SendPriority.NOTIFICATION
+                    )
+                ))
                     
             except Exception as e:
                 error_count += 1
-                logger.error(f"❌ Ошибка при отправке уведомления пользователю {user.tg_id}: {e}")
+                logger.error(f"❌ Ошибка при подготовке уведомления пользователю {user.tg_id}: {e}")
+        
+        # Дожидаемся отправки всех уведомлений
+        results = await asyncio.gather(*(future for _, future in pending_sends), return_exceptions=True)
+        for (tg_id, _), result in zip(pending_sends, results):
+            if isinstance(result, Exception):
+                error_count += 1
+                logger.error(f"❌ Ошибка при отправке уведомления пользователю {tg_id}: {result}")
+            else:
+                success_count += 1
         
         logger.info(
             f"✅ Отправлено уведомлений об изменениях сервера {server.name}: "
@@ -14,19 +14,19 @@ from utils.db import (
 )
 from services.x3ui_api import get_x3ui_client
 from services.subscription import delete_subscription_completely
+from services.telegram_sender import telegram_sender, SendPriority
 from core.config import config
 from datetime import datetime, timedelta
 import logging
-import asyncio
-from aiogram.exceptions import TelegramNetworkError
-from aiohttp.client_exceptions import ClientConnectorError
 
 logger = logging.getLogger(__name__)
 
 
-async def send_message_with_retry(bot, chat_id, text, reply_markup=None, parse_mode="HTML", max_retries=3, retry_delay=2):
+async def send_message_with_retry(bot, chat_id, text, reply_markup=None, parse_mode="HTML"):
     """
-    Отправляет сообщение с повторными попытками при сетевых ошибках
+    Отправляет сообщение через общую очередь отправки
+    
+    Повторы при flood control и сетевых ошибках выполняет сессия бота (core.session).
     
     Args:
         bot: Экземпляр бота
@@ -34,40 +34,25 @@ async def send_message_with_retry(bot, chat_id, text, reply_markup=None, parse_m
         text: Текст сообщения
         reply_markup: Клавиатура (опционально)
         parse_mode: Режим парсинга (по умолчанию HTML)
-        max_retries: Максимальное количество попыток
-        retry_delay: Начальная задержка между попытками (секунды)
     
     Returns:
-        bool: True если сообщение отправлено успешно, False если не удалось после всех попыток
+        bool: True если сообщение отправлено успешно, False если не удалось
     """
-    for attempt in range(max_retries):
-        try:
-            await bot.send_message(
+    try:
+        await telegram_sender.call(
+            lambda: bot.send_message(
                 chat_id=int(chat_id),
                 text=text,
                 reply_markup=reply_markup,
                 parse_mode=parse_mode
-            )
-            return True
-        except (TelegramNetworkError, ClientConnectorError, ConnectionError, TimeoutError, asyncio.TimeoutError) as network_error:
-            if attempt < max_retries - 1:
-                logger.warning(
-                    f"⚠️ Сетевая ошибка при отправке сообщения (попытка {attempt + 1}/{max_retries}): "
-                    f"{type(network_error).__name__}: {network_error}. Повтор через {retry_delay} сек..."
-                )
-                await asyncio.sleep(retry_delay)
-                retry_delay *= 2  # Экспоненциальная задержка
-            else:
-                logger.error(
-                    f"❌ Не удалось отправить сообщение после {max_retries} попыток: "
-                    f"{type(network_error).__name__}: {network_error}"
-                )
-                return False
-        except Exception as e:
-            # Для других ошибок не делаем retry
-            logger.error(f"❌ Ошибка при отправке сообщения: {type(e).__name__}: {e}")
-            return False
-    return False
+            ),
+            chat_id=chat_id,
+            priority=SendPriority.NOTIFICATION
+        )
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка при отправке сообщения: {type(e).__name__}: {e}")
+        return False
 
 
 async def send_subscription_expired_notification(subscription):
@@ -324,11 +309,7 @@ async def send_subscription_expiring_soon_notification(subscription, days_left:
         
         if subscription.expire_date:
             # Преобразуем время в часовой пояс пользователя
-            expire_time = utc_to_user_timezone(
-                subscription.expire_date,
-                user=user,
-                language_code=user.language_code if hasattr(user, 'language_code') and user.language_code else None
-            )
+            expire_time = utc_to_user_timezone(subscription.expire_date, user=user)
             expire_time_str = expire_time.strftime("%d.%m.%Y в %H:%M")
             text += f"⏳ Подписка закончится: <b>{expire_time_str}</b>\n\n"
         
@@ -2,12 +2,17 @@
 Сервис для обработки неудачных попыток создания подписок
 Включает механизм повторных попыток с экспоненциальной задержкой
 """
+import asyncio
 import logging
+import random
+from collections import defaultdict
 from typing import Optional, Dict, Any
 from datetime import datetime, timedelta
 from database.base import async_session
 from database.models import FailedSubscriptionAttempt, Payment, User, Server
-from sqlalchemy import select
+from sqlalchemy import select, update, or_, and_
+from core.config import config
+from services.server_health import probe_server, is_server_down, record_server_success
 from handlers.buy.payment import handle_successful_payment
 from services.yookassa_service import yookassa_service
 from core.loader import bot
@@ -19,6 +24,28 @@ logger = logging.getLogger(__name__)
 # Интервалы между попытками (экспоненциальная задержка в минутах)
 RETRY_INTERVALS = [5, 15, 30, 60, 120]  # 5 мин, 15 мин, 30 мин, 1 час, 2 часа
 
+# Сколько припаркованных попыток одного сервера возвращать в очередь за один проход
+# после восстановления сервера, и с каким шагом (в секундах) разносить их во времени
+PARKED_RELEASE_BATCH = 10
+PARKED_RELEASE_SPACING_SECONDS = 20
+
+
+def get_retry_delay(attempt_count: int) -> timedelta:
+    """
+    Вычисляет задержку до следующей попытки: экспоненциальная задержка по RETRY_INTERVALS
+    с джиттером (от половины до полного интервала), чтобы попытки, упавшие одновременно,
+    не возвращались на сервер одной волной
+    
+    Args:
+        attempt_count: Количество уже выполненных попыток
+        
+    Returns:
+        Задержка до следующей попытки
+    """
+    minutes = RETRY_INTERVALS[min(attempt_count, len(RETRY_INTERVALS) - 1)]
+    seconds = minutes * 60
+    return timedelta(seconds=seconds / 2 + random.uniform(0, seconds / 2))
+
 
 async def create_failed_attempt(
     payment_id: int,
@@ -51,7 +78,7 @@ async def create_failed_attempt(
             select(FailedSubscriptionAttempt)
             .where(
                 FailedSubscriptionAttempt.payment_id == payment_id,
-                FailedSubscriptionAttempt.status.in_(["pending", "processing"])
+                FailedSubscriptionAttempt.status.in_(["pending", "processing", "parked"])
             )
             .order_by(FailedSubscriptionAttempt.created_at.desc())
             .limit(1)
@@ -69,8 +96,8 @@ async def create_failed_attempt(
             await session.commit()
             return existing_attempt
         
-        # Первая попытка повтора через 5 минут
-        next_attempt = datetime.utcnow() + timedelta(minutes=RETRY_INTERVALS[0])
+        # Первая попытка повтора через ~5 минут (с джиттером)
+        next_attempt = datetime.utcnow() + get_retry_delay(0)
         
         attempt = FailedSubscriptionAttempt(
             payment_id=payment_id,
@@ -124,6 +151,54 @@ async def get_pending_attempts(limit: int = 10) -> list[FailedSubscriptionAttemp
         return list(attempts)
 
 
+async def claim_pending_attempts(limit: int = 50) -> list[FailedSubscriptionAttempt]:
+    """
+    Атомарно забирает готовые к обработке попытки из очереди
+    
+    Строки блокируются через SELECT ... FOR UPDATE SKIP LOCKED и сразу переводятся
+    в статус processing, поэтому несколько обработчиков (или реплик бота) могут
+    разбирать очередь одновременно, не получая одни и те же попытки.
+    Попытки, зависшие в processing дольше RETRY_QUEUE_CLAIM_TIMEOUT_MINUTES
+    (например, после падения процесса), забираются повторно.
+    Попытки с исчерпанным лимитом тоже захватываются - для них выполняется возврат средств.
+    
+    Args:
+        limit: Максимальное количество попыток для захвата
+        
+    Returns:
+        Список захваченных FailedSubscriptionAttempt
+    """
+    async with async_session() as session:
+        now = datetime.utcnow()
+        stale_before = now - timedelta(minutes=config.RETRY_QUEUE_CLAIM_TIMEOUT_MINUTES)
+        result = await session.execute(
+            select(FailedSubscriptionAttempt)
+            .where(
+                or_(
+                    and_(
+                        FailedSubscriptionAttempt.status == "pending",
+                        FailedSubscriptionAttempt.next_attempt_at <= now
+                    ),
+                    and_(
+                        FailedSubscriptionAttempt.status == "processing",
+                        FailedSubscriptionAttempt.updated_at <= stale_before
+                    )
+                )
+            )
+            .order_by(FailedSubscriptionAttempt.created_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        attempts = list(result.scalars().all())
+        
+        for attempt in attempts:
+            attempt.status = "processing"
+            attempt.updated_at = now
+        
+        await session.commit()
+        return attempts
+
+
 async def update_attempt_status(
     attempt_id: int,
     status: str,
@@ -135,7 +210,7 @@ async def update_attempt_status(
     
     Args:
         attempt_id: ID попытки
-        status: Новый статус (pending, processing, completed, failed, refunded)
+        status: Новый статус (pending, processing, parked, completed, failed, refunded)
         error_message: Обновленное сообщение об ошибке (опционально)
         refund_id: ID возврата средств (опционально)
     """
@@ -183,22 +258,136 @@ async def increment_attempt_count(attempt_id: int) -> None:
         
         attempt.attempt_count += 1
         
-        # Определяем интервал для следующей попытки (экспоненциальная задержка)
-        if attempt.attempt_count < len(RETRY_INTERVALS):
-            minutes = RETRY_INTERVALS[attempt.attempt_count]
-        else:
-            # Если превысили максимальное количество интервалов, используем последний
-            minutes = RETRY_INTERVALS[-1]
+        # Определяем интервал для следующей попытки (экспоненциальная задержка с джиттером)
+        delay = get_retry_delay(attempt.attempt_count)
         
-        attempt.next_attempt_at = datetime.utcnow() + timedelta(minutes=minutes)
+        attempt.next_attempt_at = datetime.utcnow() + delay
         attempt.updated_at = datetime.utcnow()
         
         await session.commit()
         
         logger.info(
             f"🔄 Попытка {attempt_id}: счетчик увеличен до {attempt.attempt_count}, "
-            f"следующая попытка через {minutes} минут"
+            f"следующая попытка через {int(delay.total_seconds() // 60)} минут"
+        )
+
+
+async def park_attempts(attempt_ids: list[int], reason: str) -> None:
+    """
+    Паркует попытки недоступного сервера: они не обрабатываются и не расходуют
+    лимит попыток, пока сервер не восстановится (но не дольше RETRY_PARK_MAX_HOURS
+    с создания попытки, см. claim_expired_parked_attempts)
+    
+    Args:
+        attempt_ids: ID попыток
+        reason: Причина парковки (сохраняется в error_message)
+    """
+    if not attempt_ids:
+        return
+    
+    async with async_session() as session:
+        await session.execute(
+            update(FailedSubscriptionAttempt)
+            .where(FailedSubscriptionAttempt.id.in_(attempt_ids))
+            .values(status="parked", error_message=reason, updated_at=datetime.utcnow())
+        )
+        await session.commit()
+    
+    logger.info(f"🅿️ Припарковано попыток: {len(attempt_ids)} ({reason})")
+
+
+async def claim_expired_parked_attempts(limit: int = 50) -> list[FailedSubscriptionAttempt]:
+    """
+    Атомарно забирает припаркованные попытки, сервер которых не восстановился
+    за RETRY_PARK_MAX_HOURS с момента создания попытки
+    
+    Попытки переводятся в processing (как в claim_pending_attempts), чтобы возврат
+    средств по ним выполнил только один обработчик.
+    
+    Args:
+        limit: Максимальное количество попыток для захвата
+        
+    Returns:
+        Список захваченных FailedSubscriptionAttempt
+    """
+    async with async_session() as session:
+        now = datetime.utcnow()
+        deadline = now - timedelta(hours=config.RETRY_PARK_MAX_HOURS)
+        result = await session.execute(
+            select(FailedSubscriptionAttempt)
+            .where(
+                FailedSubscriptionAttempt.status == "parked",
+                FailedSubscriptionAttempt.created_at <= deadline
+            )
+            .order_by(FailedSubscriptionAttempt.created_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        attempts = list(result.scalars().all())
+        
+        for attempt in attempts:
+            attempt.status = "processing"
+            attempt.updated_at = now
+        
+        await session.commit()
+        return attempts
+
+
+async def release_parked_attempts() -> int:
+    """
+    Возвращает в очередь припаркованные попытки серверов, которые снова доступны
+    
+    Доступность проверяется входом в панель. За один проход на сервер возвращается
+    не больше PARKED_RELEASE_BATCH попыток, а их next_attempt_at разносится с шагом
+    PARKED_RELEASE_SPACING_SECONDS, чтобы не нагрузить только что поднявшуюся панель.
+    
+    Returns:
+        Количество возвращенных в очередь попыток
+    """
+    from services.server_health import probe_server
+    from utils.db import get_server_by_id
+    
+    async with async_session() as session:
+        result = await session.execute(
+            select(FailedSubscriptionAttempt.server_id)
+            .where(FailedSubscriptionAttempt.status == "parked")
+            .distinct()
         )
+        server_ids = [row[0] for row in result.all()]
+    
+    released = 0
+    for server_id in server_ids:
+        server = await get_server_by_id(server_id)
+        if server and not await probe_server(server):
+            continue
+        
+        async with async_session() as session:
+            result = await session.execute(
+                select(FailedSubscriptionAttempt)
+                .where(
+                    FailedSubscriptionAttempt.server_id == server_id,
+                    FailedSubscriptionAttempt.status == "parked"
+                )
+                .order_by(FailedSubscriptionAttempt.created_at)
+                .limit(PARKED_RELEASE_BATCH)
+                .with_for_update(skip_locked=True)
+            )
+            attempts = list(result.scalars().all())
+            
+            now = datetime.utcnow()
+            for index, attempt in enumerate(attempts):
+                offset = index * PARKED_RELEASE_SPACING_SECONDS + random.uniform(0, PARKED_RELEASE_SPACING_SECONDS)
+                attempt.status = "pending"
+                attempt.next_attempt_at = now + timedelta(seconds=offset)
+                attempt.updated_at = now
+            
+            await session.commit()
+        
+        if attempts:
+            released += len(attempts)
+            logger.info(f"🟢 Сервер {server_id} доступен: возвращено в очередь {len(attempts)} припаркованных попыток")
+    
+    return released
 
 
 async def retry_subscription_creation(attempt: FailedSubscriptionAttempt) -> bool:
@@ -240,23 +429,40 @@ async def retry_subscription_creation(attempt: FailedSubscriptionAttempt) -> boo
                     await update_attempt_status(attempt.id, "completed")
                     return True
             
+            # handle_successful_payment ожидает Telegram ID, а в попытке хранится ID пользователя в БД
+            result = await session.execute(
+                select(User.tg_id).where(User.id == attempt.user_id)
+            )
+            user_tg_id = result.scalar_one_or_none()
+            if not user_tg_id:
+                logger.error(f"❌ Пользователь {attempt.user_id} не найден")
+                await update_attempt_status(
+                    attempt.id,
+                    "failed",
+                    error_message="Пользователь не найден"
+                )
+                return False
+            
             # Обновляем статус на "processing"
             await update_attempt_status(attempt.id, "processing")
             
             # Пытаемся создать/продлить подписку
             # Используем ту же функцию, что и при успешной оплате
-            # НО: передаем флаг, что это повторная попытка, чтобы избежать бесконечного цикла
+            # НО: передаем флаг, что это повторная попытка, чтобы ошибка вернулась сюда,
+            # а не создавала новую запись в очереди
             await handle_successful_payment(
                 payment_id=attempt.payment_id,
-                user_id=attempt.user_id,
+                user_id=int(user_tg_id),
                 server_id=attempt.server_id,
                 message_id=None,  # Не отправляем сообщения при повторных попытках
                 subscription_id=attempt.subscription_id if attempt.is_renewal else None,
-                is_renewal=attempt.is_renewal
+                is_renewal=attempt.is_renewal,
+                raise_on_provisioning_error=True
             )
             
             # Если дошли сюда без исключения, считаем успешным
             await update_attempt_status(attempt.id, "completed")
+            await record_server_success(attempt.server_id)
             logger.info(f"✅ Успешно обработана повторная попытка {attempt.id}")
             return True
             
@@ -267,6 +473,11 @@ async def retry_subscription_creation(attempt: FailedSubscriptionAttempt) -> boo
         )
         logger.error(traceback.format_exc())
         
+        # Если панель сервера не отвечает, попытку не расходуем - паркуем до его восстановления
+        if await _is_server_unreachable(attempt.server_id):
+            await park_attempts([attempt.id], f"Сервер недоступен: {error_msg}")
+            return False
+        
         # Обновляем статус обратно на pending и увеличиваем счетчик
         await update_attempt_status(attempt.id, "pending", error_message=error_msg)
         await increment_attempt_count(attempt.id)
@@ -274,10 +485,107 @@ async def retry_subscription_creation(attempt: FailedSubscriptionAttempt) -> boo
         return False
 
 
+async def _is_server_unreachable(server_id: int) -> bool:
+    """
+    Проверить панель сервера после ошибки и вернуть True, если она не отвечает
+    
+    Достаточно одной неудачной проверки: порог SERVER_DOWN_FAILURE_THRESHOLD нужен,
+    чтобы признать сервер недоступным для всех, а попытка пользователя не должна
+    расходоваться уже на первой ошибке из-за сбоя сервера.
+    """
+    from utils.db import get_server_by_id
+    
+    try:
+        server = await get_server_by_id(server_id)
+        if not server:
+            return False
+        return not await probe_server(server)
+    except Exception as e:
+        logger.error(f"❌ Ошибка при проверке доступности сервера {server_id}: {e}")
+        return False
+
+
+async def _process_claimed_attempt(attempt: FailedSubscriptionAttempt, stats: Dict[str, int]) -> None:
+    """
+    Обрабатывает одну захваченную попытку и обновляет статистику
+    
+    Args:
+        attempt: Захваченная попытка (статус processing)
+        stats: Общий словарь статистики текущего прохода
+    """
+    stats["processed"] += 1
+    
+    # Проверяем, не превышен ли лимит попыток
+    if attempt.attempt_count >= attempt.max_attempts:
+        logger.warning(
+            f"⚠️ Попытка {attempt.id} достигла максимума попыток "
+            f"({attempt.attempt_count}/{attempt.max_attempts})"
+        )
+        stats["max_attempts_reached"] += 1
+        
+        # Помечаем как failed и пытаемся вернуть средства
+        await handle_failed_after_max_attempts(attempt)
+        return
+    
+    # Пытаемся обработать
+    success = await retry_subscription_creation(attempt)
+    
+    if success:
+        stats["succeeded"] += 1
+    else:
+        stats["failed"] += 1
+
+
+async def _process_server_attempts(
+    server_id: int,
+    attempts: list[FailedSubscriptionAttempt],
+    stats: Dict[str, int]
+) -> None:
+    """
+    Обрабатывает попытки одного сервера с ограничением параллельности,
+    чтобы не перегружать панель 3x-ui после ее восстановления
+    
+    Args:
+        server_id: ID сервера
+        attempts: Попытки, относящиеся к этому серверу
+        stats: Общий словарь статистики текущего прохода
+    """
+    # Сервер недоступен - не тратим попытки, паркуем их до восстановления
+    if await is_server_down(server_id):
+        await park_attempts(
+            [attempt.id for attempt in attempts],
+            "Сервер недоступен, ожидание восстановления"
+        )
+        stats["parked"] += len(attempts)
+        return
+    
+    semaphore = asyncio.Semaphore(max(1, config.RETRY_QUEUE_SERVER_CONCURRENCY))
+    
+    async def run(attempt: FailedSubscriptionAttempt) -> None:
+        async with semaphore:
+            try:
+                await _process_claimed_attempt(attempt, stats)
+            except Exception as e:
+                logger.error(f"❌ Ошибка при обработке попытки {attempt.id} (сервер {server_id}): {e}")
+                logger.error(traceback.format_exc())
+                # Возвращаем попытку в очередь, чтобы она не зависла в processing. Попытка
+                # засчитывается и откладывается, иначе этот же проход сразу забрал бы ее снова
+                await update_attempt_status(attempt.id, "pending", error_message=str(e))
+                await increment_attempt_count(attempt.id)
+    
+    await asyncio.gather(*(run(attempt) for attempt in attempts))
+
+
 async def process_retry_queue() -> Dict[str, int]:
     """
     Обрабатывает очередь повторных попыток
     
+    Попытки захватываются пачками по RETRY_QUEUE_BATCH_SIZE, группируются по серверу
+    и обрабатываются параллельно (не более RETRY_QUEUE_SERVER_CONCURRENCY одновременно
+    на один сервер). Очередь разбирается пачками до тех пор, пока в ней есть готовые попытки.
+    Попытки недоступных серверов паркуются и постепенно возвращаются после восстановления;
+    если сервер не восстановился за RETRY_PARK_MAX_HOURS, выполняется возврат средств.
+    
     Returns:
         Словарь со статистикой обработки
     """
@@ -285,43 +593,61 @@ async def process_retry_queue() -> Dict[str, int]:
         "processed": 0,
         "succeeded": 0,
         "failed": 0,
-        "max_attempts_reached": 0
+        "max_attempts_reached": 0,
+        "parked": 0,
+        "park_expired": 0
     }
     
+    batch_size = max(1, config.RETRY_QUEUE_BATCH_SIZE)
+    
     try:
-        # Получаем готовые к обработке попытки
-        attempts = await get_pending_attempts(limit=10)
+        # Возвращаем в очередь попытки серверов, которые снова доступны
+        await release_parked_attempts()
         
-        logger.info(f"🔄 Обработка очереди повторных попыток: найдено {len(attempts)} попыток")
-        
-        for attempt in attempts:
-            stats["processed"] += 1
-            
-            # Проверяем, не превышен ли лимит попыток
-            if attempt.attempt_count >= attempt.max_attempts:
+        # Сервер не восстановился за отведенное время - возвращаем средства
+        while True:
+            expired = await claim_expired_parked_attempts(limit=batch_size)
+            for attempt in expired:
                 logger.warning(
-                    f"⚠️ Попытка {attempt.id} достигла максимума попыток "
-                    f"({attempt.attempt_count}/{attempt.max_attempts})"
+                    f"⚠️ Попытка {attempt.id}: сервер {attempt.server_id} недоступен дольше "
+                    f"{config.RETRY_PARK_MAX_HOURS} ч, выполняется возврат средств"
                 )
-                stats["max_attempts_reached"] += 1
-                
-                # Помечаем как failed и пытаемся вернуть средства
                 await handle_failed_after_max_attempts(attempt)
-                continue
+            stats["park_expired"] += len(expired)
+            if len(expired) < batch_size:
+                break
+        
+        while True:
+            # Захватываем готовые к обработке попытки
+            attempts = await claim_pending_attempts(limit=batch_size)
+            if not attempts:
+                break
+            
+            attempts_by_server: Dict[int, list[FailedSubscriptionAttempt]] = defaultdict(list)
+            for attempt in attempts:
+                attempts_by_server[attempt.server_id].append(attempt)
+            
+            logger.info(
+                f"🔄 Обработка очереди повторных попыток: захвачено {len(attempts)} попыток "
+                f"на {len(attempts_by_server)} серверах"
+            )
             
-            # Пытаемся обработать
-            success = await retry_subscription_creation(attempt)
+            await asyncio.gather(*(
+                _process_server_attempts(server_id, server_attempts, stats)
+                for server_id, server_attempts in attempts_by_server.items()
+            ))
             
-            if success:
-                stats["succeeded"] += 1
-            else:
-                stats["failed"] += 1
+            # Неполная пачка - очередь разобрана
+            if len(attempts) < batch_size:
+                break
         
-        if stats["processed"] > 0:
+        if stats["processed"] > 0 or stats["park_expired"] > 0:
             logger.info(
                 f"📊 Статистика обработки: обработано={stats['processed']}, "
                 f"успешно={stats['succeeded']}, неудачно={stats['failed']}, "
-                f"достигнут максимум={stats['max_attempts_reached']}"
+                f"достигнут максимум={stats['max_attempts_reached']}, "
+                f"припарковано={stats['parked']}, "
+                f"возврат после парковки={stats['park_expired']}"
             )
         
         return stats
@@ -339,14 +665,16 @@ def start_subscription_retry_handler():
     from services.scheduler import add_job
     
     # Добавляем задачу обработки очереди повторных попыток
-    # Проверяем очередь каждые 5 минут
+    # Проверяем очередь каждую минуту (время следующей попытки задается next_attempt_at)
+    # max_instances=1: следующий проход не стартует, пока текущий разбирает очередь
     add_job(
         process_retry_queue,
         trigger="interval",
-        minutes=5,
-        id="process_subscription_retry_queue"
+        minutes=1,
+        id="process_subscription_retry_queue",
+        max_instances=1
     )
-    logger.info("✅ Задача обработки повторных попыток создания подписок добавлена (каждые 5 минут)")
+    logger.info("✅ Задача обработки повторных попыток создания подписок добавлена (каждую минуту)")
 
 
 async def handle_failed_after_max_attempts(attempt: FailedSubscriptionAttempt) -> None:
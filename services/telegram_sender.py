@@ -0,0 +1,254 @@
+"""
+Центральная очередь исходящих сообщений Telegram с ограничением скорости и приоритетами
+
+Все массовые отправки (рассылки, уведомления) ставятся в одну очередь. Воркеры берут
+задачи по приоритету и соблюдают глобальный лимит и лимит на один чат (token bucket),
+а при TelegramRetryAfter приостанавливают уведомления и рассылки на указанное Telegram
+время. Подтверждения оплаты, выдача ключей и ответы пользователю паузу не ждут.
+Глобальный лимит ниже лимита Telegram, поэтому интерактивные ответы хендлеров,
+которые отправляются напрямую, не упираются в flood control.
+"""
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Optional
+from aiogram.exceptions import TelegramRetryAfter
+from core.config import config
+from core.session import raise_on_flood_control
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз повторять отправку после TelegramRetryAfter
+MAX_RETRY_AFTER_ATTEMPTS = 5
+
+# Сколько чатов хранить в памяти для лимита на чат
+MAX_TRACKED_CHATS = 10000
+
+
+class SendPriority(IntEnum):
+    """Приоритет отправки (меньше - важнее)"""
+    CRITICAL = 0  # Подтверждения оплаты, выдача ключей
+    INTERACTIVE = 1  # Ответы пользователю, отправленные через очередь
+    NOTIFICATION = 2  # Уведомления об истечении подписок, изменениях серверов
+    BULK = 3  # Рассылки
+
+
+# С какого приоритета задачи ждут глобальную паузу после flood control: важные отправки
+# не должны задерживаться из-за ограничения, полученного рассылкой
+PAUSABLE_PRIORITY = SendPriority.NOTIFICATION
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self) -> float:
+        """
+        Забрать токен
+
+        Returns:
+            0, если токен получен, иначе сколько секунд подождать до появления токена
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+@dataclass(order=True)
+class _SendJob:
+    priority: int
+    seq: int
+    send: Callable[[], Awaitable[Any]] = field(compare=False)
+    chat_id: Optional[int] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    retry_after_attempts: int = field(default=0, compare=False)
+
+
+class TelegramSender:
+    """Диспетчер исходящих сообщений"""
+
+    def __init__(self, global_rate: float, per_chat_rate: float, workers: int):
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.workers_count = workers
+        self._chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: list[asyncio.Task] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+
+    def _ensure_started(self) -> None:
+        """Запустить воркеры в текущем event loop (лениво, при первой отправке)"""
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._workers = [task for task in self._workers if not task.done()]
+        while len(self._workers) < self.workers_count:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Небольшой запас, чтобы 2-3 сообщения подряд (например, фото + меню) уходили сразу
+            bucket = TokenBucket(self.per_chat_rate, capacity=3)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > MAX_TRACKED_CHATS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _requeue_later(self, job: _SendJob, delay: float) -> None:
+        """Вернуть задачу в очередь через delay секунд, не занимая воркер ожиданием"""
+        loop = asyncio.get_running_loop()
+        loop.call_later(delay, self._queue.put_nowait, job)
+
+    async def _worker(self) -> None:
+        while True:
+            job: _SendJob = await self._queue.get()
+            try:
+                if job.future.done():
+                    continue
+
+                # Глобальная пауза после TelegramRetryAfter (только уведомления и рассылки)
+                pause = self._paused_until - time.monotonic()
+                if pause > 0 and job.priority >= PAUSABLE_PRIORITY:
+                    self._requeue_later(job, pause)
+                    continue
+
+                # Лимит на чат: не ждем в воркере, а откладываем задачу
+                if job.chat_id is not None:
+                    wait = self._chat_bucket(job.chat_id).reserve()
+                    if wait > 0:
+                        self._requeue_later(job, wait)
+                        continue
+
+                # Глобальный лимит: ждем токен (порядок приоритетов сохраняется)
+                wait = self.global_bucket.reserve()
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self.global_bucket.reserve()
+
+                # Сессия бота не ждет retry_after внутри воркера: задачу откладывает очередь,
+                # и воркер сразу берет следующую (например, CRITICAL во время паузы рассылки)
+                flood_token = raise_on_flood_control.set(True)
+                try:
+                    result = await job.send()
+                except TelegramRetryAfter as e:
+                    job.retry_after_attempts += 1
+                    self.pause(e.retry_after)
+                    logger.warning(
+                        f"⚠️ Flood control Telegram: пауза отправки на {e.retry_after} сек "
+                        f"(чат {job.chat_id}, попытка {job.retry_after_attempts}/{MAX_RETRY_AFTER_ATTEMPTS})"
+                    )
+                    if job.retry_after_attempts >= MAX_RETRY_AFTER_ATTEMPTS:
+                        job.future.set_exception(e)
+                    else:
+                        self._requeue_later(job, e.retry_after)
+                    continue
+                except Exception as e:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                    continue
+                finally:
+                    raise_on_flood_control.reset(flood_token)
+
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка в воркере очереди отправки: {e}")
+            finally:
+                self._queue.task_done()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Приостановить уведомления и рассылки в очереди (после flood control Telegram)
+
+        Задачи CRITICAL и INTERACTIVE продолжают отправляться с учетом лимитов; если
+        ограничение получат они сами, задача повторяется через retry_after.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def submit(
+        self,
+        send: Callable[[], Awaitable[Any]],
+        chat_id: Optional[int] = None,
+        priority: SendPriority = SendPriority.NOTIFICATION
+    ) -> asyncio.Future:
+        """
+        Поставить отправку в очередь
+
+        Args:
+            send: Функция без аргументов, возвращающая корутину вызова Bot API
+                  (вызывается в момент отправки, поэтому может быть вызвана повторно)
+            chat_id: ID чата для лимита на чат
+            priority: Приоритет отправки
+
+        Returns:
+            Future с результатом вызова (или исключением)
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_SendJob(
+            priority=int(priority),
+            seq=next(self._seq),
+            send=send,
+            chat_id=int(chat_id) if chat_id is not None else None,
+            future=future
+        ))
+        return future
+
+    async def call(
+        self,
+        send: Callable[[], Awaitable[Any]],
+        chat_id: Optional[int] = None,
+        priority: SendPriority = SendPriority.NOTIFICATION
+    ) -> Any:
+        """Поставить отправку в очередь и дождаться результата"""
+        return await self.submit(send, chat_id=chat_id, priority=priority)
+
+    async def send_message(
+        self,
+        chat_id: int,
+        text: str,
+        priority: SendPriority = SendPriority.NOTIFICATION,
+        **kwargs
+    ):
+        """Отправить текстовое сообщение через очередь"""
+        from core.loader import bot
+        return await self.call(
+            lambda: bot.send_message(chat_id=int(chat_id), text=text, **kwargs),
+            chat_id=chat_id,
+            priority=priority
+        )
+
+    async def stop(self) -> None:
+        """Остановить воркеры"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+telegram_sender = TelegramSender(
+    global_rate=config.TELEGRAM_GLOBAL_RATE,
+    per_chat_rate=config.TELEGRAM_PER_CHAT_RATE,
+    workers=config.TELEGRAM_SEND_WORKERS
+)
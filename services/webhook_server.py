@@ -0,0 +1,153 @@
+"""
+Встроенный HTTP-сервер для режима webhook
+
+Принимает обновления Telegram (с проверкой секретного токена), уведомления YooKassa
+и отдает эндпоинты /health и /ready для балансировщика и оркестратора.
+Несколько реплик бота могут работать за одним балансировщиком: состояние FSM,
+кэш и данные проверки платежей хранятся в Redis.
+"""
+import asyncio
+import logging
+from urllib.parse import urlparse
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from sqlalchemy import text
+from core.config import config
+
+logger = logging.getLogger(__name__)
+
+# Таймаут проверок готовности (секунды)
+READINESS_CHECK_TIMEOUT = 3
+
+# Задачи обработки уведомлений YooKassa (храним ссылки, чтобы задачи не собрал GC)
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def health_handler(request: web.Request) -> web.Response:
+    """Liveness: процесс запущен и обрабатывает запросы (и счетчики кэша в памяти процесса)"""
+    from utils.cache import CacheService
+    return web.json_response({"status": "ok", "local_cache": CacheService.local_stats()})
+
+
+async def readiness_handler(request: web.Request) -> web.Response:
+    """Readiness: доступны БД и Redis"""
+    from database.base import engine
+    from core.storage import redis_client
+
+    checks = {}
+
+    try:
+        async with asyncio.timeout(READINESS_CHECK_TIMEOUT):
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        checks["database"] = "ok"
+    except Exception as e:
+        checks["database"] = f"error: {type(e).__name__}"
+
+    try:
+        if not redis_client:
+            raise RuntimeError("Redis не настроен")
+        async with asyncio.timeout(READINESS_CHECK_TIMEOUT):
+            await redis_client.ping()
+        checks["redis"] = "ok"
+    except Exception as e:
+        checks["redis"] = f"error: {type(e).__name__}"
+
+    ready = all(value == "ok" for value in checks.values())
+    return web.json_response(
+        {"status": "ready" if ready else "not_ready", "checks": checks},
+        status=200 if ready else 503
+    )
+
+
+async def yookassa_webhook_handler(request: web.Request) -> web.Response:
+    """
+    Уведомление YooKassa об изменении статуса платежа
+
+    Тело уведомления используется только для получения ID платежа: статус заново
+    запрашивается в YooKassa (check_payment_job), поэтому поддельное уведомление
+    не может подтвердить неоплаченный платеж.
+    """
+    from services.payment_checker import check_payment_job
+
+    try:
+        payload = await request.json()
+    except Exception:
+        return web.Response(status=400)
+
+    payment_object = payload.get("object") if isinstance(payload, dict) else None
+    yookassa_payment_id = payment_object.get("id") if isinstance(payment_object, dict) else None
+    if not yookassa_payment_id:
+        return web.Response(status=400)
+
+    logger.info(f"💳 Уведомление YooKassa: {payload.get('event')} для платежа {yookassa_payment_id}")
+
+    # Отвечаем сразу, обработка идет в фоне (YooKassa повторяет уведомление при долгом ответе)
+    task = asyncio.create_task(check_payment_job(str(yookassa_payment_id)))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return web.Response(status=200)
+
+
+def get_telegram_webhook_url() -> str:
+    """Публичный URL webhook Telegram"""
+    return f"{config.TELEGRAM_WEBHOOK_BASE_URL}{config.TELEGRAM_WEBHOOK_PATH}"
+
+
+def create_webhook_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """Создать aiohttp-приложение с обработчиками webhook"""
+    app = web.Application()
+
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=config.TELEGRAM_WEBHOOK_SECRET or None
+    ).register(app, path=config.TELEGRAM_WEBHOOK_PATH)
+
+    app.router.add_get("/health", health_handler)
+    app.router.add_get("/ready", readiness_handler)
+
+    if config.YOOKASSA_WEBHOOK_ENABLED:
+        yookassa_path = urlparse(config.WEBHOOK_URL).path if config.WEBHOOK_URL else ""
+        if yookassa_path and yookassa_path != config.TELEGRAM_WEBHOOK_PATH:
+            app.router.add_post(yookassa_path, yookassa_webhook_handler)
+            logger.info(f"💳 Уведомления YooKassa принимаются по пути {yookassa_path}")
+        else:
+            logger.warning("⚠️ YOOKASSA_WEBHOOK_ENABLED=true, но WEBHOOK_URL не задан или совпадает с путем Telegram")
+
+    # Запуск и остановка диспетчера (startup/shutdown хендлеры) вместе с приложением
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """Зарегистрировать webhook в Telegram и запустить HTTP-сервер"""
+    if not config.TELEGRAM_WEBHOOK_BASE_URL:
+        raise RuntimeError("BOT_MODE=webhook требует TELEGRAM_WEBHOOK_BASE_URL")
+    if not config.TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook требует TELEGRAM_WEBHOOK_SECRET")
+
+    app = create_webhook_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=config.WEBHOOK_SERVER_HOST, port=config.WEBHOOK_SERVER_PORT)
+    await site.start()
+    logger.info(f"🌐 HTTP-сервер запущен на {config.WEBHOOK_SERVER_HOST}:{config.WEBHOOK_SERVER_PORT}")
+
+    # Все реплики регистрируют один и тот же URL, повторный вызов безопасен.
+    # Webhook не удаляется при остановке, чтобы не отключить остальные реплики.
+    await bot.set_webhook(
+        url=get_telegram_webhook_url(),
+        secret_token=config.TELEGRAM_WEBHOOK_SECRET,
+        max_connections=config.TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=False
+    )
+    logger.info(f"✅ Webhook Telegram зарегистрирован: {get_telegram_webhook_url()}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -12,6 +12,7 @@ import os
 from typing import Optional, Dict, Any, List
 from datetime import datetime, timedelta
 from core.config import config
+from utils.tracing import span, TraceStages
 
 logger = logging.getLogger(__name__)
 
@@ -139,6 +140,12 @@ class X3UIAPI:
         Returns:
             True если успешно, False в противном случае
         """
+        # Время входа в панель учитывается в трассировке покупки
+        with span(TraceStages.X3UI_LOGIN):
+            return await self._login(max_retries)
+    
+    async def _login(self, max_retries: int) -> bool:
+        """Аутентификация в панели с повторными попытками (см. login)"""
         last_error = None
         
         for attempt in range(1, max_retries + 1):
@@ -965,7 +972,8 @@ class X3UIAPI:
         days: int = 30,
         tg_id: Optional[str] = None,
         limit_ip: int = 3,
-        sub_id: Optional[str] = None
+        sub_id: Optional[str] = None,
+        enable: bool = True
     ) -> Dict[str, Any]:
         """
         Создает клиента во всех инбаундах на основе первого клиента каждого инбаунда.
@@ -980,6 +988,7 @@ class X3UIAPI:
             tg_id: Telegram ID пользователя (опционально)
             limit_ip: Лимит IP адресов
             sub_id: SubId для подписок (обязательно)
+            enable: Создать клиентов включенными (False - для пула заранее созданных клиентов)
             
         Returns:
             Словарь с результатами создания клиентов во всех инбаундах
@@ -1087,8 +1096,8 @@ class X3UIAPI:
                 if limit_ip is not None and protocol != "shadowsocks":
                     new_client["limitIp"] = limit_ip
                 
-                # Устанавливаем enable = True
-                new_client["enable"] = True
+                # Устанавливаем enable (False для клиентов из пула - включаются при покупке)
+                new_client["enable"] = enable
                 
                 # Устанавливаем expiryTime = 0 (бессрочная подписка, управление через enable/disable)
                 new_client["expiryTime"] = 0
@@ -1499,6 +1508,105 @@ class X3UIAPI:
         else:
             return result
     
+    async def activate_clients_by_sub_id(self, sub_id: str, tg_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Включает всех клиентов с указанным subID за один проход по inbounds.
+        Используется при выдаче клиента из пула: в отличие от update_all_clients_by_sub_id
+        список inbounds запрашивается один раз, а не для каждого клиента.
+        
+        Args:
+            sub_id: SubId подписки
+            tg_id: Telegram ID нового владельца (опционально)
+            
+        Returns:
+            Словарь с результатами включения клиентов
+        """
+        if not sub_id:
+            return {"error": True, "message": "sub_id обязателен", "error_type": "missing_sub_id"}
+        
+        inbounds = await self.get_inbounds()
+        if inbounds is None:
+            return {"error": True, "message": "Ошибка получения списка inbounds с сервера", "error_type": "connection"}
+        
+        results = {
+            "updated": [],
+            "errors": []
+        }
+        
+        session = await self._get_session()
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/json"
+        }
+        epoch = datetime.utcfromtimestamp(0)
+        current_time_ms = int((datetime.utcnow() - epoch).total_seconds() * 1000.0)
+        
+        for inbound in inbounds:
+            inbound_id = inbound.get("id")
+            protocol = inbound.get("protocol", "").lower()
+            settings_str = inbound.get("settings", "{}")
+            try:
+                settings = json.loads(settings_str) if isinstance(settings_str, str) else settings_str
+                clients = settings.get("clients", [])
+            except (json.JSONDecodeError, TypeError) as e:
+                logger.warning(f"⚠️ Ошибка парсинга settings для inbound {inbound_id}: {e}")
+                continue
+            
+            for client in clients:
+                if str(client.get("subId", "")).strip() != sub_id:
+                    continue
+                
+                client_email = client.get("email")
+                client_data = client.copy()
+                client_data["enable"] = True
+                client_data["updated_at"] = current_time_ms
+                if tg_id:
+                    client_data["tgId"] = int(tg_id) if protocol == "shadowsocks" and str(tg_id).isdigit() else str(tg_id)
+                
+                # Для Shadowsocks идентификатором клиента служит email
+                update_client_id = client_data.get("id") if protocol != "shadowsocks" else None
+                if not update_client_id:
+                    update_client_id = client_email
+                
+                data1 = {
+                    "id": inbound_id,
+                    "settings": json.dumps({"clients": [client_data]}, ensure_ascii=False)
+                }
+                url = f"{self.api_url}/panel/api/inbounds/updateClient/{update_client_id}"
+                
+                try:
+                    async with session.post(
+                        url,
+                        headers=headers,
+                        json=data1,
+                        allow_redirects=True,
+                        max_redirects=10,
+                        timeout=aiohttp.ClientTimeout(total=30, connect=10)
+                    ) as response:
+                        response_text = await response.text()
+                        if response.status in [200, 201]:
+                            results["updated"].append(client_email)
+                        else:
+                            results["errors"].append(f"{client_email}: {response.status} - {response_text[:200]}")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    results["errors"].append(f"{client_email}: {str(e)}")
+        
+        if not results["updated"]:
+            results["error"] = True
+            results["message"] = "; ".join(results["errors"]) or f"Не найдено клиентов с subID {sub_id}"
+            results["error_type"] = "not_found" if not results["errors"] else "api_error"
+        elif results["errors"]:
+            results["error"] = True
+            results["message"] = f"Включено {len(results['updated'])}, ошибок: {len(results['errors'])}"
+            results["error_type"] = "partial"
+        else:
+            results["error"] = False
+            results["message"] = f"Включено клиентов: {len(results['updated'])}"
+        
+        return results
+    
     async def disable_all_clients_by_sub_id(self, sub_id: str) -> Dict[str, Any]:
         """
         Отключает всех клиентов с указанным subID на всех инбаундах
@@ -6,6 +6,7 @@ import json
 from typing import Optional, Dict
 from yookassa import Configuration, Payment, Refund
 from core.config import config
+from utils.tracing import span, TraceStages
 import logging
 
 logger = logging.getLogger(__name__)
@@ -272,7 +273,8 @@ class YooKassaService:
                 raise ValueError("Не удалось создать receipt - это обязательное поле для платежей в России")
             
             # Всегда используем payment_data_with_receipt
-            payment = Payment.create(payment_data_with_receipt, idempotence_key)
+            with span(TraceStages.YOOKASSA_CREATE):
+                payment = Payment.create(payment_data_with_receipt, idempotence_key)
             
             if config.TEST_MODE:
                 logger.info(f"YooKassa payment created: id={payment.id}, status={payment.status}")
@@ -342,7 +344,8 @@ class YooKassaService:
         self._ensure_config()
         
         try:
-            payment = Payment.find_one(payment_id)
+            with span(TraceStages.YOOKASSA_STATUS):
+                payment = Payment.find_one(payment_id)
             
             status_data = {
                 "id": payment.id,
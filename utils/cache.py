@@ -1,58 +1,221 @@
 """
 Утилиты для кэширования данных в Redis
+
+Двухуровневый кэш: редко меняющиеся данные (каталог) дополнительно хранятся в памяти
+процесса (L1, LocalCache) перед Redis. При изменении или удалении ключа реплики бота
+сбрасывают свои копии по сообщению в канале Redis pub/sub (CacheInvalidationListener).
+
+Для данных, загружаемых из БД, используйте CacheService.get_or_load(): одновременные
+промахи по одному ключу выполняют одну загрузку, запись обновляется заранее с вероятностью,
+растущей к концу TTL, а отсутствующие в БД объекты кэшируются на короткое время.
+
+Инвалидация не использует KEYS: ключи удаляются точно по имени или по тегам - множествам
+Redis с ключами, относящимися к одной сущности (CacheTags). Удаление по паттерну
+(delete_pattern) идет пошагово через SCAN и нужно только для сброса без указания сущности.
 """
+import asyncio
+import fnmatch
 import json
 import logging
-from typing import Optional, Any, List
+import math
+import random
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Any, List, Callable, Awaitable, Union
 from core.storage import redis_client
 from datetime import timedelta
 
 logger = logging.getLogger(__name__)
 
+# Версия формата объектов каталога (utils.catalog) в кэше.
+# Увеличивается при изменении полей LocationDTO/ServerDTO/TariffDTO, чтобы новая версия бота
+# не читала записи старого формата (старые ключи удалятся по TTL).
+CATALOG_CACHE_VERSION = 1
+
+# Кэш в памяти процесса (L1): максимум записей и время жизни записи (секунды).
+# TTL ограничивает устаревание, если сообщение об инвалидации не дошло (обрыв связи с Redis)
+LOCAL_CACHE_MAX_SIZE = 1024
+LOCAL_CACHE_TTL = 60
+
+# Канал Redis pub/sub для сброса L1 на всех репликах
+CACHE_INVALIDATION_CHANNEL = "cache:invalidate"
+
+# Время жизни множества ключей тега (не меньше TTL любой записи кэша)
+CACHE_TAG_TTL = 86400
+
+# Ключей за один шаг SCAN и за одну команду UNLINK
+SCAN_BATCH_SIZE = 500
+
+# Коэффициент досрочного обновления записей get_or_load (0 - обновлять только после истечения TTL).
+# Чем больше, тем раньше (и чаще) запись обновляется до истечения
+CACHE_EARLY_REFRESH_BETA = 1.0
+
+# ID процесса в сообщениях инвалидации (свои сообщения не обрабатываются повторно)
+INSTANCE_ID = uuid.uuid4().hex
+
+_MISSING = object()
+
+# Загрузки get_or_load, выполняющиеся в этом процессе (ключ -> результат загрузки)
+_inflight_loads: dict[str, asyncio.Future] = {}
+
 
 class CacheKeys:
     """Ключи для кэширования"""
     # Локации
-    ACTIVE_LOCATIONS = "cache:locations:active"
-    LOCATION_BY_ID = "cache:location:{id}"
+    ACTIVE_LOCATIONS = f"cache:v{CATALOG_CACHE_VERSION}:locations:active"
+    LOCATION_BY_ID = f"cache:v{CATALOG_CACHE_VERSION}:location:{{id}}"
     
     # Серверы
-    ACTIVE_SERVERS = "cache:servers:active"
-    SERVERS_BY_LOCATION = "cache:servers:location:{location_id}"
-    SERVER_BY_ID = "cache:server:{id}"
+    ACTIVE_SERVERS = f"cache:v{CATALOG_CACHE_VERSION}:servers:active"
+    SERVERS_BY_LOCATION = f"cache:v{CATALOG_CACHE_VERSION}:servers:location:{{location_id}}"
+    SERVER_BY_ID = f"cache:v{CATALOG_CACHE_VERSION}:server:{{id}}"
     
     # Пользователи
     USER_BY_TG_ID = "cache:user:tg_id:{tg_id}"
     USER_SUBSCRIPTIONS = "cache:user:{user_id}:subscriptions"
+    # Язык и username, последними сохраненные в БД (чтобы не писать в БД на каждое обновление)
+    USER_LOCALE = "cache:user:locale:{tg_id}"
+    # Общее количество пользователей
+    USERS_COUNT = "cache:users:count"
     
     # Тарифы
-    TARIFF_BY_ID = "cache:tariff:{id}"
+    TARIFF_BY_ID = f"cache:v{CATALOG_CACHE_VERSION}:tariff:{{id}}"
+    
+    # Промокоды
+    PROMO_CODE_BY_CODE = "cache:promo:code:{code}"
+    
+    # Статистика админ-панели
+    ADMIN_STATS = "cache:admin:stats"
+
+
+class CacheTags:
+    """Теги (множества ключей кэша одной сущности) для точной инвалидации"""
+    # Ключи с данными пользователя (по ID в БД)
+    USER = "cache:tag:user:{user_id}"
+    # Ключи с данными локации: локация, ее серверы (в ServerDTO хранится локация)
+    LOCATION = "cache:tag:location:{location_id}"
+
+
+class LocalCache:
+    """
+    Кэш в памяти процесса (L1) с вытеснением давно не использованных записей (LRU) и TTL
+    
+    Значения хранятся без копирования - вызывающий код не должен изменять
+    полученные объекты (см. CacheService.get(local=True)).
+    """
+    
+    def __init__(self, max_size: int = LOCAL_CACHE_MAX_SIZE, ttl: int = LOCAL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: str) -> Any:
+        """Значение из L1 или _MISSING"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return _MISSING
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
+        ttl = min(ttl, self.ttl) if ttl else self.ttl
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+    
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+    
+    def delete_pattern(self, pattern: str) -> None:
+        for key in [key for key in self._data if fnmatch.fnmatchcase(key, pattern)]:
+            del self._data[key]
+    
+    def clear(self) -> None:
+        self._data.clear()
+    
+    def stats(self) -> dict:
+        """Счетчики попаданий, промахов и вытеснений"""
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+local_cache = LocalCache()
+
+
+def _invalidation_message(keys: Optional[List[str]] = None, pattern: Optional[str] = None) -> str:
+    return json.dumps({"sender": INSTANCE_ID, "keys": keys, "pattern": pattern})
 
 
 class CacheService:
     """Сервис для работы с кэшем"""
     
     @staticmethod
-    async def get(key: str) -> Optional[Any]:
-        """Получить значение из кэша"""
+    async def get(key: str, local: bool = False) -> Optional[Any]:
+        """
+        Получить значение из кэша
+        
+        local=True - сначала искать в памяти процесса (L1), при промахе - в Redis с сохранением в L1.
+        Только для редко меняющихся данных; полученное значение нельзя изменять.
+        """
+        if local:
+            value = local_cache.get(key)
+            if value is not _MISSING:
+                return value
         try:
             value = await redis_client.get(key)
             if value:
-                return json.loads(value)
+                value = json.loads(value)
+                if local:
+                    local_cache.set(key, value)
+                return value
             return None
         except Exception as e:
             logger.error(f"Ошибка при получении из кэша {key}: {e}")
             return None
     
     @staticmethod
-    async def set(key: str, value: Any, ttl: int = 300) -> bool:
-        """Установить значение в кэш с TTL (в секундах)"""
+    async def set(
+        key: str,
+        value: Any,
+        ttl: int = 300,
+        local: bool = False,
+        tags: Optional[List[str]] = None
+    ) -> bool:
+        """
+        Установить значение в кэш с TTL (в секундах)
+        
+        local=True - значение также сохраняется в L1, остальные реплики сбрасывают свою копию ключа.
+        tags - теги (CacheTags), по которым ключ будет удален в invalidate_tags().
+        Все команды отправляются одним pipeline.
+        """
+        if local:
+            local_cache.set(key, value, ttl)
         try:
-            await redis_client.setex(
-                key,
-                ttl,
-                json.dumps(value, default=str)
-            )
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.setex(key, ttl, json.dumps(value, default=str))
+            for tag in tags or ():
+                pipe.sadd(tag, key)
+                pipe.expire(tag, CACHE_TAG_TTL)
+            if local:
+                pipe.publish(CACHE_INVALIDATION_CHANNEL, _invalidation_message(keys=[key]))
+            await pipe.execute()
             return True
         except Exception as e:
             logger.error(f"Ошибка при установке в кэш {key}: {e}")
@@ -60,59 +223,269 @@ class CacheService:
     
     @staticmethod
     async def delete(key: str) -> bool:
-        """Удалить значение из кэша"""
+        """Удалить значение из кэша (в Redis и в L1 всех реплик)"""
+        return await CacheService.delete_many([key]) is not None
+    
+    @staticmethod
+    async def delete_many(keys: List[str]) -> Optional[int]:
+        """
+        Удалить ключи одним pipeline (в Redis и в L1 всех реплик)
+        
+        Returns:
+            Количество удаленных ключей Redis или None при ошибке
+        """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return 0
+        for key in keys:
+            local_cache.delete(key)
         try:
-            await redis_client.delete(key)
-            return True
+            pipe = redis_client.pipeline(transaction=False)
+            for start in range(0, len(keys), SCAN_BATCH_SIZE):
+                pipe.unlink(*keys[start:start + SCAN_BATCH_SIZE])
+            pipe.publish(CACHE_INVALIDATION_CHANNEL, _invalidation_message(keys=keys))
+            results = await pipe.execute()
+            return sum(results[:-1])
         except Exception as e:
-            logger.error(f"Ошибка при удалении из кэша {key}: {e}")
-            return False
+            logger.error(f"Ошибка при удалении из кэша {keys[:5]}: {e}")
+            return None
     
     @staticmethod
-    async def delete_pattern(pattern: str) -> int:
-        """Удалить все ключи по паттерну"""
+    async def invalidate_tags(*tags: str) -> int:
+        """
+        Удалить все ключи с указанными тегами (и сами теги)
+        
+        Два запроса к Redis независимо от количества ключей: чтение множеств тегов
+        и удаление ключей (UNLINK - память освобождается в фоне).
+        """
+        if not tags:
+            return 0
         try:
-            keys = await redis_client.keys(pattern)
-            if keys:
-                return await redis_client.delete(*keys)
+            pipe = redis_client.pipeline(transaction=False)
+            for tag in tags:
+                pipe.smembers(tag)
+            members = await pipe.execute()
+        except Exception as e:
+            logger.error(f"Ошибка при чтении тегов кэша {tags}: {e}")
             return 0
+        keys = [key for tag_keys in members for key in tag_keys]
+        deleted = await CacheService.delete_many(keys + list(tags))
+        return deleted or 0
+    
+    @staticmethod
+    async def delete_pattern(pattern: str) -> int:
+        """
+        Удалить все ключи по паттерну (в Redis и в L1 всех реплик)
+        
+        Ключи ищутся пошагово через SCAN (Redis не блокируется на время обхода всех ключей)
+        и удаляются пачками. Для сброса кэша одной сущности используйте теги (invalidate_tags).
+        """
+        local_cache.delete_pattern(pattern)
+        deleted = 0
+        try:
+            batch = []
+            async for key in redis_client.scan_iter(match=pattern, count=SCAN_BATCH_SIZE):
+                batch.append(key)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    deleted += await redis_client.unlink(*batch)
+                    batch = []
+            if batch:
+                deleted += await redis_client.unlink(*batch)
+            # Уведомляем реплики после удаления из Redis (как в delete_many): иначе они
+            # могли бы успеть перечитать в L1 еще не удаленные значения
+            await redis_client.publish(CACHE_INVALIDATION_CHANNEL, _invalidation_message(pattern=pattern))
+            return deleted
         except Exception as e:
             logger.error(f"Ошибка при удалении по паттерну {pattern}: {e}")
-            return 0
+            return deleted
+    
+    @staticmethod
+    async def get_or_load(
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: int = 300,
+        negative_ttl: Optional[int] = None,
+        local: bool = False,
+        tags: Optional[Union[List[str], Callable[[Any], Optional[List[str]]]]] = None,
+        beta: float = CACHE_EARLY_REFRESH_BETA
+    ) -> Any:
+        """
+        Получить значение из кэша или загрузить его (read-through) с защитой от лавины запросов к БД
+        
+        - Одновременные промахи по ключу в процессе ждут одну загрузку (single-flight)
+        - Запись обновляется досрочно с вероятностью, растущей к концу TTL и со временем
+          загрузки (XFetch), поэтому записи не истекают у всех обработчиков одновременно
+        - Результат None кэшируется на negative_ttl секунд (None - не кэшируется)
+        
+        В кэше хранится конверт {"v": значение, "d": время загрузки, "x": момент истечения},
+        поэтому ключ нужно читать только через get_or_load.
+        
+        Args:
+            key: Ключ кэша
+            loader: Функция загрузки значения (результат должен сериализоваться в JSON)
+            ttl: Время жизни записи (секунды)
+            negative_ttl: Время жизни записи об отсутствии значения (None - не кэшировать)
+            local: Хранить запись также в памяти процесса (см. get(local=True))
+            tags: Теги ключа или функция, возвращающая теги по загруженному значению
+            beta: Коэффициент досрочного обновления
+        """
+        entry = await CacheService.get(key, local=local)
+        if isinstance(entry, dict) and "x" in entry:
+            delta = entry.get("d", 0) * beta
+            # -ln(U) > 0: чем ближе к истечению и чем дольше загрузка, тем вероятнее обновление
+            if time.time() - delta * math.log(random.random() or 1e-12) < entry["x"]:
+                return entry["v"]
+        
+        inflight = _inflight_loads.get(key)
+        if inflight is not None:
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Отменена загрузка другого обработчика (а не текущий) - загружаем сами
+                if not inflight.cancelled():
+                    raise
+                return await CacheService.get_or_load(key, loader, ttl, negative_ttl, local, tags, beta)
+        
+        future = asyncio.get_running_loop().create_future()
+        _inflight_loads[key] = future
+        try:
+            started = time.monotonic()
+            value = await loader()
+            delta = time.monotonic() - started
+            
+            entry_ttl = ttl if value is not None else negative_ttl
+            if entry_ttl:
+                key_tags = tags(value) if callable(tags) else tags
+                await CacheService.set(
+                    key,
+                    {"v": value, "d": round(delta, 4), "x": time.time() + entry_ttl},
+                    ttl=entry_ttl,
+                    local=local,
+                    tags=key_tags
+                )
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие; без них - не выводим предупреждение asyncio
+            future.exception()
+            raise
+        finally:
+            _inflight_loads.pop(key, None)
+    
+    @staticmethod
+    def local_stats() -> dict:
+        """Счетчики кэша в памяти процесса (L1)"""
+        return local_cache.stats()
     
     @staticmethod
     async def invalidate_user_cache(user_id: int):
-        """Инвалидировать весь кэш пользователя"""
-        patterns = [
-            CacheKeys.USER_BY_TG_ID.format(tg_id="*"),
-            CacheKeys.USER_SUBSCRIPTIONS.format(user_id=user_id),
-        ]
-        for pattern in patterns:
-            await CacheService.delete_pattern(pattern)
+        """Инвалидировать кэш одного пользователя (ключи с тегом пользователя)"""
+        await CacheService.invalidate_tags(CacheTags.USER.format(user_id=user_id))
+        await CacheService.delete(CacheKeys.USER_SUBSCRIPTIONS.format(user_id=user_id))
     
     @staticmethod
-    async def invalidate_location_cache():
-        """Инвалидировать кэш локаций"""
-        patterns = [
-            CacheKeys.ACTIVE_LOCATIONS,
+    async def invalidate_location_cache(location_id: Optional[int] = None):
+        """
+        Инвалидировать кэш локаций (и серверов - в них хранится локация)
+        
+        Без location_id сбрасывается кэш всех локаций и серверов (через SCAN).
+        """
+        if location_id:
+            await CacheService.invalidate_tags(CacheTags.LOCATION.format(location_id=location_id))
+            await CacheService.delete(CacheKeys.ACTIVE_LOCATIONS)
+            return
+        
+        await CacheService.delete(CacheKeys.ACTIVE_LOCATIONS)
+        for pattern in (
             CacheKeys.LOCATION_BY_ID.format(id="*"),
-        ]
-        for pattern in patterns:
+            CacheKeys.SERVERS_BY_LOCATION.format(location_id="*"),
+            CacheKeys.SERVER_BY_ID.format(id="*"),
+        ):
             await CacheService.delete_pattern(pattern)
     
     @staticmethod
     async def invalidate_server_cache(server_id: Optional[int] = None, location_id: Optional[int] = None):
-        """Инвалидировать кэш серверов"""
-        patterns = []
+        """Инвалидировать кэш серверов (точные ключи, одним pipeline)"""
+        keys = [CacheKeys.ACTIVE_SERVERS]
         if server_id:
-            patterns.append(CacheKeys.SERVER_BY_ID.format(id=server_id))
+            keys.append(CacheKeys.SERVER_BY_ID.format(id=server_id))
         if location_id:
-            patterns.append(CacheKeys.SERVERS_BY_LOCATION.format(location_id=location_id))
-        patterns.append(CacheKeys.ACTIVE_SERVERS)
-        
-        for pattern in patterns:
-            await CacheService.delete_pattern(pattern)
+            keys.append(CacheKeys.SERVERS_BY_LOCATION.format(location_id=location_id))
+        await CacheService.delete_many(keys)
+
+    @staticmethod
+    async def invalidate_promo_code_cache(code: str):
+        """Инвалидировать кэш промокода"""
+        await CacheService.delete(CacheKeys.PROMO_CODE_BY_CODE.format(code=code.upper().strip()))
+
+
+class CacheInvalidationListener:
+    """
+    Подписка на канал инвалидации: сбрасывает записи L1, измененные другими репликами
+    
+    Запускается на каждой реплике. После переподключения к Redis L1 очищается полностью -
+    сообщения, отправленные за время обрыва, потеряны.
+    """
+    
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self) -> None:
+        if not redis_client:
+            logger.warning("⚠️ Redis не настроен - кэш в памяти сбрасывается только по TTL")
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self) -> None:
+        while True:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                local_cache.clear()
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message:
+                        self._handle(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Подписка на инвалидацию кэша прервана: {e}. Переподключение через 5 сек...")
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+    
+    @staticmethod
+    def _handle(data: str) -> None:
+        try:
+            payload = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        if payload.get("sender") == INSTANCE_ID:
+            return
+        for key in payload.get("keys") or ():
+            local_cache.delete(key)
+        if payload.get("pattern"):
+            local_cache.delete_pattern(payload["pattern"])
+
 
+cache_invalidation_listener = CacheInvalidationListener()
 
 # Глобальный экземпляр
 cache_service = CacheService()
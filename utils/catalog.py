@@ -0,0 +1,124 @@
+"""
+Неизменяемые объекты каталога (локации, серверы, тарифы) для кэширования в Redis
+
+Используются в пользовательских сценариях (покупка, профиль), где данные каталога
+только читаются. Объекты не связаны с сессией БД и сериализуются в JSON;
+для изменения данных используйте ORM-функции utils.db (update_*/delete_*).
+"""
+from dataclasses import dataclass, asdict
+from typing import Optional, Any
+from urllib.parse import urlparse
+
+
+def get_subscription_base_url(server) -> str:
+    """
+    Базовый URL ссылок подписки сервера (ссылка = {базовый URL}/{sub_id})
+
+    Используется sub_url из настроек сервера, иначе - старый формат http://{IP панели}:2096/sub
+    """
+    if server.sub_url:
+        return server.sub_url.rstrip('/')
+    try:
+        parsed_url = urlparse(server.api_url)
+        server_ip = parsed_url.hostname or parsed_url.netloc.split(':')[0]
+    except Exception:
+        server_ip = "vpn-x3.ru"  # Fallback
+    return f"http://{server_ip}:2096/sub"
+
+
+@dataclass(frozen=True, slots=True)
+class LocationDTO:
+    """Локация"""
+    id: int
+    name: str
+    description: Optional[str]
+    price: float
+    is_active: bool
+    is_hidden: bool
+
+    @classmethod
+    def from_model(cls, location) -> "LocationDTO":
+        return cls(
+            id=location.id,
+            name=location.name,
+            description=location.description,
+            price=location.price,
+            is_active=bool(location.is_active),
+            is_hidden=bool(location.is_hidden),
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "LocationDTO":
+        return cls(**data)
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass(frozen=True, slots=True)
+class ServerDTO:
+    """
+    Сервер без данных доступа к панели 3x-ui
+
+    URL панели, логин, пароль и сертификат в кэш не попадают: для запросов к панели
+    загружайте сервер из БД (get_server_by_id). Количество пользователей тоже не хранится -
+    оно меняется при каждой покупке (см. get_available_servers_for_location).
+    """
+    id: int
+    name: str
+    location_id: int
+    description: Optional[str]
+    is_active: bool
+    max_users: Optional[int]
+    subscription_base_url: str
+    location: Optional[LocationDTO]
+
+    @classmethod
+    def from_model(cls, server) -> "ServerDTO":
+        # Локация должна быть загружена заранее (joinedload), иначе - без локации
+        location = server.__dict__.get("location")
+        return cls(
+            id=server.id,
+            name=server.name,
+            location_id=server.location_id,
+            description=server.description,
+            is_active=bool(server.is_active),
+            max_users=server.max_users,
+            subscription_base_url=get_subscription_base_url(server),
+            location=LocationDTO.from_model(location) if location is not None else None,
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "ServerDTO":
+        location = data.get("location")
+        return cls(**{**data, "location": LocationDTO.from_dict(location) if location else None})
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass(frozen=True, slots=True)
+class TariffDTO:
+    """Тариф"""
+    id: int
+    name: str
+    price: float
+    duration_days: int
+    traffic_limit: Optional[float]
+
+    @classmethod
+    def from_model(cls, tariff) -> "TariffDTO":
+        return cls(
+            id=tariff.id,
+            name=tariff.name,
+            price=tariff.price,
+            duration_days=tariff.duration_days,
+            traffic_limit=tariff.traffic_limit,
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "TariffDTO":
+        return cls(**data)
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
@@ -1,11 +1,14 @@
-from database.base import async_session
-from database.models import User, Server, Payment, Subscription, Tariff, Location, PromoCode, PromoCodeUsage, SupportTicket, Platform, Tutorial, TutorialFile, AdminDocumentation, AdminDocumentationFile
+from database.base import async_session, get_session
+from database.models import User, Server, Payment, Subscription, Tariff, Location, PromoCode, PromoCodeUsage, ServerReservation, DailyStats, SupportTicket, Platform, Tutorial, TutorialFile, AdminDocumentation, AdminDocumentationFile
 from sqlalchemy import select, func, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload, joinedload
 from typing import Optional, List
 from datetime import datetime, timedelta, timezone
 import re
-from utils.cache import CacheService, CacheKeys
+import time
+from utils.cache import CacheService, CacheKeys, CacheTags
+from utils.catalog import LocationDTO, ServerDTO, TariffDTO, get_subscription_base_url
 
 
 def get_timezone_offset_from_language(language_code: Optional[str] = None) -> int:
@@ -58,7 +61,7 @@ def utc_to_user_timezone(utc_datetime: datetime, timezone_offset: Optional[int]
     Args:
         utc_datetime: datetime объект в UTC (без timezone info)
         timezone_offset: смещение часового пояса пользователя в часах относительно UTC (опционально)
-        user: объект User для получения часового пояса из профиля (опционально)
+        user: объект User для получения часового пояса или языка из профиля (опционально)
         language_code: код языка пользователя для автоматического определения часового пояса (опционально)
     
     Returns:
@@ -68,6 +71,9 @@ def utc_to_user_timezone(utc_datetime: datetime, timezone_offset: Optional[int]
     if timezone_offset is None:
         if user and hasattr(user, 'timezone_offset') and user.timezone_offset is not None:
             timezone_offset = user.timezone_offset
+        elif user and getattr(user, 'language_code', None) and not language_code:
+            # Язык, сохраненный из последнего обновления пользователя
+            timezone_offset = get_timezone_offset_from_language(user.language_code)
         elif language_code:
             # Пытаемся определить по языку пользователя
             timezone_offset = get_timezone_offset_from_language(language_code)
@@ -167,6 +173,31 @@ def generate_location_unique_name(location_name: str, subscription_id: int = Non
     return f"{slug}-{unique_id}"
 
 
+def generate_location_slug(location_name: str) -> str:
+    """
+    Нормализует название локации для использования в email клиентов 3x-ui
+    (транслитерация в латиницу, только [a-z0-9])
+
+    Args:
+        location_name: Название локации (например, "Москва")
+
+    Returns:
+        Строка вида "moskva"
+    """
+    import unicodedata
+
+    translit_map = {
+        'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo',
+        'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
+        'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+        'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+        'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya'
+    }
+    normalized = unicodedata.normalize('NFKD', location_name)
+    location_slug = ''.join(translit_map.get(char.lower(), char.lower()) for char in normalized)
+    return re.sub(r'[^a-z0-9]', '', location_slug)
+
+
 def get_subscription_identifier(subscription: Subscription, location_name: str = None) -> str:
     """
     Генерирует уникальный идентификатор подписки в формате {LOCATION_UNIQUE_NAME}
@@ -190,55 +221,102 @@ def get_subscription_identifier(subscription: Subscription, location_name: str =
     return generate_location_unique_name(location_name, subscription.id)
 
 
-async def get_user_by_tg_id(tg_id: str, use_cache: bool = True) -> Optional[User]:
+# Кэш ID пользователя по tg_id (секунды). Отсутствие пользователя кэшируется коротко:
+# запись сбрасывается при регистрации (database.crud.create_user), TTL ограничивает гонку
+# с загрузкой, начатой до регистрации
+USER_ID_CACHE_TTL = 300
+USER_ID_NEGATIVE_CACHE_TTL = 10
+
+
+async def get_user_by_tg_id(tg_id: str, use_cache: bool = True, session: Optional[AsyncSession] = None) -> Optional[User]:
     """Получить пользователя по Telegram ID с кэшированием ID"""
     tg_id_str = str(tg_id)
     cache_key = CacheKeys.USER_BY_TG_ID.format(tg_id=tg_id_str)
     
-    # Проверяем кэш - если есть ID, используем его для быстрого запроса
-    cached_id = None
-    if use_cache:
-        cached = await CacheService.get(cache_key)
-        if cached and isinstance(cached, dict) and 'id' in cached:
-            cached_id = cached.get('id')
-    
-    async with async_session() as session:
-        if cached_id:
-            # Быстрый запрос по ID (есть индекс)
-            result = await session.execute(select(User).where(User.id == cached_id))
-            user = result.scalar_one_or_none()
-            if user and user.tg_id == tg_id_str:
-                return user
-        
-        # Обычный запрос по tg_id
-        result = await session.execute(select(User).where(User.tg_id == tg_id_str))
+    async with get_session(session) as session:
+        if not use_cache:
+            result = await session.execute(select(User).where(User.tg_id == tg_id_str))
+            return result.scalar_one_or_none()
+        
+        loaded_user = None
+        
+        async def load_user_id() -> Optional[int]:
+            nonlocal loaded_user
+            result = await session.execute(select(User).where(User.tg_id == tg_id_str))
+            loaded_user = result.scalar_one_or_none()
+            return loaded_user.id if loaded_user else None
+        
+        # Одновременные запросы одного пользователя (например, рассылка и /start) - один запрос к БД
+        user_id = await CacheService.get_or_load(
+            cache_key,
+            load_user_id,
+            ttl=USER_ID_CACHE_TTL,
+            negative_ttl=USER_ID_NEGATIVE_CACHE_TTL,
+            tags=lambda user_id: [CacheTags.USER.format(user_id=user_id)] if user_id else None
+        )
+        if loaded_user is not None or user_id is None:
+            return loaded_user
+        
+        # Быстрый запрос по ID (первичный ключ)
+        result = await session.execute(select(User).where(User.id == user_id))
         user = result.scalar_one_or_none()
+        if user and user.tg_id == tg_id_str:
+            return user
         
-        # Кэшируем только ID для быстрого доступа
-        if user and use_cache:
-            await CacheService.set(cache_key, {'id': user.id}, ttl=300)
-        
-        return user
+        # Кэш устарел - обычный запрос по tg_id
+        result = await session.execute(select(User).where(User.tg_id == tg_id_str))
+        return result.scalar_one_or_none()
+
+
+# Кэш tg_id администраторов в памяти процесса (секунды).
+# Изменения через set_admin() сбрасывают кэш сразу, изменения из других процессов
+# (scripts/set_admin.py, другие реплики) применяются по истечении TTL.
+ADMIN_IDS_CACHE_TTL = 60
+
+_admin_ids_cache: Optional[frozenset] = None
+_admin_ids_cache_expires_at = 0.0
+
+
+async def get_admin_tg_ids(session: Optional[AsyncSession] = None) -> frozenset:
+    """Получить tg_id всех администраторов (одним запросом, с кэшем в памяти)"""
+    global _admin_ids_cache, _admin_ids_cache_expires_at
+    
+    if _admin_ids_cache is not None and time.monotonic() < _admin_ids_cache_expires_at:
+        return _admin_ids_cache
+    
+    async with get_session(session) as session:
+        result = await session.execute(
+            select(User.tg_id).where(User.is_admin == True)
+        )
+        _admin_ids_cache = frozenset(str(tg_id) for tg_id in result.scalars().all())
+    _admin_ids_cache_expires_at = time.monotonic() + ADMIN_IDS_CACHE_TTL
+    return _admin_ids_cache
+
+
+def invalidate_admin_ids_cache() -> None:
+    """Сбросить кэш администраторов (после изменения прав)"""
+    global _admin_ids_cache, _admin_ids_cache_expires_at
+    _admin_ids_cache = None
+    _admin_ids_cache_expires_at = 0.0
 
 
 async def is_admin(tg_id: str) -> bool:
     """Проверить, является ли пользователь администратором"""
-    user = await get_user_by_tg_id(tg_id)
-    return user.is_admin if user else False
+    return str(tg_id) in await get_admin_tg_ids()
 
 
-async def get_all_admins() -> list[User]:
+async def get_all_admins(session: Optional[AsyncSession] = None) -> list[User]:
     """Получить всех администраторов"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(User).where(User.is_admin == True)
         )
         return list(result.scalars().all())
 
 
-async def get_all_servers() -> list[Server]:
+async def get_all_servers(session: Optional[AsyncSession] = None) -> list[Server]:
     """Получить все серверы с загруженными локациями"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Server)
             .options(joinedload(Server.location))
@@ -247,37 +325,27 @@ async def get_all_servers() -> list[Server]:
         return list(result.unique().scalars().all())
 
 
-def generate_subscription_link(server: Server, sub_id: str) -> str:
+def generate_subscription_link(server, sub_id: str) -> str:
     """
     Генерирует ссылку на подписку на основе настроек сервера
     
     Args:
-        server: Объект сервера
+        server: Объект сервера (Server или ServerDTO из кэша каталога)
         sub_id: ID подписки (sub_id)
     
     Returns:
         Ссылка на подписку в формате {sub_url}/{sub_id} или http://{server_ip}:2096/sub/{sub_id}
     """
-    if server.sub_url:
-        # Используем кастомный sub_url из настроек сервера
-        sub_url = server.sub_url.rstrip('/')
-        return f"{sub_url}/{sub_id}"
-    else:
-        # Используем старый формат: извлекаем IP из api_url
-        from urllib.parse import urlparse
-        try:
-            parsed_url = urlparse(server.api_url)
-            server_ip = parsed_url.hostname or parsed_url.netloc.split(':')[0]
-        except:
-            server_ip = "vpn-x3.ru"  # Fallback
-        return f"http://{server_ip}:2096/sub/{sub_id}"
+    if isinstance(server, ServerDTO):
+        return f"{server.subscription_base_url}/{sub_id}"
+    return f"{get_subscription_base_url(server)}/{sub_id}"
 
 
-async def get_server_by_id(server_id: int, use_cache: bool = True) -> Optional[Server]:
+async def get_server_by_id(server_id: int, use_cache: bool = True, session: Optional[AsyncSession] = None) -> Optional[Server]:
     """Получить сервер по ID с загруженной локацией"""
-    # Кэширование не используется для объектов ORM - всегда загружаем из БД
-    # но используем joinedload для оптимизации (один запрос вместо двух)
-    async with async_session() as session:
+    # Объекты ORM не кэшируются (нужны данные доступа к панели) - для чтения без запроса к БД
+    # используйте get_catalog_server(). joinedload - один запрос вместо двух
+    async with get_session(session) as session:
         result = await session.execute(
             select(Server)
             .options(joinedload(Server.location))
@@ -296,7 +364,8 @@ async def create_server(
     max_users: int = None,
     ssl_certificate: str = None,
     payment_days: int = None,
-    sub_url: str = None
+    sub_url: str = None,
+    session: Optional[AsyncSession] = None
 ) -> Server:
     """
     Создать новый сервер
@@ -312,6 +381,7 @@ async def create_server(
         ssl_certificate: SSL сертификат в формате PEM (опционально)
         payment_days: Количество дней, на которое куплен сервер (опционально)
         sub_url: URL шаблон для генерации ссылок подписки (формат: {sub_url}/{subID}, опционально)
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
     """
     from datetime import datetime, timedelta
     
@@ -319,7 +389,7 @@ async def create_server(
     if payment_days and payment_days > 0:
         payment_expire_date = datetime.utcnow() + timedelta(days=payment_days)
     
-    async with async_session() as session:
+    async with get_session(session) as session:
         server = Server(
             name=name,
             api_url=api_url,
@@ -336,21 +406,23 @@ async def create_server(
         session.add(server)
         await session.commit()
         await session.refresh(server)
-        
-        return server
+    
+    await CacheService.invalidate_server_cache(server.id, location_id)
+    return server
 
 
-async def update_server(server_id: int, **kwargs) -> Optional[Server]:
+async def update_server(server_id: int, session: Optional[AsyncSession] = None, **kwargs) -> Optional[Server]:
     """Обновить данные сервера
     
     Args:
         server_id: ID сервера
         **kwargs: Поля для обновления. Можно передать None для nullable полей (location, description, max_users).
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
     
     Returns:
         Обновленный сервер или None если не найден
     """
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(Server).where(Server.id == server_id))
         server = result.scalar_one_or_none()
         if not server:
@@ -399,6 +471,10 @@ async def update_server(server_id: int, **kwargs) -> Optional[Server]:
         await session.commit()
         await session.refresh(server)
         
+        await CacheService.invalidate_server_cache(server_id, old_location_id)
+        if server.location_id != old_location_id:
+            await CacheService.invalidate_server_cache(location_id=server.location_id)
+        
         # Если были изменены критичные поля, отправляем уведомления пользователям
         if changed_critical_fields:
             # Отправляем уведомления асинхронно (не блокируя ответ)
@@ -441,21 +517,23 @@ async def update_server(server_id: int, **kwargs) -> Optional[Server]:
         return server
 
 
-async def delete_server(server_id: int) -> bool:
+async def delete_server(server_id: int, session: Optional[AsyncSession] = None) -> bool:
     """
     Удалить сервер
     
     Перед удалением сервера:
     1. Устанавливает server_id = NULL для всех связанных payments
     2. Проверяет наличие активных subscriptions - если есть, возвращает False
+    3. Удаляет клиентов из пула заранее созданных клиентов сервера
     
     Args:
         server_id: ID сервера для удаления
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
         
     Returns:
         True если сервер успешно удален, False если есть активные подписки или сервер не найден
     """
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(Server).where(Server.id == server_id))
         server = result.scalar_one_or_none()
         if not server:
@@ -485,15 +563,25 @@ async def delete_server(server_id: int) -> bool:
             .values(server_id=None)
         )
         
+        # Удаляем клиентов пула этого сервера
+        from database.models import PooledClient
+        from sqlalchemy import delete
+        await session.execute(
+            delete(PooledClient).where(PooledClient.server_id == server_id)
+        )
+        
         # Удаляем сервер
+        location_id = server.location_id
         await session.delete(server)
         await session.commit()
-        return True
+    
+    await CacheService.invalidate_server_cache(server_id, location_id)
+    return True
 
 
-async def set_admin(tg_id: str, is_admin: bool = True) -> Optional[User]:
+async def set_admin(tg_id: str, is_admin: bool = True, session: Optional[AsyncSession] = None) -> Optional[User]:
     """Установить статус администратора для пользователя"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(User).where(User.tg_id == str(tg_id)))
         user = result.scalar_one_or_none()
         if not user:
@@ -502,26 +590,163 @@ async def set_admin(tg_id: str, is_admin: bool = True) -> Optional[User]:
         user.is_admin = is_admin
         await session.commit()
         await session.refresh(user)
-        return user
+    
+    invalidate_admin_ids_cache()
+    return user
 
 
-async def get_all_users() -> list[User]:
+async def get_all_users(session: Optional[AsyncSession] = None) -> list[User]:
     """Получить всех пользователей"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(User).order_by(User.created_at.desc()))
         return list(result.scalars().all())
 
 
-async def get_user_by_id(user_id: int) -> Optional[User]:
+async def get_users_page(
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = 10,
+    session: Optional[AsyncSession] = None
+) -> tuple[list[User], bool, bool]:
+    """
+    Получить страницу пользователей (новые первыми) keyset-пагинацией по User.id
+    
+    Один запрос LIMIT по первичному ключу независимо от номера страницы.
+    
+    Args:
+        after_id: ID последнего пользователя предыдущей страницы (следующая страница)
+        before_id: ID первого пользователя следующей страницы (предыдущая страница)
+        limit: Размер страницы
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
+        
+    Returns:
+        (пользователи страницы, есть ли предыдущая страница, есть ли следующая страница)
+    """
+    query = select(User)
+    if before_id is not None:
+        query = query.where(User.id > before_id).order_by(User.id.asc())
+    else:
+        if after_id is not None:
+            query = query.where(User.id < after_id)
+        query = query.order_by(User.id.desc())
+    
+    async with get_session(session) as session:
+        result = await session.execute(query.limit(limit + 1))
+        users = list(result.scalars().all())
+    
+    has_more = len(users) > limit
+    users = users[:limit]
+    if before_id is not None:
+        users.reverse()
+        return users, has_more, True
+    return users, after_id is not None, has_more
+
+
+async def search_users(
+    query: str,
+    offset: int = 0,
+    limit: int = 10,
+    session: Optional[AsyncSession] = None
+) -> tuple[list[User], bool]:
+    """
+    Поиск пользователей для администраторов одним запросом
+    
+    Ищет без учета регистра по части username, email, SubId пользователя и его подписок,
+    по началу tg_id и по точному ID; username дополнительно ищется нечетко (оператор %
+    pg_trgm, порог сходства pg_trgm.similarity_threshold - по умолчанию 0.3).
+    Каждое условие выполняется по своему GIN-индексу (миграция add_user_search_trgm),
+    найденные ID объединяются через UNION.
+    
+    Args:
+        query: Строка поиска (@ в начале игнорируется)
+        offset: Смещение (номер страницы * limit)
+        limit: Размер страницы
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
+        
+    Returns:
+        (найденные пользователи - сначала точные совпадения, затем по сходству username,
+        есть ли следующая страница)
+    """
+    from sqlalchemy import union, case
+    
+    query = query.strip().lstrip('@')
+    if not query:
+        return [], False
+    
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    contains = f"%{escaped}%"
+    
+    candidates = [
+        select(User.id).where(User.username.ilike(contains, escape='\\')),
+        select(User.id).where(User.username.op('%')(query)),
+        select(User.id).where(User.email.ilike(contains, escape='\\')),
+        select(User.id).where(User.sub_id.ilike(contains, escape='\\')),
+        select(User.id).where(User.tg_id.like(f"{escaped}%", escape='\\')),
+        select(Subscription.user_id).where(Subscription.sub_id.ilike(contains, escape='\\')),
+    ]
+    lowered = query.lower()
+    exact_conditions = [
+        func.lower(User.username) == lowered,
+        User.tg_id == query,
+        func.lower(User.email) == lowered,
+    ]
+    # ID пользователя (int4) - только для чисел, помещающихся в тип колонки
+    if query.isdigit() and int(query) < 2 ** 31:
+        candidates.append(select(User.id).where(User.id == int(query)))
+        exact_conditions.append(User.id == int(query))
+    matched_ids = union(*candidates).subquery()
+    exact_match = or_(*exact_conditions)
+    stmt = (
+        select(User)
+        .join(matched_ids, User.id == matched_ids.c.id)
+        .order_by(
+            case((exact_match, 0), else_=1),
+            func.similarity(func.coalesce(User.username, ''), query).desc(),
+            User.id.desc()
+        )
+        .offset(offset)
+        .limit(limit + 1)
+    )
+    
+    async with get_session(session) as session:
+        result = await session.execute(stmt)
+        users = list(result.scalars().all())
+    
+    return users[:limit], len(users) > limit
+
+
+async def get_user_recipients_batch(after_id: int = 0, limit: int = 500, session: Optional[AsyncSession] = None) -> list[tuple[int, str, Optional[str]]]:
+    """
+    Получить пачку получателей рассылки после указанного ID (keyset-пагинация по User.id)
+    
+    Args:
+        after_id: ID последнего обработанного пользователя (0 - с начала)
+        limit: Размер пачки
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
+        
+    Returns:
+        Список кортежей (id, tg_id, username) в порядке возрастания ID
+    """
+    async with get_session(session) as session:
+        result = await session.execute(
+            select(User.id, User.tg_id, User.username)
+            .where(User.id > after_id)
+            .order_by(User.id)
+            .limit(limit)
+        )
+        return [tuple(row) for row in result.all()]
+
+
+async def get_user_by_id(user_id: int, session: Optional[AsyncSession] = None) -> Optional[User]:
     """Получить пользователя по ID"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(User).where(User.id == user_id))
         return result.scalar_one_or_none()
 
 
-async def update_user(user_id: int, **kwargs) -> Optional[User]:
+async def update_user(user_id: int, session: Optional[AsyncSession] = None, **kwargs) -> Optional[User]:
     """Обновить данные пользователя"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(User).where(User.id == user_id))
         user = result.scalar_one_or_none()
         if not user:
@@ -533,12 +758,41 @@ async def update_user(user_id: int, **kwargs) -> Optional[User]:
         
         await session.commit()
         await session.refresh(user)
-        return user
+    
+    # Кэш ID по tg_id (get_user_by_tg_id) устаревает только при смене tg_id
+    if kwargs.get("tg_id") is not None:
+        await CacheService.invalidate_user_cache(user_id)
+    return user
+
+
+async def update_user_locale(tg_id: str, language_code: Optional[str], username: Optional[str] = None, session: Optional[AsyncSession] = None) -> bool:
+    """
+    Сохранить язык пользователя (и username) из входящего обновления Telegram
+
+    Часовой пояс определяется по языку, так как Telegram не передает его ботам.
+
+    Returns:
+        True если пользователь найден и обновлен
+    """
+    values = {
+        "language_code": language_code,
+        "timezone_offset": get_timezone_offset_from_language(language_code) if language_code else None,
+    }
+    if username:
+        values["username"] = username
+
+    from sqlalchemy import update
+    async with get_session(session) as session:
+        result = await session.execute(
+            update(User).where(User.tg_id == str(tg_id)).values(**values)
+        )
+        await session.commit()
+        return result.rowcount > 0
 
 
-async def update_user_email(tg_id: str, email: str) -> Optional[User]:
+async def update_user_email(tg_id: str, email: str, session: Optional[AsyncSession] = None) -> Optional[User]:
     """Обновить email пользователя по tg_id"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(User).where(User.tg_id == str(tg_id)))
         user = result.scalar_one_or_none()
         if not user:
@@ -550,51 +804,64 @@ async def update_user_email(tg_id: str, email: str) -> Optional[User]:
         return user
 
 
-async def get_users_count() -> int:
-    """Получить общее количество пользователей"""
-    async with async_session() as session:
+# Сколько секунд кэшировать общее количество пользователей (для списка в админ-панели)
+USERS_COUNT_CACHE_TTL = 300
+
+
+async def get_users_count(use_cache: bool = False, session: Optional[AsyncSession] = None) -> int:
+    """Получить общее количество пользователей (use_cache - значение может отставать на USERS_COUNT_CACHE_TTL)"""
+    if use_cache:
+        cached = await CacheService.get(CacheKeys.USERS_COUNT)
+        if cached is not None:
+            return cached
+    
+    async with get_session(session) as session:
         result = await session.execute(select(func.count(User.id)))
-        return result.scalar() or 0
+        count = result.scalar() or 0
+    
+    if use_cache:
+        await CacheService.set(CacheKeys.USERS_COUNT, count, ttl=USERS_COUNT_CACHE_TTL)
+    return count
 
 
-async def get_active_users_count() -> int:
+async def get_active_users_count(session: Optional[AsyncSession] = None) -> int:
     """Получить количество активных пользователей"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(func.count(User.id)).where(User.status == "active"))
         return result.scalar() or 0
 
 
-async def get_servers_count() -> int:
+async def get_servers_count(session: Optional[AsyncSession] = None) -> int:
     """Получить общее количество серверов"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(func.count(Server.id)))
         return result.scalar() or 0
 
 
-async def get_active_servers_count() -> int:
+async def get_active_servers_count(session: Optional[AsyncSession] = None) -> int:
     """Получить количество активных серверов"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(func.count(Server.id)).where(Server.is_active == True))
         return result.scalar() or 0
 
 
-async def get_payments_count() -> int:
+async def get_payments_count(session: Optional[AsyncSession] = None) -> int:
     """Получить общее количество платежей"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(func.count(Payment.id)))
         return result.scalar() or 0
 
 
-async def get_paid_payments_count() -> int:
+async def get_paid_payments_count(session: Optional[AsyncSession] = None) -> int:
     """Получить количество успешных платежей"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(func.count(Payment.id)).where(Payment.status == "paid"))
         return result.scalar() or 0
 
 
-async def get_total_revenue() -> float:
+async def get_total_revenue(session: Optional[AsyncSession] = None) -> float:
     """Получить общую выручку (сумма всех успешных платежей)"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(func.sum(Payment.amount)).where(Payment.status == "paid")
         )
@@ -602,11 +869,11 @@ async def get_total_revenue() -> float:
         return float(total) if total else 0.0
 
 
-async def get_revenue_by_period(start_date: datetime, end_date: datetime = None) -> float:
+async def get_revenue_by_period(start_date: datetime, end_date: datetime = None, session: Optional[AsyncSession] = None) -> float:
     """Получить выручку за период"""
     if end_date is None:
         end_date = datetime.utcnow()
-    async with async_session() as session:
+    async with get_session(session) as session:
         # Используем paid_at для точной даты оплаты, если NULL - используем created_at
         result = await session.execute(
             select(func.sum(Payment.amount)).where(
@@ -623,18 +890,18 @@ async def get_revenue_by_period(start_date: datetime, end_date: datetime = None)
         return float(total) if total else 0.0
 
 
-async def get_subscriptions_count_by_status(status: str) -> int:
+async def get_subscriptions_count_by_status(status: str, session: Optional[AsyncSession] = None) -> int:
     """Получить количество подписок по статусу"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(func.count(Subscription.id)).where(Subscription.status == status)
         )
         return result.scalar() or 0
 
 
-async def get_users_with_active_subscriptions_count() -> int:
+async def get_users_with_active_subscriptions_count(session: Optional[AsyncSession] = None) -> int:
     """Получить количество уникальных пользователей с активными подписками"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(func.count(func.distinct(Subscription.user_id))).where(
                 Subscription.status == "active"
@@ -643,11 +910,11 @@ async def get_users_with_active_subscriptions_count() -> int:
         return result.scalar() or 0
 
 
-async def get_paid_payments_count_by_period(start_date: datetime, end_date: datetime = None) -> int:
+async def get_paid_payments_count_by_period(start_date: datetime, end_date: datetime = None, session: Optional[AsyncSession] = None) -> int:
     """Получить количество успешных платежей за период"""
     if end_date is None:
         end_date = datetime.utcnow()
-    async with async_session() as session:
+    async with get_session(session) as session:
         # Используем paid_at для точной даты оплаты, если NULL - используем created_at
         result = await session.execute(
             select(func.count(Payment.id)).where(
@@ -663,11 +930,11 @@ async def get_paid_payments_count_by_period(start_date: datetime, end_date: date
         return result.scalar() or 0
 
 
-async def get_new_users_count_by_period(start_date: datetime, end_date: datetime = None) -> int:
+async def get_new_users_count_by_period(start_date: datetime, end_date: datetime = None, session: Optional[AsyncSession] = None) -> int:
     """Получить количество новых пользователей за период"""
     if end_date is None:
         end_date = datetime.utcnow()
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(func.count(User.id)).where(
                 and_(
@@ -679,9 +946,209 @@ async def get_new_users_count_by_period(start_date: datetime, end_date: datetime
         return result.scalar() or 0
 
 
-async def has_user_made_purchase(user_id: int) -> bool:
+def _paid_in_period(start_date: Optional[datetime], end_date: Optional[datetime] = None):
+    """Условие "платеж оплачен в периоде [start_date, end_date)" (paid_at, для старых платежей - created_at)"""
+    paid_conditions = [Payment.paid_at.isnot(None)]
+    created_conditions = [Payment.paid_at.is_(None)]
+    if start_date is not None:
+        paid_conditions.append(Payment.paid_at >= start_date)
+        created_conditions.append(Payment.created_at >= start_date)
+    if end_date is not None:
+        paid_conditions.append(Payment.paid_at < end_date)
+        created_conditions.append(Payment.created_at < end_date)
+    return and_(
+        Payment.status == "paid",
+        or_(and_(*paid_conditions), and_(*created_conditions))
+    )
+
+
+async def get_admin_stats(session: Optional[AsyncSession] = None) -> dict:
+    """
+    Получить статистику для админ-панели двумя запросами
+    
+    Первый запрос - количество подписок по статусам (один проход по subscriptions)
+    и последний закрытый день в daily_stats (rolled_at). Второй - выручка и активность:
+    закрытые дни берутся из daily_stats, остальное время (сегодня и дни, которые
+    фоновая задача еще не посчитала) - из payments и users по индексам.
+    
+    Returns:
+        Словарь со статистикой (значения - числа, пригодные для JSON)
+    """
+    now = datetime.utcnow()
+    today_start = datetime(now.year, now.month, now.day, 0, 0, 0)
+    week_start = today_start - timedelta(days=7)
+    month_start = datetime(now.year, now.month, 1, 0, 0, 0)
+    
+    async with get_session(session) as session:
+        row = (await session.execute(
+            select(
+                func.count(Subscription.id).filter(Subscription.status == "active"),
+                func.count(Subscription.id).filter(Subscription.status == "expired"),
+                func.count(Subscription.id).filter(Subscription.status == "paused"),
+                func.count(func.distinct(Subscription.user_id)).filter(Subscription.status == "active"),
+                select(func.max(DailyStats.day)).where(DailyStats.rolled_at.isnot(None)).scalar_subquery()
+            )
+        )).one()
+        active, expired, paused, users_with_subscriptions, last_rolled_day = row
+        
+        # Данные после последнего посчитанного дня считаем по исходным таблицам
+        rolled_until = (
+            datetime(last_rolled_day.year, last_rolled_day.month, last_rolled_day.day) + timedelta(days=1)
+            if last_rolled_day else None
+        )
+        
+        def live_start(period_start: Optional[datetime]) -> Optional[datetime]:
+            if rolled_until is None:
+                return period_start
+            return max(period_start, rolled_until) if period_start else rolled_until
+        
+        def rolled_revenue(period_start: Optional[datetime]):
+            conditions = [DailyStats.rolled_at.isnot(None)]
+            if period_start is not None:
+                conditions.append(DailyStats.day >= period_start.date())
+            return select(func.coalesce(func.sum(DailyStats.revenue), 0.0)).where(and_(*conditions)).scalar_subquery()
+        
+        def live_revenue(period_start: Optional[datetime]):
+            return (
+                select(func.coalesce(func.sum(Payment.amount), 0.0))
+                .where(_paid_in_period(live_start(period_start)))
+                .scalar_subquery()
+            )
+        
+        row = (await session.execute(
+            select(
+                rolled_revenue(None) + live_revenue(None),
+                rolled_revenue(week_start) + live_revenue(week_start),
+                rolled_revenue(month_start) + live_revenue(month_start),
+                live_revenue(today_start),
+                select(func.count(Payment.id)).where(_paid_in_period(today_start)).scalar_subquery(),
+                select(func.count(User.id)).where(User.created_at >= today_start).scalar_subquery()
+            )
+        )).one()
+        total_revenue, revenue_week, revenue_month, revenue_today, payments_today, new_users_today = row
+    
+    return {
+        "active_subscriptions": active,
+        "expired_subscriptions": expired,
+        "paused_subscriptions": paused,
+        "users_with_subscriptions": users_with_subscriptions,
+        "total_revenue": float(total_revenue or 0),
+        "revenue_today": float(revenue_today or 0),
+        "revenue_week": float(revenue_week or 0),
+        "revenue_month": float(revenue_month or 0),
+        "payments_today": payments_today or 0,
+        "new_users_today": new_users_today or 0
+    }
+
+
+async def rollup_daily_stats(session: Optional[AsyncSession] = None) -> None:
+    """
+    Обновить статистику по дням (daily_stats)
+    
+    Пересчитываются закрытые дни начиная с последнего уже посчитанного (он пересчитывается
+    повторно на случай поздно подтвержденных платежей), поэтому обычный запуск читает
+    платежи и пользователей за 1-2 дня. Первый запуск заполняет всю историю.
+    Посчитанные дни помечаются rolled_at - по нему get_admin_stats определяет, какие
+    дни брать из daily_stats. В строку текущего дня записывается только количество
+    подписок по статусам (rolled_at не ставится).
+    """
+    from sqlalchemy import update
+    from sqlalchemy.dialects.postgresql import insert
+    
+    now = datetime.utcnow()
+    today_start = datetime(now.year, now.month, now.day, 0, 0, 0)
+    today = today_start.date()
+    
+    async with get_session(session) as session:
+        last_rolled_day = await session.scalar(
+            select(func.max(DailyStats.day)).where(DailyStats.rolled_at.isnot(None))
+        )
+        if last_rolled_day:
+            start = datetime(last_rolled_day.year, last_rolled_day.month, last_rolled_day.day)
+        else:
+            start = None
+        
+        # Обнуляем пересчитываемые дни (на случай отмененных платежей), затем заполняем заново
+        reset_conditions = [DailyStats.day < today]
+        if start is not None:
+            reset_conditions.append(DailyStats.day >= start.date())
+        await session.execute(
+            update(DailyStats)
+            .where(and_(*reset_conditions))
+            .values(revenue=0.0, paid_payments=0, new_users=0)
+            .execution_options(synchronize_session=False)
+        )
+        
+        paid_day = func.date(func.coalesce(Payment.paid_at, Payment.created_at))
+        payments_insert = insert(DailyStats).from_select(
+            ["day", "revenue", "paid_payments"],
+            select(paid_day, func.sum(Payment.amount), func.count(Payment.id))
+            .where(_paid_in_period(start, today_start))
+            .group_by(paid_day)
+        )
+        await session.execute(
+            payments_insert.on_conflict_do_update(
+                index_elements=[DailyStats.day],
+                set_={
+                    "revenue": payments_insert.excluded.revenue,
+                    "paid_payments": payments_insert.excluded.paid_payments,
+                    "updated_at": now
+                }
+            )
+        )
+        
+        user_day = func.date(User.created_at)
+        user_conditions = [User.created_at < today_start]
+        if start is not None:
+            user_conditions.append(User.created_at >= start)
+        users_insert = insert(DailyStats).from_select(
+            ["day", "new_users"],
+            select(user_day, func.count(User.id))
+            .where(and_(*user_conditions))
+            .group_by(user_day)
+        )
+        await session.execute(
+            users_insert.on_conflict_do_update(
+                index_elements=[DailyStats.day],
+                set_={"new_users": users_insert.excluded.new_users, "updated_at": now}
+            )
+        )
+        
+        # Закрываем посчитанные дни. Строка вчерашнего дня нужна и без платежей и
+        # регистраций: иначе следующий запуск и статистика начнут с более раннего дня
+        yesterday = today - timedelta(days=1)
+        await session.execute(
+            insert(DailyStats).values(day=yesterday).on_conflict_do_nothing(index_elements=[DailyStats.day])
+        )
+        await session.execute(
+            update(DailyStats)
+            .where(and_(*reset_conditions))
+            .values(rolled_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        
+        # Подписки по статусам на текущий момент
+        status_counts = dict((await session.execute(
+            select(Subscription.status, func.count(Subscription.id))
+            .where(Subscription.status.in_(["active", "expired", "paused"]))
+            .group_by(Subscription.status)
+        )).all())
+        status_values = {
+            "active_subscriptions": status_counts.get("active", 0),
+            "expired_subscriptions": status_counts.get("expired", 0),
+            "paused_subscriptions": status_counts.get("paused", 0),
+            "updated_at": now
+        }
+        status_insert = insert(DailyStats).values(day=today, **status_values)
+        await session.execute(
+            status_insert.on_conflict_do_update(index_elements=[DailyStats.day], set_=status_values)
+        )
+        await session.commit()
+
+
+async def has_user_made_purchase(user_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Проверить, делал ли пользователь успешные покупки"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         # Используем EXISTS для оптимизации - не загружаем все подписки
         result = await session.execute(
             select(func.count(Subscription.id)).where(Subscription.user_id == user_id).limit(1)
@@ -690,9 +1157,9 @@ async def has_user_made_purchase(user_id: int) -> bool:
         return count > 0
 
 
-async def mark_user_used_discount(user_id: int) -> bool:
+async def mark_user_used_discount(user_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Отметить, что пользователь использовал скидку на первую покупку"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(User).where(User.id == user_id))
         user = result.scalar_one_or_none()
         if not user:
@@ -704,10 +1171,10 @@ async def mark_user_used_discount(user_id: int) -> bool:
         return True
 
 
-async def get_all_active_subscriptions() -> List[Subscription]:
+async def get_all_active_subscriptions(session: Optional[AsyncSession] = None) -> List[Subscription]:
     """Получить все активные подписки с предзагрузкой связанных данных (оптимизация N+1)
     Включает приватные подписки, но они будут пропущены в checker"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Subscription)
             .options(joinedload(Subscription.server).joinedload(Server.location))
@@ -716,10 +1183,10 @@ async def get_all_active_subscriptions() -> List[Subscription]:
         return list(result.unique().scalars().all())
 
 
-async def get_all_expired_subscriptions() -> List[Subscription]:
+async def get_all_expired_subscriptions(session: Optional[AsyncSession] = None) -> List[Subscription]:
     """Получить все истекшие подписки с предзагрузкой связанных данных (оптимизация N+1)
     Исключает приватные (бессрочные) подписки - они не должны истекать"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Subscription)
             .options(joinedload(Subscription.server).joinedload(Server.location))
@@ -733,13 +1200,13 @@ async def get_all_expired_subscriptions() -> List[Subscription]:
         return list(result.unique().scalars().all())
 
 
-async def check_and_block_expired_subscriptions() -> int:
+async def check_and_block_expired_subscriptions(session: Optional[AsyncSession] = None) -> int:
     """Проверить и заблокировать истекшие подписки. Возвращает количество заблокированных.
     Бессрочные (приватные) подписки не проверяются и не блокируются."""
     from datetime import datetime
     blocked_count = 0
     
-    async with async_session() as session:
+    async with get_session(session) as session:
         # Получаем все активные подписки, исключая бессрочные (приватные)
         result = await session.execute(
             select(Subscription).where(
@@ -777,10 +1244,11 @@ async def create_subscription(
     status: str = "active",
     expire_date = None,
     traffic_limit: float = 0.0,
-    is_private: bool = False
+    is_private: bool = False,
+    session: Optional[AsyncSession] = None
 ) -> Subscription:
     """Создать новую подписку"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         subscription = Subscription(
             user_id=user_id,
             server_id=server_id,
@@ -800,9 +1268,9 @@ async def create_subscription(
         return subscription
 
 
-async def get_user_subscriptions(user_id: int) -> List[Subscription]:
+async def get_user_subscriptions(user_id: int, session: Optional[AsyncSession] = None) -> List[Subscription]:
     """Получить все подписки пользователя с предзагрузкой связанных данных (оптимизация N+1)"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Subscription)
             .options(joinedload(Subscription.server).joinedload(Server.location))
@@ -812,9 +1280,9 @@ async def get_user_subscriptions(user_id: int) -> List[Subscription]:
         return list(result.unique().scalars().all())
 
 
-async def get_subscription_by_id(subscription_id: int) -> Optional[Subscription]:
+async def get_subscription_by_id(subscription_id: int, session: Optional[AsyncSession] = None) -> Optional[Subscription]:
     """Получить подписку по ID с предзагрузкой связанных данных (оптимизация N+1)"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Subscription)
             .options(joinedload(Subscription.server).joinedload(Server.location))
@@ -823,9 +1291,9 @@ async def get_subscription_by_id(subscription_id: int) -> Optional[Subscription]
         return result.unique().scalar_one_or_none()
 
 
-async def get_user_subscriptions_by_server(user_id: int, server_id: int) -> List[Subscription]:
+async def get_user_subscriptions_by_server(user_id: int, server_id: int, session: Optional[AsyncSession] = None) -> List[Subscription]:
     """Получить все подписки пользователя на конкретном сервере"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Subscription)
             .where(Subscription.user_id == user_id)
@@ -835,9 +1303,9 @@ async def get_user_subscriptions_by_server(user_id: int, server_id: int) -> List
         return list(result.scalars().all())
 
 
-async def update_subscription(subscription_id: int, **kwargs) -> Optional[Subscription]:
+async def update_subscription(subscription_id: int, session: Optional[AsyncSession] = None, **kwargs) -> Optional[Subscription]:
     """Обновить данные подписки"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Subscription).where(Subscription.id == subscription_id)
         )
@@ -854,9 +1322,9 @@ async def update_subscription(subscription_id: int, **kwargs) -> Optional[Subscr
         return subscription
 
 
-async def delete_subscription(subscription_id: int) -> bool:
+async def delete_subscription(subscription_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Удалить подписку"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Subscription).where(Subscription.id == subscription_id)
         )
@@ -869,17 +1337,18 @@ async def delete_subscription(subscription_id: int) -> bool:
         return True
 
 
-async def delete_all_user_subscriptions(user_id: int) -> int:
+async def delete_all_user_subscriptions(user_id: int, session: Optional[AsyncSession] = None) -> int:
     """
     Удалить все подписки пользователя из базы данных
     
     Args:
         user_id: ID пользователя
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
         
     Returns:
         Количество удаленных подписок
     """
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Subscription).where(Subscription.user_id == user_id)
         )
@@ -908,17 +1377,18 @@ async def get_subscriptions_older_than_days(days: int) -> List[Subscription]:
     return await get_subscriptions_older_than(timedelta(days=days))
 
 
-async def get_subscriptions_older_than(time_delta: timedelta) -> List[Subscription]:
+async def get_subscriptions_older_than(time_delta: timedelta, session: Optional[AsyncSession] = None) -> List[Subscription]:
     """
     Получить подписки, которые не продлевались более указанного времени
     
     Args:
         time_delta: Интервал времени (timedelta)
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
         
     Returns:
         Список подписок, у которых expire_date старше указанного времени
     """
-    async with async_session() as session:
+    async with get_session(session) as session:
         cutoff_date = datetime.utcnow() - time_delta
         result = await session.execute(
             select(Subscription).where(
@@ -938,10 +1408,11 @@ async def create_payment(
     server_id: int,
     tariff_id: Optional[int] = None,
     yookassa_payment_id: Optional[str] = None,
-    currency: str = "RUB"
+    currency: str = "RUB",
+    session: Optional[AsyncSession] = None
 ) -> Payment:
     """Создать новый платеж"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         payment = Payment(
             tg_id=tg_id,
             amount=amount,
@@ -957,9 +1428,9 @@ async def create_payment(
         return payment
 
 
-async def get_payment_by_yookassa_id(yookassa_payment_id: str) -> Optional[Payment]:
+async def get_payment_by_yookassa_id(yookassa_payment_id: str, session: Optional[AsyncSession] = None) -> Optional[Payment]:
     """Получить платеж по ID YooKassa"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Payment).where(Payment.yookassa_payment_id == yookassa_payment_id)
         )
@@ -969,10 +1440,11 @@ async def get_payment_by_yookassa_id(yookassa_payment_id: str) -> Optional[Payme
 async def update_payment_status(
     payment_id: int,
     status: str,
-    paid_at: Optional[datetime] = None
+    paid_at: Optional[datetime] = None,
+    session: Optional[AsyncSession] = None
 ) -> Optional[Payment]:
     """Обновить статус платежа"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Payment).where(Payment.id == payment_id)
         )
@@ -991,9 +1463,9 @@ async def update_payment_status(
         return payment
 
 
-async def get_tariff_by_id(tariff_id: int, use_cache: bool = True) -> Optional[Tariff]:
+async def get_tariff_by_id(tariff_id: int, use_cache: bool = True, session: Optional[AsyncSession] = None) -> Optional[Tariff]:
     """Получить тариф по ID"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Tariff).where(Tariff.id == tariff_id)
         )
@@ -1014,10 +1486,11 @@ def generate_test_key() -> str:
 async def create_location(
     name: str,
     price: float,
-    description: str = None
+    description: str = None,
+    session: Optional[AsyncSession] = None
 ) -> Location:
     """Создать новую локацию"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         location = Location(
             name=name,
             price=price,
@@ -1027,21 +1500,22 @@ async def create_location(
         session.add(location)
         await session.commit()
         await session.refresh(location)
-        return location
+    
+    await CacheService.invalidate_location_cache(location.id)
+    return location
 
 
-async def get_all_locations() -> List[Location]:
+async def get_all_locations(session: Optional[AsyncSession] = None) -> List[Location]:
     """Получить все локации"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(Location).order_by(Location.name))
         return list(result.scalars().all())
 
 
-async def get_active_locations(use_cache: bool = True) -> List[Location]:
+async def get_active_locations(use_cache: bool = True, session: Optional[AsyncSession] = None) -> List[Location]:
     """Получить только активные и не скрытые локации"""
-    # Кэширование не используется для объектов ORM - всегда загружаем из БД
-    # Локации меняются редко, но для консистентности всегда загружаем свежие данные
-    async with async_session() as session:
+    # Объекты ORM не кэшируются - для чтения без запроса к БД используйте get_catalog_locations()
+    async with get_session(session) as session:
         result = await session.execute(
             select(Location).where(
                 and_(
@@ -1053,23 +1527,23 @@ async def get_active_locations(use_cache: bool = True) -> List[Location]:
         return list(result.scalars().all())
 
 
-async def get_location_by_id(location_id: int, use_cache: bool = True) -> Optional[Location]:
+async def get_location_by_id(location_id: int, use_cache: bool = True, session: Optional[AsyncSession] = None) -> Optional[Location]:
     """Получить локацию по ID"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(Location).where(Location.id == location_id))
         return result.scalar_one_or_none()
 
 
-async def get_location_by_name(name: str) -> Optional[Location]:
+async def get_location_by_name(name: str, session: Optional[AsyncSession] = None) -> Optional[Location]:
     """Получить локацию по названию"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(Location).where(Location.name == name))
         return result.scalar_one_or_none()
 
 
-async def update_location(location_id: int, **kwargs) -> Optional[Location]:
+async def update_location(location_id: int, session: Optional[AsyncSession] = None, **kwargs) -> Optional[Location]:
     """Обновить данные локации"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(Location).where(Location.id == location_id))
         location = result.scalar_one_or_none()
         if not location:
@@ -1082,12 +1556,14 @@ async def update_location(location_id: int, **kwargs) -> Optional[Location]:
         location.updated_at = datetime.utcnow()
         await session.commit()
         await session.refresh(location)
-        return location
+    
+    await CacheService.invalidate_location_cache(location_id)
+    return location
 
 
-async def delete_location(location_id: int) -> bool:
+async def delete_location(location_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Удалить локацию"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(select(Location).where(Location.id == location_id))
         location = result.scalar_one_or_none()
         if not location:
@@ -1104,12 +1580,14 @@ async def delete_location(location_id: int) -> bool:
         
         await session.delete(location)
         await session.commit()
-        return True
+    
+    await CacheService.invalidate_location_cache(location_id)
+    return True
 
 
-async def get_servers_by_location(location_id: int) -> List[Server]:
+async def get_servers_by_location(location_id: int, session: Optional[AsyncSession] = None) -> List[Server]:
     """Получить все серверы для локации с загруженными локациями"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Server)
             .options(joinedload(Server.location))
@@ -1119,10 +1597,10 @@ async def get_servers_by_location(location_id: int) -> List[Server]:
         return list(result.unique().scalars().all())
 
 
-async def get_active_servers_by_location(location_id: int, use_cache: bool = True) -> List[Server]:
+async def get_active_servers_by_location(location_id: int, use_cache: bool = True, session: Optional[AsyncSession] = None) -> List[Server]:
     """Получить только активные серверы для локации с загруженными локациями"""
     # Используем joinedload для оптимизации - один запрос вместо N+1
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Server)
             .options(joinedload(Server.location))
@@ -1134,9 +1612,114 @@ async def get_active_servers_by_location(location_id: int, use_cache: bool = Tru
         return list(result.unique().scalars().all())
 
 
-async def count_active_subscriptions_by_server(server_id: int) -> int:
+# Каталог для пользовательских сценариев (покупка, профиль): неизменяемые объекты из кэша
+# в памяти процесса (L1) и Redis. Кэш сбрасывается функциями create_*/update_*/delete_*
+# локаций и серверов (на всех репликах - через pub/sub, см. utils.cache).
+CATALOG_CACHE_TTL = 600  # 10 минут
+
+
+async def get_catalog_locations(session: Optional[AsyncSession] = None) -> List[LocationDTO]:
+    """Активные и не скрытые локации (из кэша, при промахе - из БД)"""
+    cached = await CacheService.get(CacheKeys.ACTIVE_LOCATIONS, local=True)
+    if isinstance(cached, list):
+        return [LocationDTO.from_dict(item) for item in cached]
+    
+    locations = [LocationDTO.from_model(location) for location in await get_active_locations(session=session)]
+    await CacheService.set(
+        CacheKeys.ACTIVE_LOCATIONS,
+        [location.to_dict() for location in locations],
+        ttl=CATALOG_CACHE_TTL,
+        local=True
+    )
+    return locations
+
+
+async def get_catalog_location(location_id: int, session: Optional[AsyncSession] = None) -> Optional[LocationDTO]:
+    """Локация по ID (из кэша, при промахе - из БД)"""
+    cache_key = CacheKeys.LOCATION_BY_ID.format(id=location_id)
+    cached = await CacheService.get(cache_key, local=True)
+    if isinstance(cached, dict):
+        return LocationDTO.from_dict(cached)
+    
+    location = await get_location_by_id(location_id, session=session)
+    if not location:
+        return None
+    location = LocationDTO.from_model(location)
+    await CacheService.set(
+        cache_key,
+        location.to_dict(),
+        ttl=CATALOG_CACHE_TTL,
+        local=True,
+        tags=[CacheTags.LOCATION.format(location_id=location.id)]
+    )
+    return location
+
+
+async def get_catalog_server(server_id: int, session: Optional[AsyncSession] = None) -> Optional[ServerDTO]:
+    """Сервер по ID с локацией, без данных доступа к панели (из кэша, при промахе - из БД)"""
+    cache_key = CacheKeys.SERVER_BY_ID.format(id=server_id)
+    cached = await CacheService.get(cache_key, local=True)
+    if isinstance(cached, dict):
+        return ServerDTO.from_dict(cached)
+    
+    server = await get_server_by_id(server_id, session=session)
+    if not server:
+        return None
+    server = ServerDTO.from_model(server)
+    await CacheService.set(
+        cache_key,
+        server.to_dict(),
+        ttl=CATALOG_CACHE_TTL,
+        local=True,
+        tags=[CacheTags.LOCATION.format(location_id=server.location_id)]
+    )
+    return server
+
+
+async def get_catalog_servers_by_location(location_id: int, session: Optional[AsyncSession] = None) -> List[ServerDTO]:
+    """Активные серверы локации без данных доступа к панели (из кэша, при промахе - из БД)"""
+    cache_key = CacheKeys.SERVERS_BY_LOCATION.format(location_id=location_id)
+    cached = await CacheService.get(cache_key, local=True)
+    if isinstance(cached, list):
+        return [ServerDTO.from_dict(item) for item in cached]
+    
+    servers = [
+        ServerDTO.from_model(server)
+        for server in await get_active_servers_by_location(location_id, session=session)
+    ]
+    await CacheService.set(
+        cache_key,
+        [server.to_dict() for server in servers],
+        ttl=CATALOG_CACHE_TTL,
+        local=True,
+        tags=[CacheTags.LOCATION.format(location_id=location_id)]
+    )
+    return servers
+
+
+async def get_catalog_tariff(tariff_id: int, session: Optional[AsyncSession] = None) -> Optional[TariffDTO]:
+    """
+    Тариф по ID (из кэша, при промахе - из БД)
+    
+    Тарифы в боте только создаются (новый тариф - новый ID) и не редактируются,
+    поэтому кэш не инвалидируется: изменение тарифа напрямую в БД применится через CATALOG_CACHE_TTL.
+    """
+    cache_key = CacheKeys.TARIFF_BY_ID.format(id=tariff_id)
+    cached = await CacheService.get(cache_key, local=True)
+    if isinstance(cached, dict):
+        return TariffDTO.from_dict(cached)
+    
+    tariff = await get_tariff_by_id(tariff_id, session=session)
+    if not tariff:
+        return None
+    tariff = TariffDTO.from_model(tariff)
+    await CacheService.set(cache_key, tariff.to_dict(), ttl=CATALOG_CACHE_TTL, local=True)
+    return tariff
+
+
+async def count_active_subscriptions_by_server(server_id: int, session: Optional[AsyncSession] = None) -> int:
     """Подсчитать количество активных подписок на сервере"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(func.count(Subscription.id)).where(
                 and_(
@@ -1148,77 +1731,217 @@ async def count_active_subscriptions_by_server(server_id: int) -> int:
         return result.scalar() or 0
 
 
-async def has_available_server_for_location(location_id: int) -> bool:
+# Сколько держать место на сервере за покупателем, пока он оформляет и оплачивает покупку (минуты)
+SERVER_RESERVATION_MINUTES = 15
+
+
+def _occupied_seats(now: datetime):
+    """Занятые места на сервере: активные подписки (счетчик current_users) и действующие брони"""
+    reservations = (
+        select(func.count(ServerReservation.id))
+        .where(
+            and_(
+                ServerReservation.server_id == Server.id,
+                ServerReservation.expires_at > now
+            )
+        )
+        .correlate(Server)
+        .scalar_subquery()
+    )
+    return func.coalesce(Server.current_users, 0) + reservations
+
+
+async def get_available_servers_for_location(
+    location_id: int,
+    limit: Optional[int] = None,
+    session: Optional[AsyncSession] = None
+) -> List[Server]:
+    """
+    Получить активные серверы локации со свободными местами одним запросом
+    
+    Серверы без ограничения (max_users = None) идут первыми, остальные - по убыванию
+    количества свободных мест. Занятыми считаются активные подписки и брони покупателей.
+    
+    Args:
+        location_id: ID локации
+        limit: Максимальное количество серверов (None - все)
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
+    """
+    occupied = _occupied_seats(datetime.utcnow())
+    query = (
+        select(Server)
+        .options(joinedload(Server.location))
+        .where(
+            and_(
+                Server.location_id == location_id,
+                Server.is_active == True,
+                or_(Server.max_users.is_(None), occupied < Server.max_users)
+            )
+        )
+        .order_by(
+            Server.max_users.is_(None).desc(),
+            (Server.max_users - occupied).desc(),
+            Server.id
+        )
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    
+    async with get_session(session) as session:
+        result = await session.execute(query)
+        return list(result.unique().scalars().all())
+
+
+async def has_available_server_for_location(location_id: int, session: Optional[AsyncSession] = None) -> bool:
     """
     Проверить, есть ли хотя бы один доступный сервер в локации.
-    Сервер считается доступным, если он активен и не переполнен (current_users < max_users).
+    Сервер считается доступным, если он активен и не переполнен (занято меньше max_users).
     Если max_users не установлен (None), сервер всегда доступен.
     
     Returns:
         True если есть хотя бы один доступный сервер, False иначе
     """
-    servers = await get_active_servers_by_location(location_id)
-    
-    if not servers:
-        return False
-    
-    for server in servers:
-        active_count = await count_active_subscriptions_by_server(server.id)
-        
-        # Если max_users не установлен (None), считаем сервер доступным
-        if server.max_users is None:
-            return True
-        elif active_count < server.max_users:
-            return True
-    
-    return False
+    return bool(await get_available_servers_for_location(location_id, limit=1, session=session))
 
 
-async def select_available_server_for_location(location_id: int) -> Optional[Server]:
+async def select_available_server_for_location(location_id: int, session: Optional[AsyncSession] = None) -> Optional[Server]:
     """
     Автоматически выбрать доступный сервер из локации.
-    Выбирает сервер с наименьшей загрузкой (current_users < max_users).
+    Выбирает сервер с наибольшим количеством свободных мест.
     Если все серверы заполнены, возвращает None.
+    
+    Место на сервере не занимается - для покупки используйте reserve_server_for_location().
+    """
+    servers = await get_available_servers_for_location(location_id, limit=1, session=session)
+    return servers[0] if servers else None
+
+
+async def reserve_server_for_location(location_id: int, tg_id: str) -> Optional[Server]:
     """
-    servers = await get_active_servers_by_location(location_id)
+    Выбрать сервер локации и занять на нем место на время оформления покупки
     
-    if not servers:
-        return None
+    Бронь учитывается как занятое место до оплаты (release_server_reservation),
+    отмены или истечения SERVER_RESERVATION_MINUTES, поэтому параллельные покупатели
+    не займут последнее место дважды. Строка сервера блокируется на время проверки
+    (FOR UPDATE SKIP LOCKED: покупатели расходятся по свободным серверам локации,
+    ожидание блокировки - только если остальные серверы заняты другими покупателями).
+    Повторный вызов продлевает бронь пользователя в этой локации.
+    
+    Бронирование всегда выполняется в отдельной короткой транзакции, а не в сессии обновления.
+    
+    Returns:
+        Сервер с забронированным местом или None, если свободных мест нет
+    """
+    from sqlalchemy import update, delete
+    
+    tg_id = str(tg_id)
+    now = datetime.utcnow()
+    expires_at = now + timedelta(minutes=SERVER_RESERVATION_MINUTES)
     
-    # Сортируем серверы по загрузке (сначала те, где больше свободных мест)
-    available_servers = []
-    for server in servers:
-        active_count = await count_active_subscriptions_by_server(server.id)
+    async with async_session() as session:
+        # Бронь уже есть (повторное нажатие, ввод промокода или email) - продлеваем ее
+        result = await session.execute(
+            update(ServerReservation)
+            .where(
+                and_(
+                    ServerReservation.tg_id == tg_id,
+                    ServerReservation.expires_at > now,
+                    ServerReservation.server_id.in_(
+                        select(Server.id).where(
+                            and_(Server.location_id == location_id, Server.is_active == True)
+                        )
+                    )
+                )
+            )
+            .values(expires_at=expires_at)
+            .returning(ServerReservation.server_id)
+            .execution_options(synchronize_session=False)
+        )
+        reserved_server_id = result.scalars().first()
+        
+        if reserved_server_id is None:
+            candidates = [
+                (server.id, server.max_users)
+                for server in await get_available_servers_for_location(location_id, session=session)
+            ]
+            full_server_ids = set()
+            
+            # Сначала пробуем серверы, которые никто не бронирует, затем ждем блокировку
+            for skip_locked in (True, False):
+                for server_id, max_users in candidates:
+                    if server_id in full_server_ids:
+                        continue
+                    
+                    locked = await session.execute(
+                        select(Server.id)
+                        .where(Server.id == server_id)
+                        .with_for_update(skip_locked=skip_locked)
+                    )
+                    if locked.scalar_one_or_none() is None:
+                        continue
+                    
+                    # Пересчитываем места под блокировкой: учитываются брони, сделанные до нас
+                    if max_users is not None:
+                        occupied = await session.scalar(
+                            select(_occupied_seats(now)).select_from(Server).where(Server.id == server_id)
+                        )
+                        if occupied >= max_users:
+                            full_server_ids.add(server_id)
+                            await session.rollback()
+                            continue
+                    
+                    await session.execute(
+                        delete(ServerReservation).where(
+                            and_(
+                                ServerReservation.server_id == server_id,
+                                ServerReservation.expires_at <= now
+                            )
+                        )
+                    )
+                    session.add(ServerReservation(server_id=server_id, tg_id=tg_id, expires_at=expires_at))
+                    reserved_server_id = server_id
+                    break
+                
+                if reserved_server_id is not None:
+                    break
         
-        # Если max_users не установлен (None), считаем сервер доступным
-        if server.max_users is None:
-            available_servers.append((server, float('inf')))  # Бесконечная вместимость
-        elif active_count < server.max_users:
-            available_servers.append((server, server.max_users - active_count))
+        if reserved_server_id is None:
+            return None
+        
+        await session.commit()
+        result = await session.execute(
+            select(Server).options(joinedload(Server.location)).where(Server.id == reserved_server_id)
+        )
+        return result.scalar_one_or_none()
+
+
+async def release_server_reservation(tg_id: str, server_id: Optional[int] = None, session: Optional[AsyncSession] = None) -> None:
+    """
+    Освободить места, забронированные пользователем (после оплаты, при отмене или ошибке платежа)
     
-    if not available_servers:
-        return None
+    Args:
+        tg_id: Telegram ID покупателя
+        server_id: ID сервера (None - все брони пользователя)
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
+    """
+    from sqlalchemy import delete
     
-    # Сортируем по количеству свободных мест (по убыванию)
-    available_servers.sort(key=lambda x: x[1], reverse=True)
+    conditions = [ServerReservation.tg_id == str(tg_id)]
+    if server_id is not None:
+        conditions.append(ServerReservation.server_id == server_id)
     
-    # Возвращаем сервер с наибольшим количеством свободных мест
-    return available_servers[0][0]
+    async with get_session(session) as session:
+        await session.execute(delete(ServerReservation).where(and_(*conditions)))
+        await session.commit()
 
 
 async def update_server_current_users(server_id: int):
-    """Обновить счетчик текущих пользователей на сервере"""
-    async with async_session() as session:
-        result = await session.execute(select(Server).where(Server.id == server_id))
-        server = result.scalar_one_or_none()
-        if not server:
-            return
-        
-        active_count = await count_active_subscriptions_by_server(server_id)
-        server.current_users = active_count
-        server.updated_at = datetime.utcnow()
-        await session.commit()
+    """
+    Обработать изменение количества пользователей на сервере (после создания или переноса подписок)
     
+    Сам счетчик servers.current_users изменяется триггером БД при каждом изменении
+    подписок, здесь только проверяется загрузка сервера (по счетчику, без подсчета подписок).
+    """
     # Проверяем загрузку сервера и отправляем уведомления админам при необходимости
     try:
         from services.server_load_checker import check_server_load
@@ -1230,16 +1953,53 @@ async def update_server_current_users(server_id: int):
         logger.error(f"Ошибка при проверке загрузки сервера {server_id}: {e}")
 
 
-async def get_users_with_active_subscriptions_by_location(location_id: int) -> List[User]:
+async def recount_servers_current_users(session: Optional[AsyncSession] = None) -> int:
+    """
+    Пересчитать счетчики current_users всех серверов по активным подпискам
+    
+    Счетчики ведет триггер БД, пересчет исправляет расхождения (например, после
+    ручного изменения данных с отключенными триггерами). Обновляются только
+    серверы, у которых значение отличается.
+    
+    Returns:
+        Количество исправленных серверов
+    """
+    from sqlalchemy import update
+    
+    actual = (
+        select(func.count(Subscription.id))
+        .where(
+            and_(
+                Subscription.server_id == Server.id,
+                Subscription.status == "active"
+            )
+        )
+        .correlate(Server)
+        .scalar_subquery()
+    )
+    
+    async with get_session(session) as session:
+        result = await session.execute(
+            update(Server)
+            .where(Server.current_users.is_distinct_from(actual))
+            .values(current_users=actual)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        return result.rowcount or 0
+
+
+async def get_users_with_active_subscriptions_by_location(location_id: int, session: Optional[AsyncSession] = None) -> List[User]:
     """Получить всех пользователей с активными подписками на сервера в указанной локации
     
     Args:
         location_id: ID локации
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
         
     Returns:
         Список уникальных пользователей с активными подписками на сервера в локации
     """
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(User)
             .join(Subscription, User.id == Subscription.user_id)
@@ -1255,16 +2015,17 @@ async def get_users_with_active_subscriptions_by_location(location_id: int) -> L
         return list(result.scalars().all())
 
 
-async def get_users_with_subscriptions_by_server(server_id: int) -> List[User]:
+async def get_users_with_subscriptions_by_server(server_id: int, session: Optional[AsyncSession] = None) -> List[User]:
     """Получить всех пользователей с подписками на указанном сервере
     
     Args:
         server_id: ID сервера
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
         
     Returns:
         Список уникальных пользователей с подписками на сервере (любого статуса)
     """
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(User)
             .join(Subscription, User.id == Subscription.user_id)
@@ -1274,16 +2035,17 @@ async def get_users_with_subscriptions_by_server(server_id: int) -> List[User]:
         return list(result.scalars().all())
 
 
-async def get_subscriptions_by_location(location_id: int) -> List[Subscription]:
+async def get_subscriptions_by_location(location_id: int, session: Optional[AsyncSession] = None) -> List[Subscription]:
     """Получить все подписки для локации (на всех серверах этой локации)
     
     Args:
         location_id: ID локации
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
         
     Returns:
         Список всех подписок на серверах в указанной локации (любого статуса)
     """
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Subscription)
             .join(Server, Subscription.server_id == Server.id)
@@ -1294,16 +2056,17 @@ async def get_subscriptions_by_location(location_id: int) -> List[Subscription]:
         return list(result.unique().scalars().all())
 
 
-async def get_subscriptions_by_server(server_id: int) -> List[Subscription]:
+async def get_subscriptions_by_server(server_id: int, session: Optional[AsyncSession] = None) -> List[Subscription]:
     """Получить все подписки на указанном сервере
     
     Args:
         server_id: ID сервера
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
         
     Returns:
         Список всех подписок на сервере (любого статуса)
     """
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Subscription)
             .options(joinedload(Subscription.server).joinedload(Server.location))
@@ -1317,9 +2080,9 @@ async def get_subscriptions_by_server(server_id: int) -> List[Subscription]:
 
 # ==================== ПРОМОКОДЫ ====================
 
-async def create_promo_code(code: str, discount_percent: float, max_uses: Optional[int] = None, allow_reuse_by_same_user: bool = False) -> PromoCode:
+async def create_promo_code(code: str, discount_percent: float, max_uses: Optional[int] = None, allow_reuse_by_same_user: bool = False, session: Optional[AsyncSession] = None) -> PromoCode:
     """Создать промокод (max_uses=None для безлимитного промокода)"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         promo_code = PromoCode(
             code=code.upper().strip(),
             discount_percent=discount_percent,
@@ -1331,39 +2094,82 @@ async def create_promo_code(code: str, discount_percent: float, max_uses: Option
         session.add(promo_code)
         await session.commit()
         await session.refresh(promo_code)
-        return promo_code
+    
+    # Сбрасываем запись "промокод не найден" (get_promo_code_by_code)
+    await CacheService.invalidate_promo_code_cache(promo_code.code)
+    return promo_code
 
 
-async def get_promo_code_by_code(code: str) -> Optional[PromoCode]:
-    """Получить промокод по коду"""
-    async with async_session() as session:
-        result = await session.execute(
-            select(PromoCode).where(PromoCode.code == code.upper().strip())
-        )
-        return result.scalar_one_or_none()
+# Время жизни кэша промокода (в секундах)
+# Короткое, т.к. current_uses меняется при каждом использовании; лимит проверяется атомарно в use_promo_code
+PROMO_CODE_CACHE_TTL = 30
+
+PROMO_CODE_CACHE_FIELDS = (
+    "id", "code", "discount_percent", "max_uses", "current_uses",
+    "allow_reuse_by_same_user", "is_active", "created_at", "updated_at"
+)
+
+
+async def get_promo_code_by_code(code: str, use_cache: bool = True, session: Optional[AsyncSession] = None) -> Optional[PromoCode]:
+    """Получить промокод по коду (с коротким кэшированием, в том числе несуществующих кодов)"""
+    normalized_code = code.upper().strip()
+    cache_key = CacheKeys.PROMO_CODE_BY_CODE.format(code=normalized_code)
+    
+    async def load_promo_code() -> Optional[dict]:
+        async with get_session(session) as db_session:
+            result = await db_session.execute(
+                select(PromoCode).where(PromoCode.code == normalized_code)
+            )
+            promo_code = result.scalar_one_or_none()
+        if not promo_code:
+            return None
+        return {field: getattr(promo_code, field) for field in PROMO_CODE_CACHE_FIELDS}
+    
+    if not use_cache:
+        async with get_session(session) as session:
+            result = await session.execute(
+                select(PromoCode).where(PromoCode.code == normalized_code)
+            )
+            return result.scalar_one_or_none()
+    
+    cached = await CacheService.get_or_load(
+        cache_key,
+        load_promo_code,
+        ttl=PROMO_CODE_CACHE_TTL,
+        negative_ttl=PROMO_CODE_CACHE_TTL
+    )
+    if not cached:
+        return None
+    
+    # Восстанавливаем отсоединенный от сессии объект (словарь не изменяем - он общий для ожидающих загрузку)
+    data = dict(cached)
+    for field in ("created_at", "updated_at"):
+        if isinstance(data.get(field), str):
+            data[field] = datetime.fromisoformat(data[field])
+    return PromoCode(**data)
 
 
-async def get_promo_code_by_id(promo_code_id: int) -> Optional[PromoCode]:
+async def get_promo_code_by_id(promo_code_id: int, session: Optional[AsyncSession] = None) -> Optional[PromoCode]:
     """Получить промокод по ID"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(PromoCode).where(PromoCode.id == promo_code_id)
         )
         return result.scalar_one_or_none()
 
 
-async def get_all_promo_codes() -> List[PromoCode]:
+async def get_all_promo_codes(session: Optional[AsyncSession] = None) -> List[PromoCode]:
     """Получить все промокоды"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(PromoCode).order_by(PromoCode.created_at.desc())
         )
         return list(result.scalars().all())
 
 
-async def update_promo_code(promo_code_id: int, **kwargs) -> Optional[PromoCode]:
+async def update_promo_code(promo_code_id: int, session: Optional[AsyncSession] = None, **kwargs) -> Optional[PromoCode]:
     """Обновить промокод"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(PromoCode).where(PromoCode.id == promo_code_id)
         )
@@ -1371,6 +2177,8 @@ async def update_promo_code(promo_code_id: int, **kwargs) -> Optional[PromoCode]
         if not promo_code:
             return None
         
+        old_code = promo_code.code
+        
         for key, value in kwargs.items():
             if hasattr(promo_code, key):
                 setattr(promo_code, key, value)
@@ -1378,12 +2186,18 @@ async def update_promo_code(promo_code_id: int, **kwargs) -> Optional[PromoCode]
         promo_code.updated_at = datetime.utcnow()
         await session.commit()
         await session.refresh(promo_code)
-        return promo_code
+    
+    # Инвалидируем кэш (код промокода мог измениться)
+    await CacheService.invalidate_promo_code_cache(old_code)
+    if promo_code.code != old_code:
+        await CacheService.invalidate_promo_code_cache(promo_code.code)
+    
+    return promo_code
 
 
-async def delete_promo_code(promo_code_id: int) -> bool:
+async def delete_promo_code(promo_code_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Удалить промокод"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(PromoCode).where(PromoCode.id == promo_code_id)
         )
@@ -1391,12 +2205,15 @@ async def delete_promo_code(promo_code_id: int) -> bool:
         if not promo_code:
             return False
         
+        code = promo_code.code
         await session.delete(promo_code)
         await session.commit()
-        return True
+    
+    await CacheService.invalidate_promo_code_cache(code)
+    return True
 
 
-async def can_use_promo_code(promo_code: PromoCode, user_id: int) -> tuple[bool, str]:
+async def can_use_promo_code(promo_code: PromoCode, user_id: int, session: Optional[AsyncSession] = None) -> tuple[bool, str]:
     """
     Проверить, может ли пользователь использовать промокод
     Возвращает (может_использовать, сообщение_об_ошибке)
@@ -1410,7 +2227,7 @@ async def can_use_promo_code(promo_code: PromoCode, user_id: int) -> tuple[bool,
     
     # Проверяем, использовал ли пользователь уже этот промокод (только если не разрешено повторное использование)
     if not promo_code.allow_reuse_by_same_user:
-        async with async_session() as session:
+        async with get_session(session) as session:
             result = await session.execute(
                 select(PromoCodeUsage).where(
                     and_(
@@ -1426,21 +2243,65 @@ async def can_use_promo_code(promo_code: PromoCode, user_id: int) -> tuple[bool,
     return True, ""
 
 
-async def use_promo_code(promo_code_id: int, user_id: int, payment_id: int = None) -> Optional[PromoCodeUsage]:
-    """Использовать промокод (увеличить счетчик использований и создать запись)"""
-    async with async_session() as session:
-        # Получаем промокод
-        result = await session.execute(
-            select(PromoCode).where(PromoCode.id == promo_code_id)
+async def use_promo_code(promo_code_id: int, user_id: int, payment_id: int = None, session: Optional[AsyncSession] = None) -> Optional[PromoCodeUsage]:
+    """
+    Использовать промокод (увеличить счетчик использований и создать запись)
+    
+    Счетчик увеличивается одним условным UPDATE: только если промокод активен, лимит не исчерпан
+    и (при запрете повторного использования) пользователь еще не использовал промокод.
+    Так конкурентные покупки не теряют обновления и не превышают max_uses.
+    Одновременные использования промокода одним пользователем выполняются по очереди
+    (advisory-блокировка на пару промокод/пользователь до конца транзакции): иначе
+    проверка повторного использования не увидела бы запись, созданную параллельной покупкой.
+    
+    Вызывается до создания платежа со скидкой: если промокод использовать нельзя, платеж
+    не создается. Запись затем привязывается к платежу (set_promo_code_usage_payment)
+    или отменяется, если платеж создать не удалось (release_promo_code_usage).
+    
+    Returns:
+        Запись PromoCodeUsage или None, если промокод не найден или использовать его нельзя
+    """
+    from sqlalchemy import update, exists
+    
+    async with get_session(session) as session:
+        # Проверка ниже выполняется отдельным запросом после получения блокировки, поэтому
+        # в READ COMMITTED она видит запись об использовании, закоммиченную предыдущей покупкой
+        await session.execute(select(func.pg_advisory_xact_lock(promo_code_id, user_id)))
+        
+        already_used = exists().where(
+            and_(
+                PromoCodeUsage.promo_code_id == PromoCode.id,
+                PromoCodeUsage.user_id == user_id
+            )
         )
-        promo_code = result.scalar_one_or_none()
-        if not promo_code:
+        result = await session.execute(
+            update(PromoCode)
+            .where(
+                PromoCode.id == promo_code_id,
+                PromoCode.is_active == True,
+                or_(
+                    PromoCode.max_uses.is_(None),
+                    PromoCode.current_uses < PromoCode.max_uses
+                ),
+                or_(
+                    PromoCode.allow_reuse_by_same_user == True,
+                    ~already_used
+                )
+            )
+            .values(
+                current_uses=PromoCode.current_uses + 1,
+                updated_at=datetime.utcnow()
+            )
+            .returning(PromoCode.id)
+            .execution_options(synchronize_session=False)
+        )
+        if result.scalar_one_or_none() is None:
+            # Ничего не изменено - откатывать нечего
+            import logging
+            logger = logging.getLogger(__name__)
+            logger.warning(f"⚠️ Промокод {promo_code_id} не может быть использован пользователем {user_id} (исчерпан, неактивен или уже использован)")
             return None
         
-        # Увеличиваем счетчик использований
-        promo_code.current_uses += 1
-        promo_code.updated_at = datetime.utcnow()
-        
         # Создаем запись об использовании
         usage = PromoCodeUsage(
             promo_code_id=promo_code_id,
@@ -1454,9 +2315,55 @@ async def use_promo_code(promo_code_id: int, user_id: int, payment_id: int = Non
         return usage
 
 
-async def has_user_used_promo_code(user_id: int, promo_code_id: int) -> bool:
+async def set_promo_code_usage_payment(usage_id: int, payment_id: int, session: Optional[AsyncSession] = None) -> None:
+    """Привязать использование промокода к созданному платежу"""
+    from sqlalchemy import update
+    
+    async with get_session(session) as session:
+        await session.execute(
+            update(PromoCodeUsage)
+            .where(PromoCodeUsage.id == usage_id)
+            .values(payment_id=payment_id)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+
+
+async def release_promo_code_usage(usage_id: int, session: Optional[AsyncSession] = None) -> bool:
+    """
+    Отменить использование промокода (платеж со скидкой создать не удалось)
+    
+    Удаляет запись PromoCodeUsage и уменьшает счетчик использований промокода.
+    
+    Returns:
+        True если запись была удалена
+    """
+    from sqlalchemy import update, delete
+    
+    async with get_session(session) as session:
+        result = await session.execute(
+            delete(PromoCodeUsage)
+            .where(PromoCodeUsage.id == usage_id)
+            .returning(PromoCodeUsage.promo_code_id)
+            .execution_options(synchronize_session=False)
+        )
+        promo_code_id = result.scalar_one_or_none()
+        if promo_code_id is None:
+            return False
+        
+        await session.execute(
+            update(PromoCode)
+            .where(PromoCode.id == promo_code_id, PromoCode.current_uses > 0)
+            .values(current_uses=PromoCode.current_uses - 1, updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        return True
+
+
+async def has_user_used_promo_code(user_id: int, promo_code_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Проверить, использовал ли пользователь промокод"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(PromoCodeUsage).where(
                 and_(
@@ -1474,15 +2381,16 @@ async def has_user_used_promo_code(user_id: int, promo_code_id: int) -> bool:
 MAX_MESSAGE_LENGTH = 4000  # Максимальная длина сообщения (символов)
 MAX_PHOTO_SIZE_MB = 10  # Максимальный размер изображения (МБ)
 
-async def create_support_ticket(user_id: int, message: str, photo_file_id: str = None) -> SupportTicket:
+async def create_support_ticket(user_id: int, message: str, photo_file_id: str = None, session: Optional[AsyncSession] = None) -> SupportTicket:
     """Создать новый тикет поддержки
     
     Args:
         user_id: ID пользователя
         message: Текст сообщения
         photo_file_id: file_id изображения в Telegram (опционально)
+        session: Сессия БД (по умолчанию - сессия текущего обновления или новая)
     """
-    async with async_session() as session:
+    async with get_session(session) as session:
         ticket = SupportTicket(
             user_id=user_id,
             message=message,
@@ -1495,9 +2403,9 @@ async def create_support_ticket(user_id: int, message: str, photo_file_id: str =
         return ticket
 
 
-async def get_support_ticket_by_id(ticket_id: int) -> Optional[SupportTicket]:
+async def get_support_ticket_by_id(ticket_id: int, session: Optional[AsyncSession] = None) -> Optional[SupportTicket]:
     """Получить тикет по ID"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(SupportTicket)
             .options(joinedload(SupportTicket.user))
@@ -1506,9 +2414,9 @@ async def get_support_ticket_by_id(ticket_id: int) -> Optional[SupportTicket]:
         return result.unique().scalar_one_or_none()
 
 
-async def get_user_support_tickets(user_id: int) -> List[SupportTicket]:
+async def get_user_support_tickets(user_id: int, session: Optional[AsyncSession] = None) -> List[SupportTicket]:
     """Получить все тикеты пользователя"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(SupportTicket)
             .where(SupportTicket.user_id == user_id)
@@ -1517,9 +2425,9 @@ async def get_user_support_tickets(user_id: int) -> List[SupportTicket]:
         return list(result.scalars().all())
 
 
-async def get_all_support_tickets() -> List[SupportTicket]:
+async def get_all_support_tickets(session: Optional[AsyncSession] = None) -> List[SupportTicket]:
     """Получить все тикеты (для админов)"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(SupportTicket)
             .options(joinedload(SupportTicket.user))
@@ -1528,9 +2436,9 @@ async def get_all_support_tickets() -> List[SupportTicket]:
         return list(result.unique().scalars().all())
 
 
-async def get_open_support_tickets() -> List[SupportTicket]:
+async def get_open_support_tickets(session: Optional[AsyncSession] = None) -> List[SupportTicket]:
     """Получить все открытые тикеты (для админов)"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(SupportTicket)
             .options(joinedload(SupportTicket.user))
@@ -1540,9 +2448,9 @@ async def get_open_support_tickets() -> List[SupportTicket]:
         return list(result.unique().scalars().all())
 
 
-async def update_support_ticket(ticket_id: int, **kwargs) -> Optional[SupportTicket]:
+async def update_support_ticket(ticket_id: int, session: Optional[AsyncSession] = None, **kwargs) -> Optional[SupportTicket]:
     """Обновить данные тикета"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(SupportTicket).where(SupportTicket.id == ticket_id)
         )
@@ -1560,9 +2468,9 @@ async def update_support_ticket(ticket_id: int, **kwargs) -> Optional[SupportTic
         return ticket
 
 
-async def answer_support_ticket(ticket_id: int, admin_response: str) -> Optional[SupportTicket]:
+async def answer_support_ticket(ticket_id: int, admin_response: str, session: Optional[AsyncSession] = None) -> Optional[SupportTicket]:
     """Получить данные тикета перед удалением (для отправки уведомления)"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(SupportTicket)
             .options(joinedload(SupportTicket.user))
@@ -1577,9 +2485,9 @@ async def answer_support_ticket(ticket_id: int, admin_response: str) -> Optional
         return ticket
 
 
-async def delete_support_ticket(ticket_id: int) -> bool:
+async def delete_support_ticket(ticket_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Удалить тикет поддержки из базы данных"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(SupportTicket).where(SupportTicket.id == ticket_id)
         )
@@ -1594,9 +2502,9 @@ async def delete_support_ticket(ticket_id: int) -> bool:
 
 # ========== Функции для работы с платформами и туториалами ==========
 
-async def get_all_platforms() -> List[Platform]:
+async def get_all_platforms(session: Optional[AsyncSession] = None) -> List[Platform]:
     """Получить все платформы"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Platform)
             .order_by(Platform.order, Platform.id)
@@ -1604,9 +2512,9 @@ async def get_all_platforms() -> List[Platform]:
         return list(result.scalars().all())
 
 
-async def get_active_platforms() -> List[Platform]:
+async def get_active_platforms(session: Optional[AsyncSession] = None) -> List[Platform]:
     """Получить все активные платформы"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Platform)
             .where(Platform.is_active == True)
@@ -1615,27 +2523,27 @@ async def get_active_platforms() -> List[Platform]:
         return list(result.scalars().all())
 
 
-async def get_platform_by_id(platform_id: int) -> Optional[Platform]:
+async def get_platform_by_id(platform_id: int, session: Optional[AsyncSession] = None) -> Optional[Platform]:
     """Получить платформу по ID"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Platform).where(Platform.id == platform_id)
         )
         return result.scalar_one_or_none()
 
 
-async def get_platform_by_name(name: str) -> Optional[Platform]:
+async def get_platform_by_name(name: str, session: Optional[AsyncSession] = None) -> Optional[Platform]:
     """Получить платформу по имени"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Platform).where(Platform.name == name)
         )
         return result.scalar_one_or_none()
 
 
-async def create_platform(name: str, display_name: str, description: str = None, is_active: bool = True, order: int = 0) -> Platform:
+async def create_platform(name: str, display_name: str, description: str = None, is_active: bool = True, order: int = 0, session: Optional[AsyncSession] = None) -> Platform:
     """Создать новую платформу"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         platform = Platform(
             name=name,
             display_name=display_name,
@@ -1649,9 +2557,9 @@ async def create_platform(name: str, display_name: str, description: str = None,
         return platform
 
 
-async def update_platform(platform_id: int, **kwargs) -> Optional[Platform]:
+async def update_platform(platform_id: int, session: Optional[AsyncSession] = None, **kwargs) -> Optional[Platform]:
     """Обновить данные платформы"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Platform).where(Platform.id == platform_id)
         )
@@ -1669,9 +2577,9 @@ async def update_platform(platform_id: int, **kwargs) -> Optional[Platform]:
         return platform
 
 
-async def delete_platform(platform_id: int) -> bool:
+async def delete_platform(platform_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Удалить платформу (каскадно удалит все туториалы и файлы)"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Platform).where(Platform.id == platform_id)
         )
@@ -1684,9 +2592,9 @@ async def delete_platform(platform_id: int) -> bool:
         return True
 
 
-async def get_tutorials_by_platform(platform_id: int, is_basic: bool = None, is_active: bool = True) -> List[Tutorial]:
+async def get_tutorials_by_platform(platform_id: int, is_basic: bool = None, is_active: bool = True, session: Optional[AsyncSession] = None) -> List[Tutorial]:
     """Получить туториалы для платформы"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         query = select(Tutorial).where(Tutorial.platform_id == platform_id)
         
         if is_basic is not None:
@@ -1701,9 +2609,9 @@ async def get_tutorials_by_platform(platform_id: int, is_basic: bool = None, is_
         return list(result.scalars().all())
 
 
-async def get_tutorial_by_id(tutorial_id: int) -> Optional[Tutorial]:
+async def get_tutorial_by_id(tutorial_id: int, session: Optional[AsyncSession] = None) -> Optional[Tutorial]:
     """Получить туториал по ID с загруженными файлами"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Tutorial)
             .options(selectinload(Tutorial.files))
@@ -1720,10 +2628,11 @@ async def create_tutorial(
     video_note_id: str = None,
     is_basic: bool = True,
     order: int = 0,
-    is_active: bool = True
+    is_active: bool = True,
+    session: Optional[AsyncSession] = None
 ) -> Tutorial:
     """Создать новый туториал"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         tutorial = Tutorial(
             platform_id=platform_id,
             title=title,
@@ -1740,9 +2649,9 @@ async def create_tutorial(
         return tutorial
 
 
-async def update_tutorial(tutorial_id: int, **kwargs) -> Optional[Tutorial]:
+async def update_tutorial(tutorial_id: int, session: Optional[AsyncSession] = None, **kwargs) -> Optional[Tutorial]:
     """Обновить данные туториала"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Tutorial).where(Tutorial.id == tutorial_id)
         )
@@ -1761,9 +2670,9 @@ async def update_tutorial(tutorial_id: int, **kwargs) -> Optional[Tutorial]:
         return tutorial
 
 
-async def delete_tutorial(tutorial_id: int) -> bool:
+async def delete_tutorial(tutorial_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Удалить туториал (каскадно удалит все файлы)"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Tutorial).where(Tutorial.id == tutorial_id)
         )
@@ -1776,9 +2685,9 @@ async def delete_tutorial(tutorial_id: int) -> bool:
         return True
 
 
-async def get_tutorial_files(tutorial_id: int) -> List[TutorialFile]:
+async def get_tutorial_files(tutorial_id: int, session: Optional[AsyncSession] = None) -> List[TutorialFile]:
     """Получить все файлы туториала"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(TutorialFile)
             .where(TutorialFile.tutorial_id == tutorial_id)
@@ -1793,10 +2702,11 @@ async def add_tutorial_file(
     file_name: str = None,
     file_type: str = None,
     description: str = None,
-    order: int = 0
+    order: int = 0,
+    session: Optional[AsyncSession] = None
 ) -> TutorialFile:
     """Добавить файл к туториалу"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         tutorial_file = TutorialFile(
             tutorial_id=tutorial_id,
             file_id=file_id,
@@ -1811,9 +2721,9 @@ async def add_tutorial_file(
         return tutorial_file
 
 
-async def delete_tutorial_file(file_id: int) -> bool:
+async def delete_tutorial_file(file_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Удалить файл туториала"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(TutorialFile).where(TutorialFile.id == file_id)
         )
@@ -1826,9 +2736,9 @@ async def delete_tutorial_file(file_id: int) -> bool:
         return True
 
 
-async def get_basic_tutorial_for_platform(platform_id: int) -> Optional[Tutorial]:
+async def get_basic_tutorial_for_platform(platform_id: int, session: Optional[AsyncSession] = None) -> Optional[Tutorial]:
     """Получить базовый туториал для платформы"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Tutorial)
             .options(selectinload(Tutorial.files))
@@ -1845,9 +2755,9 @@ async def get_basic_tutorial_for_platform(platform_id: int) -> Optional[Tutorial
         return result.unique().scalar_one_or_none()
 
 
-async def get_additional_tutorials_for_platform(platform_id: int) -> List[Tutorial]:
+async def get_additional_tutorials_for_platform(platform_id: int, session: Optional[AsyncSession] = None) -> List[Tutorial]:
     """Получить дополнительные туториалы для платформы"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(Tutorial)
             .options(selectinload(Tutorial.files))
@@ -1865,9 +2775,9 @@ async def get_additional_tutorials_for_platform(platform_id: int) -> List[Tutori
 
 # ========== Функции для работы с документацией админов ==========
 
-async def get_all_documentations() -> List[AdminDocumentation]:
+async def get_all_documentations(session: Optional[AsyncSession] = None) -> List[AdminDocumentation]:
     """Получить все документации"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(AdminDocumentation)
             .order_by(AdminDocumentation.created_at.desc())
@@ -1875,9 +2785,9 @@ async def get_all_documentations() -> List[AdminDocumentation]:
         return list(result.scalars().all())
 
 
-async def get_documentation_by_id(doc_id: int) -> Optional[AdminDocumentation]:
+async def get_documentation_by_id(doc_id: int, session: Optional[AsyncSession] = None) -> Optional[AdminDocumentation]:
     """Получить документацию по ID с загруженными файлами"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(AdminDocumentation)
             .options(selectinload(AdminDocumentation.files))
@@ -1889,10 +2799,11 @@ async def get_documentation_by_id(doc_id: int) -> Optional[AdminDocumentation]:
 async def create_documentation(
     title: str,
     content: str = None,
-    created_by: int = None
+    created_by: int = None,
+    session: Optional[AsyncSession] = None
 ) -> AdminDocumentation:
     """Создать новую документацию"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         doc = AdminDocumentation(
             title=title,
             content=content,
@@ -1904,9 +2815,9 @@ async def create_documentation(
         return doc
 
 
-async def update_documentation(doc_id: int, **kwargs) -> Optional[AdminDocumentation]:
+async def update_documentation(doc_id: int, session: Optional[AsyncSession] = None, **kwargs) -> Optional[AdminDocumentation]:
     """Обновить данные документации"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(AdminDocumentation).where(AdminDocumentation.id == doc_id)
         )
@@ -1925,9 +2836,9 @@ async def update_documentation(doc_id: int, **kwargs) -> Optional[AdminDocumenta
         return doc
 
 
-async def delete_documentation(doc_id: int) -> bool:
+async def delete_documentation(doc_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Удалить документацию (каскадно удалит все файлы)"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(AdminDocumentation).where(AdminDocumentation.id == doc_id)
         )
@@ -1940,9 +2851,9 @@ async def delete_documentation(doc_id: int) -> bool:
         return True
 
 
-async def get_documentation_files(doc_id: int) -> List[AdminDocumentationFile]:
+async def get_documentation_files(doc_id: int, session: Optional[AsyncSession] = None) -> List[AdminDocumentationFile]:
     """Получить все файлы документации"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(AdminDocumentationFile)
             .where(AdminDocumentationFile.documentation_id == doc_id)
@@ -1957,10 +2868,11 @@ async def add_documentation_file(
     file_name: str = None,
     file_type: str = None,
     description: str = None,
-    order: int = 0
+    order: int = 0,
+    session: Optional[AsyncSession] = None
 ) -> AdminDocumentationFile:
     """Добавить файл к документации"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         doc_file = AdminDocumentationFile(
             documentation_id=documentation_id,
             file_id=file_id,
@@ -1975,9 +2887,9 @@ async def add_documentation_file(
         return doc_file
 
 
-async def delete_documentation_file(file_id: int) -> bool:
+async def delete_documentation_file(file_id: int, session: Optional[AsyncSession] = None) -> bool:
     """Удалить файл документации"""
-    async with async_session() as session:
+    async with get_session(session) as session:
         result = await session.execute(
             select(AdminDocumentationFile).where(AdminDocumentationFile.id == file_id)
         )
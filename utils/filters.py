@@ -1,15 +1,21 @@
 from aiogram.filters import BaseFilter
 from aiogram.types import Message, CallbackQuery
-from typing import Union
-from utils.db import is_admin
+from typing import Optional, Union
+from utils.db import is_admin as check_is_admin
 
 
 class AdminFilter(BaseFilter):
-    """Фильтр для проверки прав администратора"""
+    """
+    Фильтр для проверки прав администратора
     
-    async def __call__(self, obj: Union[Message, CallbackQuery]) -> bool:
-        user_id = str(obj.from_user.id)
-        return await is_admin(user_id)
+    Флаг is_admin добавляет AdminMiddleware один раз на обновление,
+    запрос к кэшу администраторов выполняется только без middleware.
+    """
+    
+    async def __call__(self, obj: Union[Message, CallbackQuery], is_admin: Optional[bool] = None) -> bool:
+        if is_admin is not None:
+            return is_admin
+        return await check_is_admin(str(obj.from_user.id))
 
 
 class SimpleEditServerFilter(BaseFilter):
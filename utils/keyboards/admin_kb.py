@@ -103,8 +103,8 @@ def users_menu():
     return kb.as_markup()
 
 
-def user_list_keyboard(users: list[User], page: int = 0, total_pages: int = 1):
-    """Клавиатура со списком пользователей с пагинацией"""
+def user_list_keyboard(users: list[User], page: int = 0, has_prev: bool = False, has_next: bool = False):
+    """Клавиатура со списком пользователей с пагинацией (курсор - ID первого/последнего пользователя страницы)"""
     kb = InlineKeyboardBuilder()
     
     # Кнопки пользователей
@@ -125,10 +125,10 @@ def user_list_keyboard(users: list[User], page: int = 0, total_pages: int = 1):
     
     # Кнопки пагинации
     nav_buttons = []
-    if page > 0:
-        nav_buttons.append(("◀️ Назад", f"admin_users_page_{page - 1}"))
-    if page < total_pages - 1:
-        nav_buttons.append(("Вперед ▶️", f"admin_users_page_{page + 1}"))
+    if has_prev:
+        nav_buttons.append(("◀️ Назад", f"admin_users_prev_{max(page - 1, 0)}_{users[0].id}"))
+    if has_next:
+        nav_buttons.append(("Вперед ▶️", f"admin_users_next_{page + 1}_{users[-1].id}"))
     
     for text, callback_data in nav_buttons:
         kb.button(text=text, callback_data=callback_data)
@@ -145,6 +145,46 @@ def user_list_keyboard(users: list[User], page: int = 0, total_pages: int = 1):
     return kb.as_markup()
 
 
+
+def user_search_results_keyboard(users: list[User], page: int = 0, has_next: bool = False):
+    """Клавиатура с результатами поиска пользователей (строка поиска хранится в FSM)"""
+    kb = InlineKeyboardBuilder()
+    
+    for user in users:
+        admin_badge = "👑 " if user.is_admin else ""
+        status_emoji = {
+            "active": "✅",
+            "paused": "⏸️",
+            "expired": "❌"
+        }.get(user.status, "❓")
+        
+        username = user.username or f"ID: {user.tg_id}"
+        kb.button(
+            text=f"{status_emoji} {admin_badge}{username[:25]}",
+            callback_data=f"admin_user_view_{user.id}"
+        )
+    
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(("◀️ Назад", f"admin_user_search_page_{page - 1}"))
+    if has_next:
+        nav_buttons.append(("Вперед ▶️", f"admin_user_search_page_{page + 1}"))
+    
+    for text, callback_data in nav_buttons:
+        kb.button(text=text, callback_data=callback_data)
+    
+    kb.button(text="🔍 Новый поиск", callback_data="admin_user_search")
+    kb.button(text="🔙 Назад", callback_data="admin_users")
+    
+    # Пользователи по 1, навигация в ряд, остальные кнопки по 1
+    sizes = [1] * len(users)
+    if nav_buttons:
+        sizes.append(len(nav_buttons))
+    kb.adjust(*sizes, 1)
+    
+    return kb.as_markup()
+
+
 def user_detail_keyboard(user_id: int, is_admin: bool, subscriptions=None):
     """Клавиатура для деталей пользователя"""
     kb = InlineKeyboardBuilder()
@@ -204,7 +244,31 @@ def stats_keyboard():
     """Клавиатура для статистики"""
     kb = InlineKeyboardBuilder()
     kb.button(text="🔄 Обновить", callback_data="admin_stats")
+    kb.button(text="⏱️ Скорость покупки", callback_data="admin_purchase_latency")
     kb.button(text="🔙 Назад", callback_data="admin_menu")
     kb.adjust(1)
     return kb.as_markup()
 
+
+def purchase_latency_keyboard():
+    """Клавиатура для сводки по скорости покупки"""
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🔄 Обновить", callback_data="admin_purchase_latency")
+    kb.button(text="🔙 Назад", callback_data="admin_stats")
+    kb.adjust(1)
+    return kb.as_markup()
+
+
+def broadcast_control_keyboard(broadcast_id: str, status: str):
+    """Клавиатура управления рассылкой (None для завершенной или отмененной рассылки)"""
+    if status not in ("running", "paused"):
+        return None
+    kb = InlineKeyboardBuilder()
+    if status == "running":
+        kb.button(text="⏸️ Пауза", callback_data=f"broadcast_pause_{broadcast_id}")
+    else:
+        kb.button(text="▶️ Продолжить", callback_data=f"broadcast_resume_{broadcast_id}")
+    kb.button(text="⏹️ Остановить", callback_data=f"broadcast_stop_{broadcast_id}")
+    kb.adjust(2)
+    return kb.as_markup()
+
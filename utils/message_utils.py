@@ -2,26 +2,65 @@
 Утилиты для работы с сообщениями с автоматическим сохранением ID
 """
 from functools import wraps
-from typing import Callable, Any
+from typing import Callable, Any, Optional
 from aiogram.types import Message, CallbackQuery
 from aiogram.exceptions import TelegramNetworkError, TelegramBadRequest
-from aiohttp.client_exceptions import ClientConnectorError
 from core.storage import redis_client
 import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
 
+# ID последних сообщений бота в чате пользователя (list)
+# (удаляются при следующем действии пользователя, см. CleanupMessagesMiddleware)
+BOT_MESSAGE_IDS_KEY = "bot_messages:{chat_id}:{user_id}:ids"
+BOT_MESSAGES_TTL = 86400  # 24 часа
+# Сколько последних сообщений бота хранить на чат
+MAX_TRACKED_BOT_MESSAGES = 20
+
+
+class BotMessageTracker:
+    """
+    Запись ID сообщений бота в Redis пачками
+
+    save_bot_message() не ждет Redis: ID копятся в памяти и записываются одним
+    pipeline в ближайшей итерации event loop (все сообщения, отправленные за это время).
+    """
+    
+    def __init__(self):
+        self._pending: list[tuple[int, int, int]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+    
+    def track(self, chat_id: int, user_id: int, message_id: int) -> None:
+        self._pending.append((chat_id, user_id, message_id))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+    
+    async def _flush(self) -> None:
+        # Даем накопиться сообщениям, отправленным в текущей итерации event loop
+        await asyncio.sleep(0)
+        while self._pending:
+            pending, self._pending = self._pending, []
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                for chat_id, user_id, message_id in pending:
+                    redis_key = BOT_MESSAGE_IDS_KEY.format(chat_id=chat_id, user_id=user_id)
+                    pipe.lpush(redis_key, str(message_id))
+                    pipe.ltrim(redis_key, 0, MAX_TRACKED_BOT_MESSAGES - 1)
+                    pipe.expire(redis_key, BOT_MESSAGES_TTL)
+                await pipe.execute()
+            except Exception as e:
+                logger.debug(f"Ошибка сохранения ID сообщений бота: {e}")
+
+
+bot_message_tracker = BotMessageTracker()
+
 
 async def save_bot_message(chat_id: int, user_id: int, message_id: int):
     """
-    Сохраняет ID сообщения бота для последующего удаления
+    Сохраняет ID сообщения бота для последующего удаления (запись в Redis идет в фоне)
     """
-    try:
-        redis_key = f"last_bot_message:{chat_id}:{user_id}"
-        await redis_client.set(redis_key, str(message_id), ex=86400)  # TTL 24 часа
-    except Exception:
-        pass
+    bot_message_tracker.track(chat_id, user_id, message_id)
 
 
 async def safe_callback_answer(callback: CallbackQuery, text: str = None, show_alert: bool = False, **kwargs):
@@ -73,180 +112,6 @@ async def safe_callback_answer(callback: CallbackQuery, text: str = None, show_a
         return False
 
 
-def patch_bot_methods():
-    """
-    Патчит методы Message.answer() и Bot.send_message() для автоматического добавления кнопок главного меню
-    Использует monkey patching через класс
-    """
-    from aiogram import Bot
-    from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardMarkup
-    
-    # Сохраняем оригинальные методы
-    original_message_answer = Message.answer
-    original_bot_send_message = Bot.send_message
-    original_bot_send_photo = Bot.send_photo
-    
-    async def patched_message_answer(self: Message, text: str = None, **kwargs) -> Message:
-        """Патченный метод Message.answer() с автоматическим добавлением кнопок управления и retry логикой"""
-        # Проверяем, есть ли reply_markup в kwargs
-        reply_markup = kwargs.get('reply_markup')
-        
-        # Определяем тип reply_markup
-        is_reply_keyboard = isinstance(reply_markup, ReplyKeyboardMarkup) if reply_markup else False
-        is_inline_keyboard = isinstance(reply_markup, InlineKeyboardMarkup) if reply_markup else False
-        
-        # Автоматически добавляем кнопки управления (ReplyKeyboardMarkup) к каждому сообщению
-        # НО: только если в сообщении нет ReplyKeyboardMarkup И нет InlineKeyboardMarkup
-        # ВАЖНО: В Telegram нельзя одновременно иметь ReplyKeyboardMarkup и InlineKeyboardMarkup
-        if not is_reply_keyboard and not is_inline_keyboard:
-            from utils.keyboards.main_kb import main_menu
-            kwargs['reply_markup'] = main_menu()
-        
-        # Retry логика для сетевых ошибок
-        max_retries = 3
-        retry_delay = 2
-        last_error = None
-        
-        for attempt in range(max_retries):
-            try:
-                # Вызываем оригинальный метод
-                if text is None:
-                    result = await original_message_answer(self, **kwargs)
-                else:
-                    result = await original_message_answer(self, text, **kwargs)
-                return result
-            except (TelegramNetworkError, ClientConnectorError, ConnectionError, TimeoutError, asyncio.TimeoutError) as network_error:
-                last_error = network_error
-                if attempt < max_retries - 1:
-                    logger.warning(
-                        f"⚠️ Сетевая ошибка при отправке сообщения через message.answer() "
-                        f"(попытка {attempt + 1}/{max_retries}): {type(network_error).__name__}: {network_error}. "
-                        f"Повтор через {retry_delay} сек..."
-                    )
-                    await asyncio.sleep(retry_delay)
-                    retry_delay *= 2  # Экспоненциальная задержка
-                else:
-                    logger.error(
-                        f"❌ Не удалось отправить сообщение через message.answer() после {max_retries} попыток: "
-                        f"{type(network_error).__name__}: {network_error}"
-                    )
-                    # Пробрасываем ошибку дальше, чтобы обработчик мог её обработать
-                    raise
-        
-        # Если дошли сюда, значит все попытки исчерпаны
-        if last_error:
-            raise last_error
-    
-    async def patched_bot_send_message(self: Bot, chat_id, text: str = None, **kwargs):
-        """Патченный метод Bot.send_message() с автоматическим добавлением кнопок управления и retry логикой"""
-        # Проверяем, есть ли reply_markup в kwargs
-        reply_markup = kwargs.get('reply_markup')
-        
-        # Определяем тип reply_markup
-        is_reply_keyboard = isinstance(reply_markup, ReplyKeyboardMarkup) if reply_markup else False
-        is_inline_keyboard = isinstance(reply_markup, InlineKeyboardMarkup) if reply_markup else False
-        
-        # Автоматически добавляем кнопки управления, если их нет
-        if not is_reply_keyboard and not is_inline_keyboard:
-            from utils.keyboards.main_kb import main_menu
-            kwargs['reply_markup'] = main_menu()
-        
-        # Retry логика для сетевых ошибок
-        max_retries = 3
-        retry_delay = 2
-        last_error = None
-        
-        for attempt in range(max_retries):
-            try:
-                # Вызываем оригинальный метод
-                if text is None:
-                    return await original_bot_send_message(self, chat_id, **kwargs)
-                else:
-                    return await original_bot_send_message(self, chat_id, text, **kwargs)
-            except (TelegramNetworkError, ClientConnectorError, ConnectionError, TimeoutError, asyncio.TimeoutError) as network_error:
-                last_error = network_error
-                if attempt < max_retries - 1:
-                    logger.warning(
-                        f"⚠️ Сетевая ошибка при отправке сообщения через bot.send_message() "
-                        f"(попытка {attempt + 1}/{max_retries}): {type(network_error).__name__}: {network_error}. "
-                        f"Повтор через {retry_delay} сек..."
-                    )
-                    await asyncio.sleep(retry_delay)
-                    retry_delay *= 2  # Экспоненциальная задержка
-                else:
-                    logger.error(
-                        f"❌ Не удалось отправить сообщение через bot.send_message() после {max_retries} попыток: "
-                        f"{type(network_error).__name__}: {network_error}"
-                    )
-                    # Пробрасываем ошибку дальше, чтобы обработчик мог её обработать
-                    raise
-        
-        # Если дошли сюда, значит все попытки исчерпаны
-        if last_error:
-            raise last_error
-    
-    async def patched_bot_send_photo(self: Bot, chat_id, photo, **kwargs):
-        """Патченный метод Bot.send_photo() с автоматическим добавлением кнопок управления и retry логикой"""
-        # Проверяем, есть ли reply_markup в kwargs
-        reply_markup = kwargs.get('reply_markup')
-        
-        # Определяем тип reply_markup
-        is_reply_keyboard = isinstance(reply_markup, ReplyKeyboardMarkup) if reply_markup else False
-        is_inline_keyboard = isinstance(reply_markup, InlineKeyboardMarkup) if reply_markup else False
-        
-        # Автоматически добавляем кнопки управления, если их нет
-        if not is_reply_keyboard and not is_inline_keyboard:
-            from utils.keyboards.main_kb import main_menu
-            kwargs['reply_markup'] = main_menu()
-        
-        # Retry логика для сетевых ошибок
-        max_retries = 3
-        retry_delay = 2
-        last_error = None
-        
-        for attempt in range(max_retries):
-            try:
-                # Вызываем оригинальный метод
-                return await original_bot_send_photo(self, chat_id, photo, **kwargs)
-            except (TelegramNetworkError, ClientConnectorError, ConnectionError, TimeoutError, asyncio.TimeoutError) as network_error:
-                last_error = network_error
-                if attempt < max_retries - 1:
-                    logger.warning(
-                        f"⚠️ Сетевая ошибка при отправке фото через bot.send_photo() "
-                        f"(попытка {attempt + 1}/{max_retries}): {type(network_error).__name__}: {network_error}. "
-                        f"Повтор через {retry_delay} сек..."
-                    )
-                    await asyncio.sleep(retry_delay)
-                    retry_delay *= 2  # Экспоненциальная задержка
-                else:
-                    logger.error(
-                        f"❌ Не удалось отправить фото через bot.send_photo() после {max_retries} попыток: "
-                        f"{type(network_error).__name__}: {network_error}"
-                    )
-                    # Пробрасываем ошибку дальше, чтобы обработчик мог её обработать
-                    raise
-        
-        # Если дошли сюда, значит все попытки исчерпаны
-        if last_error:
-            raise last_error
-    
-    # Применяем патчи на уровне классов
-    Message.answer = patched_message_answer
-    Bot.send_message = patched_bot_send_message
-    Bot.send_photo = patched_bot_send_photo
-
-
-async def save_bot_message(chat_id: int, user_id: int, message_id: int):
-    """
-    Сохраняет ID сообщения бота для последующего удаления
-    """
-    try:
-        redis_key = f"last_bot_message:{chat_id}:{user_id}"
-        await redis_client.set(redis_key, str(message_id), ex=86400)  # TTL 24 часа
-    except Exception:
-        pass
-
-
 async def answer_and_save(message: Message, text: str = None, **kwargs) -> Message:
     """
     Отправляет сообщение и автоматически сохраняет его ID для последующего удаления
@@ -0,0 +1,262 @@
+"""
+Легковесная трассировка покупки: длительность этапов от нажатия кнопки до выдачи ключа
+
+Этапы внутри одной задачи (хендлер, проверка платежа) собираются через contextvars:
+span() работает и в синхронном коде (SDK YooKassa), и в async, не требуя передавать
+payment_id в сервисы. Накопленные этапы записываются в Redis через flush_trace().
+Этапы, растянутые между процессами и задачами (ожидание оплаты, полное время покупки),
+считаются по отметкам времени mark() / record_since_mark().
+
+Этап может встречаться в покупке несколько раз (вход в панель при каждой проверке),
+поэтому в hash платежа длительности суммируются, а в выборки для перцентилей попадает
+одна сумма на покупку - при ее завершении (complete_payment_trace).
+"""
+import logging
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional, Dict, List, Tuple
+from core.storage import redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class TraceKeys:
+    """Ключи для трассировки"""
+    # Этапы и отметки времени одного платежа (hash)
+    PAYMENT_TRACE = "trace:payment:{payment_id}"
+    # Последние длительности этапа по завершенным покупкам для расчета перцентилей (list)
+    STAGE_SAMPLES = "trace:stage:{stage}"
+    # Все известные этапы (set)
+    STAGES = "trace:stages"
+
+
+class TraceStages:
+    """Названия этапов покупки"""
+    SERVER_SELECTION = "server_selection"
+    YOOKASSA_CREATE = "yookassa_create"
+    PAYMENT_SAVE = "payment_save"
+    PAYMENT_WAIT = "payment_wait"  # от создания платежа до обнаружения оплаты ботом
+    POLL_LAG = "poll_lag"  # от подтверждения оплаты в YooKassa до обнаружения ботом
+    YOOKASSA_STATUS = "yookassa_status"
+    X3UI_LOGIN = "x3ui_login"
+    X3UI_PROVISION = "x3ui_provision"
+    X3UI_KEYS = "x3ui_keys"
+    SUBSCRIPTION_SAVE = "subscription_save"
+    KEY_DELIVERY = "key_delivery"
+    TOTAL = "total"  # от нажатия кнопки оплаты до отправки ключа
+
+
+# Отметки времени
+MARK_PURCHASE_STARTED = "purchase_started"
+MARK_PAYMENT_CREATED = "payment_created"
+# Покупка завершена, этапы добавлены в выборки (защита от повторного добавления)
+MARK_COMPLETED = "completed"
+
+# Сколько хранить трассировку платежа (7 дней)
+TRACE_TTL = 7 * 86400
+
+# Сколько последних измерений хранить на этап
+STAGE_SAMPLES_LIMIT = 1000
+
+
+@dataclass
+class _TraceContext:
+    payment_id: Optional[int] = None
+    spans: List[Tuple[str, float]] = field(default_factory=list)
+
+
+_current_trace: ContextVar[Optional[_TraceContext]] = ContextVar("purchase_trace", default=None)
+
+
+def start_trace(payment_id: Optional[int] = None) -> None:
+    """Начать трассировку в текущей задаче (payment_id можно указать позже через bind_payment)"""
+    _current_trace.set(_TraceContext(payment_id=payment_id))
+
+
+def bind_payment(payment_id: int) -> None:
+    """Привязать текущую трассировку к платежу"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.payment_id = payment_id
+
+
+def add_span(stage: str, duration_ms: float) -> None:
+    """Добавить уже измеренный этап в текущую трассировку"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((stage, duration_ms))
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Измерить длительность блока кода как этап текущей трассировки
+
+    Вне трассировки (например, при повторных попытках из очереди) ничего не записывает.
+    """
+    if _current_trace.get() is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(stage, (time.perf_counter() - started) * 1000)
+
+
+async def _store_spans(payment_id: int, spans: List[Tuple[str, float]]) -> None:
+    """Добавить длительности этапов к трассировке платежа в Redis"""
+    if not redis_client or not spans:
+        return
+
+    key = TraceKeys.PAYMENT_TRACE.format(payment_id=payment_id)
+    pipe = redis_client.pipeline(transaction=False)
+    for stage, duration_ms in spans:
+        pipe.hincrbyfloat(key, stage, round(duration_ms, 1))
+    pipe.expire(key, TRACE_TTL)
+    await pipe.execute()
+
+
+async def _store_stage_samples(stages: Dict[str, float]) -> None:
+    """Добавить длительности этапов одной покупки в выборки для перцентилей"""
+    if not redis_client or not stages:
+        return
+
+    pipe = redis_client.pipeline(transaction=False)
+    for stage, duration_ms in stages.items():
+        samples_key = TraceKeys.STAGE_SAMPLES.format(stage=stage)
+        pipe.lpush(samples_key, round(duration_ms, 1))
+        pipe.ltrim(samples_key, 0, STAGE_SAMPLES_LIMIT - 1)
+        pipe.sadd(TraceKeys.STAGES, stage)
+    await pipe.execute()
+
+
+async def flush_trace() -> None:
+    """Записать накопленные этапы текущей трассировки в Redis"""
+    trace = _current_trace.get()
+    if trace is None or trace.payment_id is None or not trace.spans:
+        return
+
+    spans, trace.spans = trace.spans, []
+    try:
+        await _store_spans(trace.payment_id, spans)
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении трассировки платежа {trace.payment_id}: {e}")
+
+
+async def mark(payment_id: int, name: str, timestamp: Optional[float] = None) -> None:
+    """Сохранить отметку времени (unix time) для платежа"""
+    if not redis_client:
+        return
+
+    key = TraceKeys.PAYMENT_TRACE.format(payment_id=payment_id)
+    try:
+        await redis_client.hset(key, f"mark:{name}", timestamp if timestamp is not None else time.time())
+        await redis_client.expire(key, TRACE_TTL)
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении отметки {name} платежа {payment_id}: {e}")
+
+
+async def start_payment_trace(payment_id: int, purchase_started_at: float) -> None:
+    """
+    Привязать текущую трассировку к только что созданному платежу: записать накопленные
+    этапы и сохранить отметки начала покупки и создания платежа
+    """
+    bind_payment(payment_id)
+    await flush_trace()
+    await mark(payment_id, MARK_PURCHASE_STARTED, purchase_started_at)
+    await mark(payment_id, MARK_PAYMENT_CREATED)
+
+
+async def record_since_mark(payment_id: int, mark_name: str, stage: str) -> Optional[float]:
+    """
+    Записать этап длительностью от сохраненной отметки до текущего момента
+
+    Returns:
+        Длительность в миллисекундах или None, если отметки нет
+    """
+    if not redis_client:
+        return None
+
+    try:
+        started = await redis_client.hget(TraceKeys.PAYMENT_TRACE.format(payment_id=payment_id), f"mark:{mark_name}")
+        if not started:
+            return None
+        duration_ms = (time.time() - float(started)) * 1000
+        await _store_spans(payment_id, [(stage, duration_ms)])
+        return duration_ms
+    except Exception as e:
+        logger.error(f"Ошибка при записи этапа {stage} платежа {payment_id}: {e}")
+        return None
+
+
+async def complete_payment_trace(payment_id: int) -> None:
+    """
+    Завершить трассировку покупки после выдачи ключа
+
+    Записывает накопленные этапы текущей задачи и полное время покупки, затем добавляет
+    суммарные длительности этапов платежа в выборки - по одному значению на покупку.
+    """
+    await flush_trace()
+    await record_since_mark(payment_id, MARK_PURCHASE_STARTED, TraceStages.TOTAL)
+    if not redis_client:
+        return
+
+    key = TraceKeys.PAYMENT_TRACE.format(payment_id=payment_id)
+    try:
+        if not await redis_client.hsetnx(key, f"mark:{MARK_COMPLETED}", time.time()):
+            return
+        await _store_stage_samples(await get_payment_trace(payment_id))
+    except Exception as e:
+        logger.error(f"Ошибка при завершении трассировки платежа {payment_id}: {e}")
+
+
+async def get_payment_trace(payment_id: int) -> Dict[str, float]:
+    """Получить длительности этапов (мс) для платежа"""
+    if not redis_client:
+        return {}
+
+    try:
+        data = await redis_client.hgetall(TraceKeys.PAYMENT_TRACE.format(payment_id=payment_id))
+        return {stage: float(value) for stage, value in data.items() if not stage.startswith("mark:")}
+    except Exception as e:
+        logger.error(f"Ошибка при получении трассировки платежа {payment_id}: {e}")
+        return {}
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    """Перцентиль по методу ближайшего ранга"""
+    index = max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+async def get_stage_summary() -> Dict[str, Dict[str, float]]:
+    """
+    Сводка по этапам за последние STAGE_SAMPLES_LIMIT завершенных покупок
+
+    Returns:
+        {stage: {"count": ..., "p50": ..., "p95": ...}} (длительности этапа на покупку в миллисекундах)
+    """
+    if not redis_client:
+        return {}
+
+    summary = {}
+    try:
+        stages = await redis_client.smembers(TraceKeys.STAGES)
+        for stage in sorted(stages):
+            samples = await redis_client.lrange(TraceKeys.STAGE_SAMPLES.format(stage=stage), 0, -1)
+            values = sorted(float(value) for value in samples)
+            if not values:
+                continue
+            summary[stage] = {
+                "count": len(values),
+                "p50": _percentile(values, 50),
+                "p95": _percentile(values, 95),
+            }
+    except Exception as e:
+        logger.error(f"Ошибка при получении сводки трассировки: {e}")
+    return summary